@@ -1,11 +1,62 @@
 from __future__ import annotations
 
+import asyncio
+import copy
+import logging
 import secrets
+import time
 from typing import Any
 
-import _pickle as pickle
+from redis import RedisError
 from redis.asyncio import Redis
+from redis.asyncio.cluster import RedisCluster
+from redis.asyncio.retry import Retry
+
 from apphelpers.errors import InvalidSessionError
+from apphelpers.sessions import (
+    INSTRUMENTED_METHODS,
+    INVALIDATION_CHANNEL,
+    RECENT_WRITES_SIZE,
+    REVOCATION_CLOCK_SKEW,
+    REVOKED_ALL_KEY,
+    REVOKED_SIDS_KEY,
+    SIGNED_FIELDS,
+    SLOT_TAG_LEN,
+    BlobCodec,
+    ReplicaSelector,
+    SessionSigner,
+    bound_site_ids_key,
+    bound_uids_key,
+    cluster_bound_site_ids_key,
+    cluster_params,
+    cluster_rev_lookup_key,
+    cluster_session_key,
+    is_wrong_type,
+    site_groups_by_id,
+    slot_tag,
+    to_cluster_key,
+    to_site_id,
+)
+from apphelpers.utilities import chunks
+from apphelpers.utilities.instrumentation import CallMetrics, SlowCallLog, instrument
+from apphelpers.utilities.keyscan import async_scan_batches, async_unlink_matching
+from apphelpers.utilities.lrucache import LRUCache
+from apphelpers.utilities.redispool import (
+    connection_options,
+    pool_stats,
+    pooled_client,
+)
+from apphelpers.utilities.redisscripts import (
+    CREATE_SESSION_SCRIPT,
+    EXTEND_INDEX_SCRIPT,
+    INDEX_SCRIPT,
+    WRITE_SESSION_SCRIPT,
+)
+from apphelpers.utilities.serializers import (
+    build_dumps,
+    build_loads,
+    get_serializer,
+)
 
 _SEP = ":"
 session_key = ("session" + _SEP).__add__
@@ -23,13 +74,249 @@ def rev_lookup_key(uid, site_ctx=None):
 
 THIRTY_DAYS = 30 * 24 * 60 * 60
 
+# Seconds before subscribing again to a lost invalidation channel, doubled
+# after each failed attempt up to the cap
+RESUBSCRIBE_DELAY = 0.5
+RESUBSCRIBE_DELAY_CAP = 30
+
+logger = logging.getLogger("apphelpers.sessions")
+
+
+def connect(rconn_params, pool_options=None):
+    """
+    Same as apphelpers.sessions.connect for redis.asyncio clients
+    """
+    params = dict(rconn_params)
+    backend = params.pop("backend", None)
+    if backend == "memory":
+        from apphelpers.utilities.memoryredis import AsyncMemoryRedis as backend
+    if backend is not None:
+        return backend(**params)
+    return pooled_client(params, client_class=Redis, **(pool_options or {}))
+
+
+_MISSING = object()
+# Handed to the waiters of a lookup whose caller was cancelled: one of them
+# looks the session up again
+_RETRY = object()
+
 
 class SessionDBHandler:
-    def __init__(self, rconn_params):
+    def __init__(
+        self,
+        rconn_params,
+        serializer="pickle",
+        pickle_fallback=True,
+        compression=None,
+        compression_threshold=1024,
+        layout="hash",
+        negative_cache_size=0,
+        negative_cache_ttl=10,
+        cache_size=0,
+        cache_ttl=5,
+        cache_max_bytes=None,
+        signing_key=None,
+        signed_ttl=300,
+        signed_fields=SIGNED_FIELDS,
+        record_revocations=None,
+        revocation_poll_interval=5,
+        extend_interval=0,
+        extend_cache_size=10000,
+        cluster=False,
+        replicas=None,
+        replica_selection="round_robin",
+        read_your_writes=2,
+        max_connections=None,
+        pool_timeout=None,
+        health_check_interval=None,
+        socket_keepalive=None,
+        retries=None,
+        retry_backoff=0.01,
+        retry_backoff_cap=1.0,
+        metrics=None,
+        call_hooks=(),
+        slow_call_threshold=None,
+    ):
         """
-        rconn_params: redis connection parameters
+        rconn_params: redis connection parameters, optionally with a "backend"
+                      (see `connect`)
+        serializer: "pickle", "msgpack", "json" or an object with `tag`, `dumps`
+                    and `loads` (see apphelpers.utilities.serializers)
+        pickle_fallback: keep reading pickled values, e.g. sessions written
+                         before switching to another serializer. Turn it off
+                         once those sessions have expired. Values written by
+                         the other serializers are always readable.
+        compression: "zlib", "zstd" or None. Compresses each field whose encoded
+                     value is at least `compression_threshold` bytes, e.g. large
+                     profiles in `extras`. Compressed fields are always readable.
+        layout: "hash" (a field per session key) or "blob" (all fields in one
+                msgpack map in a string key: one GET and one unpack per read,
+                less memory per session; writes are merged server side. Needs
+                msgpack). Sessions stored in either layout stay readable and
+                writable whatever the setting.
+        negative_cache_size: max invalid sids remembered in-process, so that
+                             clients retrying with an expired token do not reach
+                             Redis every time (0 disables it)
+        negative_cache_ttl: seconds an invalid sid is remembered
+        cache_size: max decoded sessions cached in-process (0 disables the cache)
+        cache_ttl: seconds a cached session is served without asking Redis
+        cache_max_bytes: optional bound on the encoded size of cached sessions
+        signing_key: enables signed tokens (see `issue_signed_token`)
+        signed_ttl: seconds a signed token is trusted without asking Redis
+        signed_fields: session fields carried by signed tokens, readable by
+                       anyone holding one. Fields a token does not carry are
+                       read from Redis.
+        record_revocations: record in Redis the sids whose signed tokens
+                            `destroy`, `update` etc. revoke (default: when
+                            given a `signing_key`). Costs writes to one key.
+        revocation_poll_interval: seconds between refreshes of the revoked sids.
+                                  A destroyed session's signed tokens stop
+                                  verifying everywhere within this interval.
+        extend_interval: seconds during which `extend_timeout` skips sessions
+                         this process has already extended, so that it can be
+                         called on every request for sliding expiry
+        extend_cache_size: max sids whose last extension is remembered
+        cluster: connect to a Redis Cluster (the `rconn_params` it takes go to
+                 RedisCluster) and use the cluster key layout. Existing
+                 sessions are moved over with `migrate_to_cluster_layout`.
+        replicas: list of connection parameters of read replicas. `get`,
+                  `get_many`, `get_attribute`, `uid2sid` etc. read from them and
+                  ask the primary again when a replica does not have the key.
+                  (In cluster mode use RedisCluster's `read_from_replicas`.)
+        replica_selection: "round_robin" or "least_latency"
+        read_your_writes: seconds during which keys this process wrote are read
+                          from the primary, so that replication lag cannot hide
+                          its own updates
+        max_connections: max connections per pool (the primary and each replica
+                         have their own)
+        pool_timeout: seconds to wait for a free connection once
+                      `max_connections` are in use (blocking pool, 50
+                      connections unless told otherwise). None: fail at once.
+        health_check_interval: seconds a connection may sit idle before it is
+                               checked with a PING when next used, so that dead
+                               sockets are replaced after a failover
+        socket_keepalive: enable TCP keepalive on the connections
+        retries: times a command is retried after a connection error or timeout
+        retry_backoff: first delay between retries, in seconds; grows
+                       exponentially (with jitter) up to `retry_backoff_cap`
+        The connection options left as None keep the redis client's defaults.
+        metrics: True or a CallMetrics (apphelpers.utilities.instrumentation)
+                 to record the count, latency histogram and errors of each
+                 public method, available as `self.metrics.stats()`
+        call_hooks: callables called as hook(method, seconds, error) after
+                    each public method call (error: the exception raised or
+                    None), e.g. to feed an external metrics registry
+        slow_call_threshold: seconds from which calls are logged as slow (to
+                             the "apphelpers.sessions" logger)
+        Without metrics, hooks or slow call threshold the methods are not
+        wrapped at all.
+
+        Cached sessions are evicted on `update`, `resync`, `destroy` etc. from any
+        process through the INVALIDATION_CHANNEL pub/sub channel. Sessions are
+        only cached while this process is subscribed to it, and are loaded from
+        the primary so that no cached copy predates the last invalidation.
+
+        Where signed tokens are used, every process destroying sessions or
+        writing their signed fields must record the revocations: give them all
+        `record_revocations=True` and the same `signed_ttl` and `signed_fields`,
+        with or without a `signing_key`.
         """
-        self.rconn = Redis(**rconn_params)
+        pool_options = dict(
+            max_connections=max_connections,
+            health_check_interval=health_check_interval,
+            socket_keepalive=socket_keepalive,
+            retries=retries,
+            retry_backoff=retry_backoff,
+            retry_backoff_cap=retry_backoff_cap,
+        )
+        self.cluster = cluster
+        if cluster:
+            # Cluster clients keep a pool per node and cannot block on them
+            self.rconn = RedisCluster(
+                **cluster_params(rconn_params, RedisCluster),
+                **connection_options(retry_class=Retry, **pool_options),
+            )
+            self._session_key = cluster_session_key
+            self._rev_lookup_key = cluster_rev_lookup_key
+            self._bound_site_ids_key = cluster_bound_site_ids_key
+            self._mget = self.rconn.mget_nonatomic
+        else:
+            pool_options["pool_timeout"] = pool_timeout
+            self.rconn = connect(rconn_params, pool_options)
+            self._session_key = session_key
+            self._rev_lookup_key = rev_lookup_key
+            self._bound_site_ids_key = bound_site_ids_key
+            self._mget = self.rconn.mget
+        self._bound_uids_key = bound_uids_key
+        self._create_script = self.rconn.register_script(CREATE_SESSION_SCRIPT)
+        self.replicas = [connect(params, pool_options) for params in replicas or ()]
+        self._replica_selector = (
+            ReplicaSelector(len(self.replicas), replica_selection)
+            if self.replicas
+            else None
+        )
+        self._recent_writes = LRUCache(RECENT_WRITES_SIZE, read_your_writes)
+        self._index_script = self.rconn.register_script(INDEX_SCRIPT)
+        self._extend_index_script = self.rconn.register_script(EXTEND_INDEX_SCRIPT)
+        self._write_script = self.rconn.register_script(WRITE_SESSION_SCRIPT)
+        if layout not in ("hash", "blob"):
+            raise ValueError(f"Unknown session layout: {layout}")
+        self.layout = layout
+        try:
+            self._blob = BlobCodec()
+        except ImportError:
+            if layout == "blob":
+                raise
+            self._blob = None  # no blob layout sessions to read without msgpack
+        if layout == "blob":
+            self._fetch_layout, self._fetch_other = self._fetch_blob, self._fetch_hash
+        else:
+            self._fetch_layout, self._fetch_other = self._fetch_hash, self._fetch_blob
+        self.serializer = get_serializer(serializer)
+        self._dumps = build_dumps(self.serializer, compression, compression_threshold)
+        self._loads = build_loads(self.serializer, allow_pickle=pickle_fallback)
+        self.negative_cache = (
+            LRUCache(negative_cache_size, negative_cache_ttl)
+            if negative_cache_size
+            else None
+        )
+        self.cache = (
+            LRUCache(cache_size, cache_ttl, cache_max_bytes) if cache_size else None
+        )
+        self._cache_generation = 0
+        self._invalidation_listener = None
+        self._invalidations_subscribed = False
+        self._inflight = {}
+        self.signer = (
+            SessionSigner(signing_key, signed_ttl, signed_fields)
+            if signing_key
+            else None
+        )
+        self.signed_ttl = signed_ttl
+        self._signed_fields = frozenset(signed_fields)
+        self.record_revocations = (
+            signing_key is not None
+            if record_revocations is None
+            else record_revocations
+        )
+        self.revocation_poll_interval = revocation_poll_interval
+        # sid -> time its signed tokens were revoked, latest time read
+        self._revoked = {}
+        self._revoked_read_until = 0.0
+        self._revoked_before = 0.0
+        self._revocations_synced_at = 0.0
+        self.extend_interval = extend_interval
+        # sid -> (reverse lookup key or None, bound session index keys,
+        #         monotonic time of last extension)
+        self._extended = LRUCache(extend_cache_size)
+        self.metrics = CallMetrics() if metrics is True else metrics
+        hooks = list(call_hooks)
+        if self.metrics is not None:
+            hooks.append(self.metrics.record)
+        if slow_call_threshold is not None:
+            hooks.append(SlowCallLog(slow_call_threshold))
+        if hooks:
+            instrument(self, INSTRUMENTED_METHODS, hooks)
 
     async def create(
         self,
@@ -46,13 +333,16 @@ class SessionDBHandler:
         extras (dict): each key-value pair of extras get stored into hset
         site_ctx: int (session is only applicable for bound site_id)
         """
-        if uid:
-            sid = await self.uid2sid(uid, site_ctx)
-            if sid:
-                return sid
-
         sid = secrets.token_urlsafe()
-        key = session_key(sid)
+        if self.cluster:
+            sid = (slot_tag(uid) if uid else secrets.token_hex(SLOT_TAG_LEN // 2)) + sid
+        keys = [self._session_key(sid)]
+        if uid:
+            keys.append(self._rev_lookup_key(uid, site_ctx))
+            if site_ctx:
+                keys.append(self._bound_site_ids_key(uid))
+                if not self.cluster:
+                    keys.append(self._bound_uids_key(site_ctx))
 
         if groups is None:
             groups = []
@@ -64,42 +354,577 @@ class SessionDBHandler:
         }
         if extras:
             session_dict.update(extras)
-        session = {k: pickle.dumps(v) for k, v in session_dict.items()}
-        await self.rconn.hset(key, mapping=session)
-
+        args = [sid, ttl, uid, site_ctx or ""]
+        if self.layout == "blob":
+            args.append(
+                self._blob.pack({k: self._dumps(v) for k, v in session_dict.items()})
+            )
+        else:
+            for k, v in session_dict.items():
+                args.extend((k, self._dumps(v)))
+        # Dedupe check, session write, reverse lookup and TTLs happen in one
+        # atomic round trip, so a session can never be left without a TTL
+        sid = (await self._create_script(keys=keys, args=args)).decode()
+        if self.cluster and uid and site_ctx:
+            await self._index_script(
+                keys=[self._bound_uids_key(site_ctx)], args=[uid, ttl]
+            )
+        if self.negative_cache is not None:
+            self.negative_cache.pop(sid)
         if uid:
-            rev_key = rev_lookup_key(uid, site_ctx)
-            await self.rconn.setex(rev_key, value=sid, time=ttl)
-        await self.rconn.expire(key, ttl)
+            self._wrote(self._rev_lookup_key(uid, site_ctx))
+        self._wrote(self._session_key(sid))
         return sid
 
     async def exists(self, sid):
-        return await self.rconn.exists(session_key(sid))
+        sk = self._session_key(self._unsign(sid))
 
-    async def get(self, sid, keys=[]) -> dict[str, Any]:
-        s_values = await self.rconn.hgetall(session_key(sid))
-        if not s_values:
+        async def read(conn):
+            return await conn.exists(sk) or None
+
+        return await self._read(read, sk) or 0
+
+    async def _read(self, read, key=None):
+        """
+        => await read(connection) from a replica, or from the primary if there
+        are no replicas, if this process wrote `key` within `read_your_writes`,
+        or if the replica fails or comes up empty (None)
+        """
+        if not self.replicas or (key is not None and key in self._recent_writes):
+            return await read(self.rconn)
+        selector = self._replica_selector
+        index = selector.pick()
+        started_at = time.perf_counter()
+        try:
+            result = await read(self.replicas[index])
+        except RedisError:
+            selector.record(index, selector.error_penalty)
+            return await read(self.rconn)
+        selector.record(index, time.perf_counter() - started_at)
+        return await read(self.rconn) if result is None else result
+
+    async def _read_many(self, read, items, key):
+        """
+        Same as `_read` for read(connection, items) => [result or None, ...]:
+        items missing from the replica, or whose `key(item)` this process wrote
+        recently, are read again from the primary
+        """
+        items = list(items)
+        results = await self._read(lambda conn: read(conn, items))
+        if not self.replicas:
+            return results
+        again = [
+            i
+            for i, (item, result) in enumerate(zip(items, results))
+            if result is None or key(item) in self._recent_writes
+        ]
+        if again:
+            found = await read(self.rconn, [items[i] for i in again])
+            for i, result in zip(again, found):
+                results[i] = result
+        return results
+
+    def _wrote(self, *keys):
+        if self.replicas:
+            for key in keys:
+                self._recent_writes.set(key, True)
+
+    async def get(self, sid, keys=[], default=None) -> dict[str, Any]:
+        """
+        keys: fetch (HMGET) and decode only these fields
+        default: value for a field missing from the session
+
+        raises InvalidSessionError if the session itself is missing
+
+        With the cache enabled a miss loads the whole session once so that any
+        later lookup for the sid, whatever its keys, is served from memory.
+
+        `sid` may also be a signed token, whose fields are read without asking
+        Redis while it is fresh. Fields it does not carry are read from Redis.
+        """
+        if self.signer is not None and self.signer.is_signed(sid):
+            return await self._get_signed(sid, keys, default)
+        negative_cache = self.negative_cache
+        if negative_cache is not None and negative_cache.get(sid):
+            raise InvalidSessionError()
+        if self.cache is not None:
+            session = self._cached(sid)
+            if session is not None:
+                if keys:
+                    return {k: session.get(k, default) for k in keys}
+                return session
+        try:
+            session = await self._get_once(sid, keys)
+        except InvalidSessionError:
+            if negative_cache is not None:
+                negative_cache.set(sid, True)
+            raise
+        return {k: default if v is _MISSING else v for k, v in session.items()}
+
+    async def _get_once(self, sid, keys):
+        """
+        Concurrent lookups of the same sid and keys in this event loop share one
+        Redis call. The first one reads directly; only lookups arriving while it
+        is in flight get a future, for its result or error. Each of them gets
+        its own deep copy of the result.
+        """
+        loop = asyncio.get_running_loop()
+        flight_key = (sid, tuple(keys) if keys else ())
+        # [event loop, future for the waiters or None]
+        flight = self._inflight.get(flight_key)
+        while flight is not None and flight[0] is loop:
+            if flight[1] is None:
+                flight[1] = loop.create_future()
+            # shield: a cancelled waiter must not cancel the lookup for the others
+            result = await asyncio.shield(flight[1])
+            if result is not _RETRY:
+                return copy.deepcopy(result, {id(_MISSING): _MISSING})
+            flight = self._inflight.get(flight_key)
+        flight = self._inflight[flight_key] = [loop, None]
+        try:
+            result = await self._get(sid, keys)
+        except BaseException as e:
+            self._landed(flight_key, flight, error=e)
+            raise
+        self._landed(flight_key, flight, result)
+        return result
+
+    def _landed(self, flight_key, flight, result=None, error=None):
+        if self._inflight.get(flight_key) is flight:
+            del self._inflight[flight_key]
+        waiters = flight[1]
+        if waiters is None:
+            return
+        if isinstance(error, Exception):
+            waiters.set_exception(error)
+            waiters.exception()  # retrieved even if every waiter was cancelled
+        elif error is not None:
+            waiters.set_result(_RETRY)
+        else:
+            # Copied before the caller that looked it up can change it
+            waiters.set_result(copy.deepcopy(result, {id(_MISSING): _MISSING}))
+
+    async def _get(self, sid, keys):
+        """
+        Missing fields come back as _MISSING
+        """
+        if self.cache is not None:
+            session = await self._load(sid)
+            return {k: session.get(k, _MISSING) for k in keys} if keys else session
+
+        sk = self._session_key(sid)
+        fields = await self._read(lambda conn: self._fetch(conn, sk, keys), sk)
+        if fields is None:
             raise InvalidSessionError()
-        session = {k.decode(): pickle.loads(v) for k, v in s_values.items()}
         if keys:
-            session = {k: session.get(k, None) for k in keys}
+            return self._decode_fields(keys, fields, _MISSING)
+        return self._decode(fields)
+
+    async def _fetch(self, conn, sk, keys):
+        """
+        => encoded fields of the session, whichever its layout: [value, ...] of
+        `keys`, or {field: value} of all fields if no `keys`. None if the
+        session is missing.
+        """
+        try:
+            return await self._fetch_layout(conn, sk, keys)
+        except RedisError as e:
+            if not is_wrong_type(e):
+                raise
+            return await self._fetch_other(conn, sk, keys)
+
+    async def _fetch_hash(self, conn, sk, keys):
+        if keys:
+            return await self._hmget(conn, sk, keys)
+        return await conn.hgetall(sk) or None
+
+    async def _fetch_blob(self, conn, sk, keys):
+        blob = await conn.get(sk)
+        return None if blob is None else self._unpack(blob, keys)
+
+    def _unpack(self, blob, keys):
+        fields = self._blob.unpack(blob)
+        return [fields.get(k.encode()) for k in keys] if keys else fields
+
+    @staticmethod
+    async def _hmget(conn, sk, keys):
+        """
+        => values of `keys`, None if the session is missing
+        """
+        pipe = conn.pipeline(transaction=False)
+        pipe.exists(sk)
+        pipe.hmget(sk, keys)
+        exists, values = await pipe.execute()
+        return values if exists else None
+
+    async def _get_signed(self, token, keys, default):
+        sid, issued_at, expires_at, session = self.signer.verify(token)
+        if expires_at <= time.time():
+            # Past its trust window a token is as good as the sid it carries
+            return await self.get(sid, keys, default)
+        await self._sync_revocations()
+        if (
+            issued_at <= self._revoked.get(sid, 0)
+            or issued_at <= self._revoked_before
+            or not keys
+        ):
+            # Destroyed or changed since (Redis tells which), or asked for the
+            # whole session
+            return await self.get(sid, keys, default)
+        unsigned = [k for k in keys if k not in session]
+        if unsigned:
+            session = {**session, **(await self.get(sid, unsigned, default))}
+        return {k: session.get(k, default) for k in keys}
+
+    async def _sync_revocations(self):
+        now = time.time()
+        if now - self._revocations_synced_at < self.revocation_poll_interval:
+            return
+        # Set first: lookups arriving meanwhile use the current set, not another poll
+        self._revocations_synced_at = now
+        trusted_since = now - self.signed_ttl
+        pipe = self.rconn.pipeline(transaction=False)
+        pipe.zrangebyscore(
+            REVOKED_SIDS_KEY,
+            max(self._revoked_read_until - REVOCATION_CLOCK_SKEW, trusted_since),
+            "+inf",
+            withscores=True,
+        )
+        pipe.get(REVOKED_ALL_KEY)
+        revoked, revoked_before = await pipe.execute()
+        if revoked:
+            self._revoked_read_until = revoked[-1][1]
+        self._revoked = {
+            sid: revoked_at
+            for sid, revoked_at in self._revoked.items()
+            if revoked_at > trusted_since
+        }
+        self._revoked.update((sid.decode(), revoked_at) for sid, revoked_at in revoked)
+        self._revoked_before = float(revoked_before or 0)
+
+    def _revoke(self, pipe, sids):
+        """
+        Queues on `pipe` the revocation of signed tokens issued so far for
+        `sids`: those of destroyed sessions stop verifying, the others are
+        answered from Redis. Only if `record_revocations`.
+        """
+        if not sids or not self.record_revocations:
+            return
+        now = time.time()
+        pipe.zadd(REVOKED_SIDS_KEY, {sid: now for sid in sids})
+        pipe.zremrangebyscore(REVOKED_SIDS_KEY, "-inf", now - self.signed_ttl)
+        pipe.expire(REVOKED_SIDS_KEY, self.signed_ttl)
+        self._revoked.update(dict.fromkeys(sids, now))
+
+    def _signs(self, fields):
+        """
+        => whether signed tokens carry any of `fields` (None: all fields)
+        """
+        return fields is None or not self._signed_fields.isdisjoint(fields)
+
+    def _unsign(self, sid):
+        """
+        => the sid a signed token was issued for, else `sid` itself
+        """
+        if self.signer is not None and self.signer.is_signed(sid):
+            return self.signer.verify(sid)[0]
+        return sid
+
+    def _unsign_many(self, sids):
+        """
+        => `_unsign` of each of `sids`, None for malformed or forged tokens
+        """
+        unsigned = []
+        for sid in sids:
+            try:
+                unsigned.append(self._unsign(sid))
+            except InvalidSessionError:
+                unsigned.append(None)
+        return unsigned
+
+    async def issue_signed_token(self, sid):
+        """
+        => token carrying the session's `signed_fields`, accepted by `get` in
+        place of the sid. Needs `signing_key`.
+
+        raises InvalidSessionError if the session is missing
+        """
+        sid = self._unsign(sid)
+        session = await self.get(sid, list(self.signer.fields))
+        return self.signer.sign(sid, session)
+
+    async def get_many(self, sids, keys=None, default=None, chunk_size=500):
+        """
+        => [session or None, ...] in the order of `sids`, None for missing sessions
+        (and malformed or forged signed tokens)
+        keys, default: same as for `get`
+        chunk_size: sessions fetched per pipelined round trip
+        """
+        unsigned = self._unsign_many(sids)
+        valid = [sid for sid in unsigned if sid is not None]
+        found = iter(await self._lookup_many(valid, keys, default, chunk_size))
+        return [next(found) if sid is not None else None for sid in unsigned]
+
+    async def _lookup_many(self, sids, keys, default, chunk_size):
+        if self.cache is not None:
+            sessions = [self._cached(sid) for sid in sids]
+            missing = [sid for sid, session in zip(sids, sessions) if session is None]
+            if missing:
+                loaded = iter(await self._load_many(missing, chunk_size))
+                sessions = [
+                    session if session is not None else next(loaded)
+                    for session in sessions
+                ]
+            if keys:
+                return [
+                    {k: session.get(k, default) for k in keys} if session else None
+                    for session in sessions
+                ]
+            return sessions
+
+        return await self._read_many(
+            lambda conn, sids: self._get_many(conn, sids, keys, default, chunk_size),
+            sids,
+            self._session_key,
+        )
+
+    async def _get_many(self, conn, sids, keys, default, chunk_size):
+        sessions = []
+        for chunk in chunks(sids, chunk_size):
+            sks = map(self._session_key, chunk)
+            for fields in await self._fetch_many(conn, sks, keys):
+                if fields is None:
+                    sessions.append(None)
+                elif keys:
+                    sessions.append(self._decode_fields(keys, fields, default))
+                else:
+                    sessions.append(self._decode(fields))
+        return sessions
+
+    async def _fetch_many(self, conn, sks, keys):
+        """
+        `_fetch` for many session keys in one pipelined round trip
+        """
+        sks = list(sks)
+        blob_layout = self.layout == "blob"
+        # Commands queued per session
+        step = 2 if keys and not blob_layout else 1
+        pipe = conn.pipeline(transaction=False)
+        for sk in sks:
+            if blob_layout:
+                pipe.get(sk)
+            elif keys:
+                pipe.exists(sk)
+                pipe.hmget(sk, keys)
+            else:
+                pipe.hgetall(sk)
+        results = await pipe.execute(raise_on_error=False)
+        fetched = []
+        for i, sk in enumerate(sks):
+            result = results[i * step + step - 1]
+            if isinstance(result, Exception):
+                if not is_wrong_type(result):
+                    raise result
+                fetched.append(await self._fetch_other(conn, sk, keys))
+            elif result is None:
+                fetched.append(None)
+            elif blob_layout:
+                fetched.append(self._unpack(result, keys))
+            elif keys:
+                fetched.append(result if results[i * step] else None)
+            else:
+                fetched.append(result or None)
+        return fetched
+
+    def _decode(self, s_values):
+        fields = ((k.decode(), v) for k, v in s_values.items())
+        return {k: self._load_field(k, v) for k, v in fields}
+
+    def _decode_fields(self, keys, values, default):
+        return {
+            k: self._load_field(k, v) if v is not None else default
+            for k, v in zip(keys, values)
+        }
+
+    def _load_field(self, name, data):
+        value = self._loads(data)
+        if name == "site_groups" and value:
+            value = site_groups_by_id(value)
+        return value
+
+    async def _load(self, sid):
+        """
+        Fetches the whole session and caches it
+        """
+        generation = self._cache_generation
+        s_values = await self._fetch(self.rconn, self._session_key(sid), None)
+        if not s_values:
+            raise InvalidSessionError()
+        session = self._decode(s_values)
+        self._cache_session(sid, session, s_values, generation)
         return session
 
+    async def _load_many(self, sids, chunk_size):
+        """
+        Same as `_load` for many sessions, None for missing ones
+        """
+        generation = self._cache_generation
+        sessions = []
+        for chunk in chunks(sids, chunk_size):
+            sks = map(self._session_key, chunk)
+            for sid, s_values in zip(
+                chunk, await self._fetch_many(self.rconn, sks, None)
+            ):
+                session = self._decode(s_values) if s_values else None
+                if session is not None:
+                    self._cache_session(sid, session, s_values, generation)
+                sessions.append(session)
+        return sessions
+
+    def _cache_session(self, sid, session, s_values, generation):
+        """
+        generation: `_cache_generation` from before the session was fetched, so
+        that a copy fetched before an invalidation is not cached
+        """
+        if self._can_cache() and generation == self._cache_generation:
+            size = sum(len(k) + len(v) for k, v in s_values.items())
+            # A copy: the caller gets `session` itself
+            self.cache.set(sid, copy.deepcopy(session), size=size)  # type: ignore
+
+    def _cached(self, sid):
+        """
+        => a deep copy of the cached session, None if not cached, so that
+        callers mutating its values (e.g. the groups list) leave the cache be
+        """
+        session = self.cache.get(sid)  # type: ignore
+        return copy.deepcopy(session) if session is not None else None
+
     async def get_attribute(self, sid, attribute):
-        value = await self.rconn.hget(session_key(sid), attribute)
-        return pickle.loads(value) if value else None
+        sid = self._unsign(sid)
+        session = self.cache.get(sid) if self.cache is not None else None
+        if session is not None:
+            return copy.deepcopy(session.get(attribute))
+        sk = self._session_key(sid)
+        values = await self._read(lambda conn: self._fetch(conn, sk, [attribute]), sk)
+        if not values or not values[0]:
+            return None
+        return self._load_field(attribute, values[0])
+
+    def _can_cache(self):
+        """
+        Caching is only safe while invalidations are being received, so this also
+        (re)starts the listener for the running event loop when needed
+        """
+        if self.cache is None:
+            return False
+        listener = self._invalidation_listener
+        if (
+            listener is None
+            or listener.done()
+            or listener.get_loop() is not asyncio.get_running_loop()
+        ):
+            self._invalidations_subscribed = False
+            self._invalidation_listener = asyncio.ensure_future(
+                self._listen_for_invalidations()
+            )
+        return self._invalidations_subscribed
+
+    def _evict(self, sid):
+        self._cache_generation += 1
+        if self.cache is not None:
+            if sid == "*":
+                self.cache.clear()
+            else:
+                self.cache.pop(sid)
+
+    async def _listen_for_invalidations(self):
+        delay = RESUBSCRIBE_DELAY
+        while True:
+            pubsub = self.rconn.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(INVALIDATION_CHANNEL)
+                self._invalidations_subscribed = True
+                delay = RESUBSCRIBE_DELAY
+                async for message in pubsub.listen():
+                    self._evict(message["data"].decode())
+            except Exception:
+                logger.exception(
+                    "session invalidations lost, resubscribing in %.1fs", delay
+                )
+            finally:
+                # Invalidations may be missed until we are subscribed again:
+                # nothing is cached meanwhile
+                self._invalidations_subscribed = False
+                self._evict("*")
+                await pubsub.aclose()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RESUBSCRIBE_DELAY_CAP)
 
     async def uid2sid(self, uid, site_ctx=None):
-        sid = await self.rconn.get(rev_lookup_key(uid, site_ctx))
+        rev_key = self._rev_lookup_key(uid, site_ctx)
+        sid = await self._read(lambda conn: conn.get(rev_key), rev_key)
         return sid.decode() if sid else None
 
+    async def uid2sid_many(self, uids, site_ctx=None, chunk_size=500):
+        """
+        => [sid or None, ...] in the order of `uids`
+        chunk_size: uids looked up per MGET
+        """
+        rev_keys = [self._rev_lookup_key(uid, site_ctx) for uid in uids]
+        sids = await self._read_many(
+            lambda conn, rev_keys: self._mget_chunked(conn, rev_keys, chunk_size),
+            rev_keys,
+            lambda rev_key: rev_key,
+        )
+        return [sid.decode() if sid else None for sid in sids]
+
+    async def _mget_chunked(self, conn, keys, chunk_size):
+        mget = self._mget if conn is self.rconn else conn.mget
+        values = []
+        for chunk in chunks(keys, chunk_size):
+            values.extend(await mget(chunk))
+        return values
+
+    async def _bound_lookup(self, uid):
+        """
+        => [(site_id, sid or None), ...] for every site in the uid's index (site
+        ids as stored, str)
+        """
+        site_ids = [
+            site_id.decode()
+            for site_id in await self.rconn.smembers(self._bound_site_ids_key(uid))
+        ]
+        if not site_ids:
+            return []
+        sids = await self.rconn.mget(
+            [self._rev_lookup_key(uid, site_id) for site_id in site_ids]
+        )
+        return [
+            (site_id, sid.decode() if sid else None)
+            for site_id, sid in zip(site_ids, sids)
+        ]
+
+    async def _live_bound_lookup(self, uid):
+        """
+        Same as `_bound_lookup` but drops (and unindexes) expired bound sessions
+        """
+        bound = await self._bound_lookup(uid)
+        expired = [site_id for site_id, sid in bound if sid is None]
+        if expired:
+            pipe = self.rconn.pipeline(transaction=False)
+            pipe.srem(self._bound_site_ids_key(uid), *expired)
+            for site_id in expired:
+                pipe.srem(self._bound_uids_key(site_id), uid)
+            await pipe.execute()
+        return [(site_id, sid) for site_id, sid in bound if sid]
+
     async def uid2bound_sids(self, uid):
-        keys = await self.rconn.keys(rev_lookup_key(uid, "*"))
-        return [(await self.rconn.get(key)).decode() for key in keys]
+        return [sid for _, sid in await self._live_bound_lookup(uid)]
 
     async def uid2bound_site_ids(self, uid):
-        keys = await self.rconn.keys(rev_lookup_key(uid, "*"))
-        return [int(key.decode().split(_SEP)[2]) for key in keys]
+        return [
+            to_site_id(site_id) for site_id, _ in await self._live_bound_lookup(uid)
+        ]
 
     async def sid2uid(self, sid):
         session = await self.get(sid, ["uid"])
@@ -110,13 +935,53 @@ class SessionDBHandler:
         return await self.get(sid) if sid else None
 
     async def get_bound_sessions_for(self, uid):
-        return [self.get(sid) for sid in await self.uid2bound_sids(uid)]
+        sessions = await self.get_many(await self.uid2bound_sids(uid))
+        return [session for session in sessions if session is not None]
 
     # Same default ttl as `create` function
     async def extend_timeout(self, sid, ttl=THIRTY_DAYS):
-        await self.rconn.expire(session_key(sid), ttl)
-        uid = await self.sid2uid(sid)
-        await self.rconn.expire(rev_lookup_key(uid), ttl)
+        """
+        Pushes back the expiry of the session, of its reverse lookup and, for
+        bound sessions, of the indexes listing it (never shortening theirs,
+        which other sessions may need).
+        => False if skipped as the sid was extended within `extend_interval`
+
+        raises InvalidSessionError if the session is missing
+        """
+        sid = self._unsign(sid)
+        now = time.monotonic()
+        extended = self._extended.get(sid)
+        if extended is not None:
+            rev_key, index_keys, extended_at = extended
+            if now - extended_at < self.extend_interval:
+                return False
+        else:
+            session = await self.get(sid, ["uid", "site_ctx"])
+            uid, site_ctx = session["uid"], session["site_ctx"]
+            rev_key = self._rev_lookup_key(uid, site_ctx) if uid else None
+            index_keys = (
+                (self._bound_site_ids_key(uid), self._bound_uids_key(site_ctx))
+                if uid and site_ctx
+                else ()
+            )
+        pipe = self.rconn.pipeline(transaction=False)
+        pipe.expire(self._session_key(sid), ttl)
+        if rev_key:
+            pipe.expire(rev_key, ttl)
+        if not self.cluster:
+            for index_key in index_keys:
+                await self._extend_index_script(
+                    keys=[index_key], args=[ttl], client=pipe
+                )
+        if not (await pipe.execute())[0]:
+            self._extended.pop(sid)
+            raise InvalidSessionError()
+        if self.cluster:
+            # Scripts do not run in cluster pipelines
+            for index_key in index_keys:
+                await self._extend_index_script(keys=[index_key], args=[ttl])
+        self._extended.set(sid, (rev_key, index_keys, now))
+        return True
 
     async def sid2uidgroups(self, sid):
         """
@@ -126,23 +991,47 @@ class SessionDBHandler:
         return session["uid"], session["groups"]
 
     async def update(self, sid, keyvalues):
-        sk = session_key(sid)
-        keyvalues = {k: pickle.dumps(v) for k, v in list(keyvalues.items())}
-        await self.rconn.hset(sk, mapping=keyvalues)
+        sid = self._unsign(sid)
+        if self.layout == "blob":
+            await self._write_many("set", [(sid, keyvalues)])
+            return
+        sk = self._session_key(sid)
+        mapping = {k: self._dumps(v) for k, v in list(keyvalues.items())}
+        pipe = self.rconn.pipeline(transaction=False)
+        pipe.hset(sk, mapping=mapping)
+        pipe.publish(INVALIDATION_CHANNEL, sid)
+        if self._signs(keyvalues):
+            self._revoke(pipe, [sid])
+        try:
+            await pipe.execute()
+        except RedisError as e:
+            if not is_wrong_type(e):
+                raise
+            await self._write_many("set", [(sid, keyvalues)])
+        self._evict(sid)
+        self._wrote(sk)
 
     async def update_for(self, uid, keyvalues):
         sid = await self.uid2sid(uid)
         return await self.update(sid, keyvalues) if sid else None
 
     async def update_attribute(self, sid, attribute, value):
-        key = session_key(sid)
-        await self.rconn.hset(key, attribute, pickle.dumps(value))
+        await self.update(sid, {attribute: value})
         return True
 
     async def resync(self, sid, keyvalues):
-        removed_keys = list((await self.get(sid)).keys() - keyvalues.keys())
-        await self.remove_from_session(sid, removed_keys)
-        await self.update(sid, keyvalues)
+        """
+        Replaces the session's fields with `keyvalues` in one atomic round trip,
+        so that no concurrent update can land between the removal and the write.
+        Signed tokens issued before are answered from Redis from then on
+        (within `revocation_poll_interval` in other processes): reissue them
+        to read the new fields without a round trip.
+
+        raises InvalidSessionError if the session is missing
+        """
+        sid = self._unsign(sid)
+        if not (await self._write_many("replace", [(sid, keyvalues)]))[0]:
+            raise InvalidSessionError()
 
     async def resync_for(self, uid, keyvalues, site_ctx=None):
         keyvalues["uid"] = uid
@@ -150,47 +1039,270 @@ class SessionDBHandler:
         sid = await self.uid2sid(uid, site_ctx)
         return await self.resync(sid, keyvalues) if sid else None
 
+    async def resync_many(self, uid_keyvalues, site_ctx=None, chunk_size=500):
+        """
+        `resync_for` for many uids: sids are looked up with MGET and the
+        sessions resynced in pipelines, `chunk_size` at a time
+
+        uid_keyvalues: {uid: keyvalues}
+        => number of sessions resynced (uids without a session are skipped)
+        """
+        uids = list(uid_keyvalues)
+        sids = await self.uid2sid_many(uids, site_ctx, chunk_size)
+        items = [
+            (sid, dict(uid_keyvalues[uid], uid=uid, site_ctx=site_ctx))
+            for uid, sid in zip(uids, sids)
+            if sid
+        ]
+        resynced = 0
+        for chunk in chunks(items, chunk_size):
+            resynced += sum(await self._write_many("replace", chunk))
+        return resynced
+
+    async def _write_many(self, mode, items):
+        """
+        Runs WRITE_SESSION_SCRIPT in `mode` for each (sid, keyvalues, or field
+        names for "del") in one round trip (one per session in cluster mode,
+        whose pipelines cannot run scripts)
+
+        => [written, ...] in the order of `items`, False for missing sessions
+        """
+        calls = []
+        for sid, keyvalues in items:
+            args = [mode]
+            if mode == "del":
+                args.extend(keyvalues)
+            else:
+                for k, v in keyvalues.items():
+                    args.extend((k, self._dumps(v)))
+            calls.append((self._session_key(sid), args))
+        pipe = self.rconn.pipeline(transaction=False)
+        if self.cluster:
+            written = [
+                await self._write_script(keys=[sk], args=args) for sk, args in calls
+            ]
+        else:
+            for sk, args in calls:
+                await self._write_script(keys=[sk], args=args, client=pipe)
+        for sid, _ in items:
+            pipe.publish(INVALIDATION_CHANNEL, sid)
+        self._revoke(
+            pipe,
+            [
+                sid
+                for sid, keyvalues in items
+                if self._signs(None if mode == "replace" else keyvalues)
+            ],
+        )
+        results = await pipe.execute()
+        if not self.cluster:
+            written = results[: len(items)]
+        for sid, _ in items:
+            self._evict(sid)
+        self._wrote(*(sk for sk, _ in calls))
+        return [bool(done) for done in written]
+
     async def remove_from_session(self, sid, keys):
-        sk = session_key(sid)
-        if keys:
-            await self.rconn.hdel(sk, *keys)
+        if not keys:
+            return True
+        sid = self._unsign(sid)
+        if self.layout == "blob":
+            await self._write_many("del", [(sid, keys)])
+            return True
+        sk = self._session_key(sid)
+        pipe = self.rconn.pipeline(transaction=False)
+        pipe.hdel(sk, *keys)
+        pipe.publish(INVALIDATION_CHANNEL, sid)
+        if self._signs(keys):
+            self._revoke(pipe, [sid])
+        try:
+            await pipe.execute()
+        except RedisError as e:
+            if not is_wrong_type(e):
+                raise
+            await self._write_many("del", [(sid, keys)])
+        self._evict(sid)
+        self._wrote(sk)
         return True
 
     async def destroy(self, sid, site_ctx=None):
+        sid = self._unsign(sid)
         uid = (await self.sid2uidgroups(sid))[0]
-        sk = session_key(sid)
-        await self.rconn.delete(sk)
-        await self.rconn.delete(rev_lookup_key(uid, site_ctx))
+        pipe = self.rconn.pipeline()
+        # Sids from before cluster mode are not on their uid's slot
+        pipe.delete(self._session_key(sid))
+        pipe.delete(self._rev_lookup_key(uid, site_ctx))
+        if uid and site_ctx:
+            pipe.srem(self._bound_site_ids_key(uid), site_ctx)
+            pipe.srem(self._bound_uids_key(site_ctx), uid)
+        self._revoke(pipe, [sid])
+        pipe.publish(INVALIDATION_CHANNEL, sid)
+        await pipe.execute()
+        self._evict(sid)
+        self._wrote(self._session_key(sid), self._rev_lookup_key(uid, site_ctx))
         return True
 
     async def destroy_for(self, uid, site_ctx=None):
         sid = await self.uid2sid(uid, site_ctx)
         return await self.destroy(sid, site_ctx) if sid else None
 
-    async def destroy_all(self):
-        keys = await self.rconn.keys(session_key("*"))
-        if keys:
-            await self.rconn.delete(*keys)
-        keys = await self.rconn.keys(rev_lookup_prefix + "*")
-        if keys:
-            await self.rconn.delete(*keys)
+    async def destroy_all(self, batch_size=1000, rate_limit=None, progress=None):
+        """
+        Deletes every session and reverse lookup in batches (SCAN + UNLINK), so
+        that Redis keeps serving other clients meanwhile
+
+        batch_size: keys deleted per UNLINK
+        rate_limit: max keys deleted per second (None: as fast as possible)
+        progress: called with the number of keys deleted so far after each batch
+
+        => number of keys deleted
+        """
+        deleted = 0
+
+        def report(count):
+            if progress is not None:
+                progress(deleted + count)
+
+        for pattern in (session_key("*"), rev_lookup_prefix + "*"):
+            deleted += await async_unlink_matching(
+                self.rconn, pattern, batch_size, rate_limit, report
+            )
+        if self.record_revocations:
+            self._revoked_before = time.time()
+            await self.rconn.set(
+                REVOKED_ALL_KEY, self._revoked_before, ex=self.signed_ttl
+            )
+        await self.rconn.publish(INVALIDATION_CHANNEL, "*")
+        self._evict("*")
+        return deleted
 
     async def destroy_all_for_bound_site(self, site_ctx):
-        keys = await self.rconn.keys(rev_lookup_key("*", site_ctx))
-        if keys:
-            sids = [session_key((await self.rconn.get(key)).decode()) for key in keys]
-            if sids:
-                await self.rconn.delete(*sids)
-            await self.rconn.delete(*keys)
+        uids = [
+            uid.decode()
+            for uid in await self.rconn.smembers(self._bound_uids_key(site_ctx))
+        ]
+        rev_keys = [self._rev_lookup_key(uid, site_ctx) for uid in uids]
+        sids = await self._mget(rev_keys) if rev_keys else []
+        pipe = self.rconn.pipeline()
+        for uid, rev_key, sid in zip(uids, rev_keys, sids):
+            pipe.delete(rev_key)
+            if sid:
+                pipe.delete(self._session_key(sid.decode()))
+                pipe.publish(INVALIDATION_CHANNEL, sid)
+            pipe.srem(self._bound_site_ids_key(uid), site_ctx)
+        pipe.delete(self._bound_uids_key(site_ctx))
+        self._revoke(pipe, [sid.decode() for sid in sids if sid])
+        await pipe.execute()
+        for sid in sids:
+            if sid:
+                self._evict(sid.decode())
 
     async def destroy_bound_sessions_for(self, uid):
-        keys = await self.rconn.keys(rev_lookup_key(uid, "*"))
-        if keys:
-            sids = [session_key((await self.rconn.get(key)).decode()) for key in keys]
-            if sids:
-                await self.rconn.delete(*sids)
-            await self.rconn.delete(*keys)
+        bound = await self._bound_lookup(uid)
+        pipe = self.rconn.pipeline()
+        for site_id, sid in bound:
+            pipe.delete(self._rev_lookup_key(uid, site_id))
+            if sid:
+                pipe.delete(self._session_key(sid))
+                pipe.publish(INVALIDATION_CHANNEL, sid)
+            pipe.srem(self._bound_uids_key(site_id), uid)
+        pipe.delete(self._bound_site_ids_key(uid))
+        self._revoke(pipe, [sid for _, sid in bound if sid])
+        await pipe.execute()
+        for _, sid in bound:
+            if sid:
+                self._evict(sid)
+
+    async def rebuild_bound_indexes(self):
+        """
+        One-off migration: indexes bound sessions created before the per-uid and
+        per-site index sets existed. Uses SCAN, so it is safe to run on a live db.
+        """
+        index_ttls = {}
+        pattern = rev_lookup_key("{*}" if self.cluster else "*", "*")
+        if self.cluster:
+            pattern += f"{_SEP}*"
+        async for key in self.rconn.scan_iter(pattern):
+            key = key.decode()
+            _, *tag, uid, site_ctx = key.split(_SEP)
+            if "_bound" in (uid, site_ctx) or bool(tag) != self.cluster:
+                continue
+            await self.rconn.sadd(self._bound_site_ids_key(uid), site_ctx)
+            await self.rconn.sadd(self._bound_uids_key(site_ctx), uid)
+            ttl = await self.rconn.ttl(key)
+            for index_key in (
+                self._bound_site_ids_key(uid),
+                self._bound_uids_key(site_ctx),
+            ):
+                index_ttls[index_key] = max(ttl, index_ttls.get(index_key, 0))
+        pipe = self.rconn.pipeline(transaction=False)
+        for index_key, ttl in index_ttls.items():
+            if ttl > 0:
+                pipe.expire(index_key, ttl)
+        await pipe.execute()
+
+    async def migrate_to_cluster_layout(
+        self, source_rconn_params=None, batch_size=1000
+    ):
+        """
+        Copies the sessions and reverse lookups of the regular key layout to the
+        cluster layout, TTLs included, then rebuilds the bound session indexes.
+        Sids stay valid. Run it from a cluster mode handler before moving traffic
+        over; sessions written to the old layout meanwhile are not copied.
+
+        source_rconn_params: redis holding the regular layout (default: this
+                             handler's own connection)
+
+        => number of keys copied
+        """
+        source = connect(source_rconn_params) if source_rconn_params else self.rconn
+        copied = 0
+        for pattern in (session_key("*"), rev_lookup_prefix + "*"):
+            async for batch in async_scan_batches(source, pattern, batch_size):
+                renames = [
+                    (key, to_cluster_key(key.decode()))
+                    for key in batch
+                    if to_cluster_key(key.decode())
+                ]
+                pipe = source.pipeline(transaction=False)
+                for key, _ in renames:
+                    pipe.dump(key)
+                    pipe.pttl(key)
+                results = await pipe.execute()
+                pipe = self.rconn.pipeline(transaction=False)
+                for (_, new_key), dumped, pttl in zip(
+                    renames, results[::2], results[1::2]
+                ):
+                    if dumped is not None:  # else expired meanwhile
+                        pipe.restore(new_key, max(pttl, 0), dumped, replace=True)
+                        copied += 1
+                await pipe.execute()
+        if source is not self.rconn:
+            await source.aclose()
+        await self.rebuild_bound_indexes()
+        return copied
+
+    def pool_stats(self):
+        """
+        => {"primary": stats, "replicas": [stats, ...]}, the stats of each
+        connection pool: connections in use and idle, connections handed out
+        and the seconds spent waiting for them (None for cluster and non-Redis
+        clients)
+        """
+        return {
+            "primary": pool_stats(self.rconn),
+            "replicas": [pool_stats(replica) for replica in self.replicas],
+        }
 
     async def close(self):
+        if self._invalidation_listener is not None:
+            self._invalidation_listener.cancel()
+            try:
+                await self._invalidation_listener
+            except (asyncio.CancelledError, RuntimeError):
+                pass
+            self._invalidation_listener = None
+        for replica in self.replicas:
+            await replica.aclose()
         await self.rconn.aclose()
         return True
@@ -428,6 +428,7 @@ class APIFactory:
         site_identifier=None,
         auth_header_name="Authorization",
         auth_cookie_name="__s",
+        sessiondb_options=None,
     ):
         self.access_wrapper = phony
         self.multi_site_enabled = False
@@ -438,6 +439,7 @@ class APIFactory:
 
         self.sessions = None
         self.sessiondb_conn = sessiondb_conn
+        self.sessiondb_options = sessiondb_options or {}
         if site_identifier:
             self.enable_multi_site(site_identifier)
         if sessiondb_conn:
@@ -544,8 +546,10 @@ class APIFactory:
         """
         redis_conn_params: dict() with below keys
                            (host, port, password, db)
+        Handler options (e.g. cache_size, signing_key) are taken from
+        `sessiondb_options`
         """
-        self.sessions = SessionDBHandler(sessiondb_conn)
+        self.sessions = SessionDBHandler(sessiondb_conn, **self.sessiondb_options)
         OptionalAuthByHeaderRouter.setup_sessions(self.sessions)
         OptionalAuthByCookieOrHeaderRouter.setup_sessions(self.sessions)
         AuthByHeaderRouter.setup_sessions(self.sessions)
@@ -245,7 +245,7 @@ def setup_context_setter(sessions):
 
 
 class APIFactory:
-    def __init__(self, router, urls_prefix=""):
+    def __init__(self, router, urls_prefix="", sessiondb_options=None):
         self.router = router
         self.db_tr_wrapper = phony
         self.access_wrapper = phony
@@ -254,6 +254,7 @@ class APIFactory:
         self.site_identifier = None
         self.urls_prefix = urls_prefix
         self.honeybadger_wrapper = phony
+        self.sessiondb_options = sessiondb_options or {}
 
     def enable_multi_site(self, site_identifier):
         self.multi_site_enabled = True
@@ -277,8 +278,10 @@ class APIFactory:
         """
         redis_conn_params: dict() with below keys
                            (host, port, password, db)
+        Handler options (e.g. signing_key, negative_cache_size) are taken from
+        `sessiondb_options`
         """
-        self.sessions = SessionDBHandler(sessiondb_conn)
+        self.sessions = SessionDBHandler(sessiondb_conn, **self.sessiondb_options)
         set_context = setup_context_setter(self.sessions)
         self.router = self.router.http(requires=set_context)
         set_context = setup_strict_context_setter(self.sessions)
@@ -0,0 +1,12 @@
+from itertools import islice
+
+
+def chunks(items, size):
+    """
+    Yields successive lists of at most `size` items
+    """
+    iterator = iter(items)
+    chunk = list(islice(iterator, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, size))
@@ -1,20 +1,71 @@
 from __future__ import annotations
 
-import json
-from typing import Any, ClassVar, List, Optional
+import asyncio
+import copy
+import functools
+import inspect
+import secrets
+import time
+from typing import Any, Callable, ClassVar, Iterable, List, Optional, Tuple
 
 from redis.asyncio import Redis
 
+from apphelpers.utilities import chunks
+from apphelpers.utilities.caching import (
+    RESUBSCRIBE_DELAY,
+    RESUBSCRIBE_DELAY_CAP,
+    CacheTiers,
+    _text,
+    as_dict,
+    build_codec,
+    logger,
+    recompute_early,
+)
+from apphelpers.utilities.keyscan import (
+    async_count_indexed,
+    async_scan_batches,
+    async_unlink_indexed,
+    async_unlink_matching,
+)
+from apphelpers.utilities.lrucache import LRUCache
+from apphelpers.utilities.redisscripts import UNLOCK_SCRIPT
+
+
+def _landed(flights: dict, key: str, task: asyncio.Task):
+    if flights.get(key) is task:
+        del flights[key]
+    if not task.cancelled():
+        task.exception()  # mark retrieved even if every waiter was cancelled
+
 
 class ReadOnlyAsyncCachedModel:
     """
     Read only async cached model
+
+    Same optional local cache as ReadOnlyCachedModel, whose invalidations are
+    received by a task of the running event loop
     """
 
     connection: ClassVar[Redis]
     ns: ClassVar[str]
     key_fields: ClassVar[List[str]]
     secondary_key_fields: ClassVar[List[str]]
+    local_cache_size: ClassVar[int] = 0
+    local_cache_ttl: ClassVar[Optional[float]] = 5
+    local_cache_max_bytes: ClassVar[Optional[int]] = None
+    _cache_tiers: ClassVar[CacheTiers]
+    # Keep the model's keys in a sorted set scored by the time they expire, so
+    # that `count_matched_keys` and `delete_all` read it instead of scanning
+    # the whole db. Keys written before opting in are added by `rebuild_index`.
+    indexed: ClassVar[bool] = False
+    # Encoding of the values: None (untagged stdlib JSON, as always), "json"
+    # (orjson when installed), "msgpack" or a serializer object (see
+    # apphelpers.utilities.serializers). Untagged JSON stays readable whatever
+    # the setting, so that a model can switch while old values are cached.
+    serializer: ClassVar[Any] = None
+    # Dataclass or pydantic model to decode values into (None: dicts)
+    value_type: ClassVar[Optional[type]] = None
+    _codec: ClassVar[Tuple[Callable[[Any], Any], Callable[[Any], Any]]]
 
     @classmethod
     def _prefix_key(cls, data: dict) -> str:
@@ -31,31 +82,211 @@ class ReadOnlyAsyncCachedModel:
         return key
 
     @classmethod
-    async def _get_matched_keys(cls, data: dict) -> List[str]:
+    def _matched_keys_pattern(cls, data: dict) -> str:
         pattern = cls.ns
         for _field in cls.key_fields:
             pattern += f':{data.get(_field, "*")}'
-        return await cls.connection.keys(pattern)
+        return pattern
 
     @classmethod
-    async def get(cls, **data: Any) -> Optional[dict]:
-        key = cls._prefix_key(data)
+    def _index_key(cls) -> str:
+        return f"{cls.ns}:_idx_"
+
+    @classmethod
+    def _index_pattern(cls, data: dict) -> Optional[str]:
+        """
+        => pattern of the indexed keys matching `data`, None if all of them do
+        """
+        if any(_field in data for _field in cls.key_fields):
+            return cls._matched_keys_pattern(data)
+        return None
+
+    @classmethod
+    async def _get_matched_keys(cls, data: dict) -> List[str]:
+        pattern = cls._matched_keys_pattern(data)
+        if cls.indexed:
+            now = time.time()
+            return [
+                member
+                async for member, expires_at in cls.connection.zscan_iter(
+                    cls._index_key(), match=pattern
+                )
+                if expires_at > now
+            ]
+        # SCAN may return a key more than once
+        return list({key async for key in cls.connection.scan_iter(pattern)})
+
+    @classmethod
+    def _dumps(cls, value: dict) -> Any:
+        codec = cls.__dict__.get("_codec")
+        if codec is None:
+            codec = cls._codec = build_codec(cls.serializer)
+        return codec[0](value)
+
+    @classmethod
+    def _loads(cls, raw: Any) -> dict:
+        codec = cls.__dict__.get("_codec")
+        if codec is None:
+            codec = cls._codec = build_codec(cls.serializer)
+        return codec[1](raw)
+
+    @classmethod
+    def _typed(cls, value: Optional[dict]) -> Any:
+        value_type = cls.value_type
+        if value_type is None or value is None:
+            return value
+        # pydantic 2, pydantic 1
+        validate = getattr(value_type, "model_validate", None) or getattr(
+            value_type, "parse_obj", None
+        )
+        return validate(value) if validate is not None else value_type(**value)
+
+    @classmethod
+    def _invalidation_channel(cls) -> str:
+        return f"{cls.ns}:_invalidations_"
+
+    @classmethod
+    def _tiers(cls) -> CacheTiers:
+        tiers = cls.__dict__.get("_cache_tiers")
+        if tiers is None:
+            local = (
+                LRUCache(
+                    cls.local_cache_size,
+                    cls.local_cache_ttl,
+                    cls.local_cache_max_bytes,
+                )
+                if cls.local_cache_size
+                else None
+            )
+            tiers = cls._cache_tiers = CacheTiers(local)
+        return tiers
+
+    @classmethod
+    def _can_cache_locally(cls, tiers: CacheTiers) -> bool:
+        """
+        Local caching is only safe while invalidations are being received, so
+        this also (re)starts the listener for the running event loop when needed
+        """
+        if tiers.local is None:
+            return False
+        listener = tiers.listener
+        if (
+            listener is None
+            or listener.done()
+            or listener.get_loop() is not asyncio.get_running_loop()
+        ):
+            tiers.subscribed = False
+            tiers.listener = asyncio.ensure_future(cls._listen_for_invalidations(tiers))
+        return tiers.subscribed
+
+    @classmethod
+    async def _listen_for_invalidations(cls, tiers: CacheTiers):
+        delay = RESUBSCRIBE_DELAY
+        while True:
+            pubsub = cls.connection.pubsub(ignore_subscribe_messages=True)
+            try:
+                await pubsub.subscribe(cls._invalidation_channel())
+                tiers.subscribed = True
+                delay = RESUBSCRIBE_DELAY
+                async for message in pubsub.listen():
+                    tiers.evict(_text(message["data"]))
+            except Exception:
+                logger.exception(
+                    "%s cache invalidations lost, resubscribing in %.1fs",
+                    cls.ns,
+                    delay,
+                )
+            finally:
+                # Invalidations may be missed until we are subscribed again:
+                # the local tier is neither read nor filled meanwhile
+                tiers.subscribed = False
+                tiers.evict("*")
+                await pubsub.aclose()
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RESUBSCRIBE_DELAY_CAP)
+
+    @classmethod
+    async def _get_key(cls, key: str) -> Optional[dict]:
+        tiers = cls._tiers()
+        cached = tiers.cached(key)
+        if cached is not None:
+            return cached
+        generation = tiers.generation
         value: Any = await cls.connection.get(key)
-        return json.loads(value) if value else None
+        tiers.count((value,))
+        if not value:
+            return None
+        decoded = cls._loads(value)
+        if cls._can_cache_locally(tiers):
+            tiers.store(key, decoded, len(value), generation)
+        return decoded
+
+    @classmethod
+    async def get(cls, **data: Any) -> Optional[dict]:
+        return cls._typed(await cls._get_key(cls._prefix_key(data)))
+
+    @classmethod
+    async def get_many(
+        cls, keys_data: Iterable[dict], chunk_size: int = 500
+    ) -> List[Optional[dict]]:
+        """
+        => [value or None, ...] for each dict of key fields in `keys_data`, in
+        order, fetched with one MGET per `chunk_size` keys
+        """
+        keys = [cls._prefix_key(data) for data in keys_data]
+        tiers = cls._tiers()
+        results: List[Optional[dict]] = [None] * len(keys)
+        missed = []
+        for i, key in enumerate(keys):
+            cached = tiers.cached(key)
+            if cached is None:
+                missed.append(i)
+            else:
+                results[i] = cached
+        generation = tiers.generation
+        values: List[Any] = []
+        for chunk in chunks([keys[i] for i in missed], chunk_size):
+            values.extend(await cls.connection.mget(chunk))
+        tiers.count(values)
+        can_cache = bool(missed) and cls._can_cache_locally(tiers)
+        for i, value in zip(missed, values):
+            if value:
+                results[i] = cls._loads(value)
+                if can_cache:
+                    tiers.store(keys[i], results[i], len(value), generation)
+        if cls.value_type is not None:
+            return [cls._typed(result) for result in results]
+        return results
 
     @classmethod
     async def get_by_secondary_key(cls, **data: Any) -> Optional[dict]:
         secondary_key = cls._secondary_prefix_key(data)
         primary_key = await cls.connection.get(secondary_key)
         if primary_key:
-            value = await cls.connection.get(primary_key)
-            return json.loads(value) if value else None
+            return cls._typed(await cls._get_key(_text(primary_key)))
 
     @classmethod
     async def exists(cls, **data: Any) -> bool:
         key = cls._prefix_key(data)
         return await cls.connection.exists(key)  # type: ignore
 
+    @classmethod
+    async def exists_many(
+        cls, keys_data: Iterable[dict], chunk_size: int = 500
+    ) -> List[bool]:
+        """
+        => [bool, ...] for each dict of key fields in `keys_data`, in order,
+        checked with one pipelined round trip per `chunk_size` keys
+        """
+        keys = [cls._prefix_key(data) for data in keys_data]
+        found: List[bool] = []
+        for chunk in chunks(keys, chunk_size):
+            pipe = cls.connection.pipeline(transaction=False)
+            for key in chunk:
+                pipe.exists(key)
+            found.extend(bool(count) for count in await pipe.execute())
+        return found
+
     @classmethod
     async def get_count(cls, **data: Any) -> int:
         key: Any = cls._prefix_key(data)
@@ -64,9 +295,25 @@ class ReadOnlyAsyncCachedModel:
 
     @classmethod
     async def count_matched_keys(cls, **data: Any) -> int:
+        """
+        Indexed models count with ZCOUNT when no key field is given, else by
+        scanning their index; the others SCAN the db
+        """
+        if cls.indexed:
+            return await async_count_indexed(
+                cls.connection, cls._index_key(), cls._index_pattern(data)
+            )
         keys = await cls._get_matched_keys(data)
         return len(keys)
 
+    @classmethod
+    def cache_stats(cls) -> dict:
+        """
+        => {"local": LRUCache stats or None, "redis": {"hits", "misses",
+        "hit_ratio"}}, Redis counting only the lookups the local cache missed
+        """
+        return cls._tiers().stats()
+
 
 class ReadWriteAsyncCachedModel(ReadOnlyAsyncCachedModel):
     """
@@ -74,15 +321,237 @@ class ReadWriteAsyncCachedModel(ReadOnlyAsyncCachedModel):
     """
 
     timeout: ClassVar[Optional[int]] = None
+    # Pace of `delete_all` and `delete_all_secondary_keys`
+    delete_batch_size: ClassVar[int] = 1000
+    delete_rate_limit: ClassVar[Optional[float]] = None
+    # get_or_set: see ReadWriteCachedModel
+    lock_timeout: ClassVar[float] = 10
+    lock_wait: ClassVar[float] = 5
+    lock_poll_interval: ClassVar[float] = 0.05
+    early_recompute_beta: ClassVar[float] = 0
+    stale_ttl: ClassVar[int] = 0
+    _unlock_script: ClassVar[Any]
+
+    @classmethod
+    async def _invalidate(cls, key: str):
+        """
+        Drops `key` ("*": all keys) from the local cache of every process,
+        published whatever this model's own `local_cache_size`: readers of the
+        namespace may cache locally
+        """
+        if cls.local_cache_size:
+            cls._tiers().evict(key)
+        await cls.connection.publish(cls._invalidation_channel(), key)
+
+    @classmethod
+    async def _set(cls, key: str, value: Any, timeout: Optional[int] = None):
+        """
+        Sets `key` to `value` for `timeout` seconds (default: the model's), and
+        indexes it if the model is `indexed` (in the same round trip)
+        """
+        timeout = timeout or cls.timeout
+        if not cls.indexed:
+            await cls.connection.set(key, value)
+            if timeout:
+                await cls.connection.expire(key, timeout)
+            return
+        index_key = cls._index_key()
+        pipe = cls.connection.pipeline()
+        pipe.set(key, value)
+        expires_at = float("inf")
+        if timeout:
+            pipe.expire(key, timeout)
+            now = time.time()
+            expires_at = now + timeout
+            # Drop the keys expired since
+            pipe.zremrangebyscore(index_key, "-inf", now)
+        pipe.zadd(index_key, {key: expires_at})
+        await pipe.execute()
 
     @classmethod
     async def create(cls, **data: Any) -> str:
         key = cls._prefix_key(data)
-        await cls.connection.set(key, json.dumps(data))
-        if cls.timeout:
-            await cls.connection.expire(key, cls.timeout)
+        await cls._set(key, cls._dumps(data), cls._value_timeout())
+        await cls._invalidate(key)
         return key
 
+    @classmethod
+    async def get_or_set(cls, loader: Callable[[], Any], **data: Any) -> Optional[dict]:
+        """
+        Same as ReadWriteCachedModel.get_or_set. `loader` may be a coroutine
+        function. Concurrent misses of the event loop share one load.
+        """
+        return cls._typed(await cls._get_or_set(loader, data))
+
+    @classmethod
+    async def _get_or_set(cls, loader: Callable[[], Any], data: dict) -> Optional[dict]:
+        key = cls._prefix_key(data)
+        tiers = cls._tiers()
+        cached = tiers.cached(key)
+        if cached is not None:
+            return cached
+        generation = tiers.generation
+        raw, due = await cls._lookup(key)
+        if raw is None:
+            return await cls._load_missing(key, loader)
+        value = cls._loads(raw)
+        if due:
+            return await cls._reload(key, loader, value)
+        if cls._can_cache_locally(tiers):
+            tiers.store(key, value, len(raw), generation)
+        return value
+
+    @classmethod
+    def _value_timeout(cls) -> Optional[int]:
+        """
+        => seconds values live: `stale_ttl` past `timeout`, so that
+        `get_or_set` can tell how long before they are stale
+        """
+        return cls.timeout + cls.stale_ttl if cls.timeout else None
+
+    @classmethod
+    def _lock_key(cls, key: str) -> str:
+        return f"_lock_:{key}"
+
+    @classmethod
+    def _load_seconds_key(cls, key: str) -> str:
+        """
+        => key of the seconds `get_or_set` last took to load `key`
+        """
+        return f"_load_seconds_:{key}"
+
+    @classmethod
+    async def _lookup(cls, key: str) -> Tuple[Any, bool]:
+        """
+        => (raw value or None, whether it is due for reloading: missing,
+        stale, or picked for early recomputation)
+        """
+        pipe = cls.connection.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.pttl(key)
+        if cls.early_recompute_beta:
+            pipe.get(cls._load_seconds_key(key))
+        raw, pttl, *load_seconds = await pipe.execute()
+        cls._tiers().count((raw,))
+        if not raw:
+            return None, True
+        return raw, cls._due(pttl, load_seconds)
+
+    @classmethod
+    def _due(cls, pttl: int, load_seconds: list) -> bool:
+        if not cls.timeout or pttl < 0:
+            return False
+        # Values live `stale_ttl` seconds past `timeout` (see `_value_timeout`)
+        seconds_left = pttl / 1000 - cls.stale_ttl
+        if seconds_left <= 0:
+            return True
+        return bool(load_seconds and load_seconds[0]) and recompute_early(
+            seconds_left, float(load_seconds[0]), cls.early_recompute_beta
+        )
+
+    @classmethod
+    async def _lock(cls, key: str) -> Optional[str]:
+        """
+        => token to release the reload lock of `key` with, None if it is taken
+        """
+        token = secrets.token_hex(8)
+        locked = await cls.connection.set(
+            cls._lock_key(key), token, nx=True, px=int(cls.lock_timeout * 1000)
+        )
+        return token if locked else None
+
+    @classmethod
+    async def _unlock(cls, key: str, token: str):
+        unlock = cls.__dict__.get("_unlock_script")
+        if unlock is None:
+            unlock = cls._unlock_script = cls.connection.register_script(UNLOCK_SCRIPT)
+        await unlock(keys=[cls._lock_key(key)], args=[token])
+
+    @classmethod
+    async def _load(cls, key: str, loader: Callable[[], Any]) -> Optional[dict]:
+        tiers = cls._tiers()
+        started_at = time.perf_counter()
+        value = loader()
+        if inspect.isawaitable(value):
+            value = await value
+        load_seconds = time.perf_counter() - started_at
+        tiers.loads += 1
+        if value is not None:
+            value = as_dict(value)
+            timeout = cls._value_timeout()
+            await cls._set(key, cls._dumps(value), timeout)
+            if cls.early_recompute_beta and timeout:
+                await cls.connection.set(
+                    cls._load_seconds_key(key), load_seconds, ex=timeout
+                )
+            await cls._invalidate(key)
+        return value
+
+    @classmethod
+    async def _load_missing(cls, key: str, loader: Callable[[], Any]) -> Optional[dict]:
+        """
+        Concurrent misses of `key` in this event loop share one load, whose
+        result or error is handed to every waiter
+        """
+        tiers = cls._tiers()
+        loop = asyncio.get_running_loop()
+        task = tiers.flights.get(key)
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(cls._load_locked(key, loader))
+            tiers.flights[key] = task
+            task.add_done_callback(functools.partial(_landed, tiers.flights, key))
+        else:
+            tiers.coalesced += 1
+        # shield: a cancelled waiter must not cancel the load for the others
+        value = await asyncio.shield(task)
+        return copy.deepcopy(value)
+
+    @classmethod
+    async def _load_locked(cls, key: str, loader: Callable[[], Any]) -> Optional[dict]:
+        tiers = cls._tiers()
+        started_at = time.monotonic()
+        token = await cls._lock(key)
+        if token is None:
+            while token is None:
+                if time.monotonic() - started_at >= cls.lock_wait:
+                    tiers.waited(time.monotonic() - started_at)
+                    tiers.lock_timeouts += 1
+                    return await cls._load(key, loader)
+                await asyncio.sleep(cls.lock_poll_interval)
+                raw = await cls.connection.get(key)
+                if raw:
+                    tiers.waited(time.monotonic() - started_at)
+                    return cls._loads(raw)
+                token = await cls._lock(key)
+            tiers.waited(time.monotonic() - started_at)
+        try:
+            # Loaded meanwhile by the process before us?
+            raw = await cls.connection.get(key)
+            if raw:
+                return cls._loads(raw)
+            return await cls._load(key, loader)
+        finally:
+            await cls._unlock(key, token)
+
+    @classmethod
+    async def _reload(
+        cls, key: str, loader: Callable[[], Any], current: dict
+    ) -> Optional[dict]:
+        """
+        Reloads the `current` value of `key`, unless another caller holds its
+        lock: then => `current`
+        """
+        tiers = cls._tiers()
+        token = await cls._lock(key)
+        if token is None:
+            tiers.served_stale += 1
+            return current
+        try:
+            tiers.refreshes += 1
+            return await cls._load(key, loader)
+        finally:
+            await cls._unlock(key, token)
+
     @classmethod
     async def add_secondary_key(cls, primary_key: str, **data: Any) -> str:
         secondary_key = cls._secondary_prefix_key(data)
@@ -92,17 +561,15 @@ class ReadWriteAsyncCachedModel(ReadOnlyAsyncCachedModel):
     @classmethod
     async def create_lookup(cls, **data: Any) -> str:
         key = cls._prefix_key(data)
-        await cls.connection.set(key, 1)
-        if cls.timeout:
-            await cls.connection.expire(key, cls.timeout)
+        await cls._set(key, 1)
+        await cls._invalidate(key)
         return key
 
     @classmethod
     async def create_counter(cls, starting=1, **data: Any) -> str:
         key = cls._prefix_key(data)
-        await cls.connection.set(key, starting)
-        if cls.timeout:
-            await cls.connection.expire(key, cls.timeout)
+        await cls._set(key, starting)
+        await cls._invalidate(key)
         return key
 
     @classmethod
@@ -116,16 +583,25 @@ class ReadWriteAsyncCachedModel(ReadOnlyAsyncCachedModel):
     async def increment(cls, amount=1, **data):
         key = cls._prefix_key(data)
         await cls.connection.incr(key, amount)
+        await cls._invalidate(key)
 
     @classmethod
     async def decrement(cls, amount=1, **data):
         key = cls._prefix_key(data)
         await cls.connection.decr(key, amount)
+        await cls._invalidate(key)
 
     @classmethod
     async def delete(cls, **data):
         key = cls._prefix_key(data)
-        await cls.connection.delete(key)
+        if cls.indexed:
+            pipe = cls.connection.pipeline()
+            pipe.delete(key)
+            pipe.zrem(cls._index_key(), key)
+            await pipe.execute()
+        else:
+            await cls.connection.delete(key)
+        await cls._invalidate(key)
 
     @classmethod
     async def delete_secondary_key(cls, **data: Any):
@@ -133,13 +609,78 @@ class ReadWriteAsyncCachedModel(ReadOnlyAsyncCachedModel):
         await cls.connection.delete(secondary_key)
 
     @classmethod
-    async def delete_all(cls, **data):
-        keys = await cls._get_matched_keys(data)
-        if keys:
-            await cls.connection.delete(*keys)
+    async def delete_all(
+        cls, progress: Optional[Callable[[int], Any]] = None, **data
+    ) -> int:
+        """
+        Deletes the matching keys in batches of `delete_batch_size` (SCAN +
+        UNLINK, or a scan of the index if the model is `indexed`), at most
+        `delete_rate_limit` keys per second
+
+        progress: called with the number of keys deleted so far after each batch
+        => number of keys deleted
+        """
+        if cls.indexed:
+            deleted = await async_unlink_indexed(
+                cls.connection,
+                cls._index_key(),
+                cls._index_pattern(data),
+                cls.delete_batch_size,
+                cls.delete_rate_limit,
+                progress,
+            )
+        else:
+            deleted = await async_unlink_matching(
+                cls.connection,
+                cls._matched_keys_pattern(data),
+                cls.delete_batch_size,
+                cls.delete_rate_limit,
+                progress,
+            )
+        await cls._invalidate("*")
+        return deleted
+
+    @classmethod
+    async def delete_all_secondary_keys(
+        cls, progress: Optional[Callable[[int], Any]] = None
+    ) -> int:
+        """
+        Same as `delete_all` for secondary keys
+        progress: called with the number of keys deleted so far after each batch
+        """
+        return await async_unlink_matching(
+            cls.connection,
+            cls._secondary_prefix_key(data={}),
+            cls.delete_batch_size,
+            cls.delete_rate_limit,
+            progress,
+        )
 
     @classmethod
-    async def delete_all_secondary_keys(cls):
-        secondary_keys = await cls.connection.keys(cls._secondary_prefix_key(data={}))
-        if secondary_keys:
-            await cls.connection.delete(*secondary_keys)
+    async def rebuild_index(cls) -> int:
+        """
+        Adds the model's existing keys, found with SCAN, to its index with their
+        expiry, e.g. after opting into `indexed`
+
+        => number of keys indexed
+        """
+        index_key = cls._index_key()
+        skipped = (index_key, f"{cls.ns}:_sk_:")
+        indexed = 0
+        async for batch in async_scan_batches(
+            cls.connection, cls._matched_keys_pattern({}), cls.delete_batch_size
+        ):
+            batch = [key for key in batch if not _text(key).startswith(skipped)]
+            pipe = cls.connection.pipeline(transaction=False)
+            for key in batch:
+                pipe.pttl(key)
+            now = time.time()
+            mapping = {
+                key: now + pttl / 1000 if pttl >= 0 else float("inf")
+                for key, pttl in zip(batch, await pipe.execute())
+                if pttl != -2
+            }
+            if mapping:
+                await cls.connection.zadd(index_key, mapping)
+                indexed += len(mapping)
+        return indexed
@@ -1,20 +1,242 @@
 from __future__ import annotations
 
+import copy
+import dataclasses
 import json
-from typing import Any, ClassVar, List, Optional
+import logging
+import math
+import random
+import secrets
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, ClassVar, Iterable, List, Optional, Tuple
 
 from redis import Redis
 
+from apphelpers.utilities import chunks
+from apphelpers.utilities.keyscan import (
+    count_indexed,
+    scan_batches,
+    unlink_indexed,
+    unlink_matching,
+)
+from apphelpers.utilities.lrucache import LRUCache
+from apphelpers.utilities.redisscripts import UNLOCK_SCRIPT
+from apphelpers.utilities.serializers import (
+    build_loads,
+    compressors,
+    get_serializer,
+    serializers,
+)
+
+# Seconds to wait before subscribing again to a lost invalidation channel,
+# doubled after each failed attempt up to the cap
+RESUBSCRIBE_DELAY = 1
+RESUBSCRIBE_DELAY_CAP = 30
+
+logger = logging.getLogger("apphelpers.caching")
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+class CacheTiers:
+    """
+    Per model class state of its two cache tiers: the optional in-process LRU
+    cache (`local`) in front of Redis, the hits and misses of both, and the
+    recomputations of `get_or_set`
+    """
+
+    def __init__(self, local: Optional[LRUCache]):
+        self.local = local
+        self.redis_hits = 0
+        self.redis_misses = 0
+        # get_or_set: loader calls, those refreshing a value still cached
+        # (stale or recomputed early), callers served the current value while
+        # another one refreshes it, callers waiting on another process' lock
+        # (and for how long, and how many gave up waiting) and on a load of
+        # this process
+        self.loads = 0
+        self.refreshes = 0
+        self.served_stale = 0
+        self.lock_waits = 0
+        self.lock_wait_seconds = 0.0
+        self.lock_timeouts = 0
+        self.coalesced = 0
+        # key => future of the load in progress in this process (see
+        # `flight`, tasks for the async models)
+        self.flights: dict = {}
+        # Bumped by every invalidation, so that values fetched before one are
+        # not cached
+        self.generation = 0
+        self.subscribed = False
+        self.listener: Any = None
+        self.lock = threading.Lock()
+
+    def count(self, values: Iterable[Any]):
+        for value in values:
+            if value:
+                self.redis_hits += 1
+            else:
+                self.redis_misses += 1
+
+    def store(self, key: str, value: Any, size: int, generation: int):
+        if generation == self.generation:
+            self.local.set(key, copy.deepcopy(value), size=size)  # type: ignore
+
+    def cached(self, key: str) -> Any:
+        """
+        => a deep copy of the value of `key` in the local tier (callers may
+        change it as they like), or None. Nothing is served from it while
+        unsubscribed from invalidations: such lookups count as misses.
+        """
+        if self.local is None:
+            return None
+        if not self.subscribed:
+            self.local.misses += 1
+            return None
+        cached = self.local.get(key)
+        return copy.deepcopy(cached) if cached is not None else None
+
+    def evict(self, key: str):
+        self.generation += 1
+        if self.local is not None:
+            if key == "*":
+                self.local.clear()
+            else:
+                self.local.pop(key)
+
+    def flight(self, key: str, load: Callable[[], Any]) -> Any:
+        """
+        => load()'s result (or error), handed as well to the threads of the
+        process asking for `key` meanwhile: they wait for it instead of
+        repeating the load. Each gets its own deep copy.
+        """
+        with self.lock:
+            future = self.flights.get(key)
+            leading = future is None
+            if leading:
+                future = self.flights[key] = Future()
+            else:
+                self.coalesced += 1
+        if leading:
+            try:
+                future.set_result(load())
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    del self.flights[key]
+        value = future.result()
+        return copy.deepcopy(value)
+
+    def waited(self, seconds: float):
+        self.lock_waits += 1
+        self.lock_wait_seconds += seconds
+
+    def stats(self) -> dict:
+        lookups = self.redis_hits + self.redis_misses
+        return {
+            "local": self.local.stats() if self.local is not None else None,
+            "redis": {
+                "hits": self.redis_hits,
+                "misses": self.redis_misses,
+                "hit_ratio": self.redis_hits / lookups if lookups else 0.0,
+            },
+            "recompute": {
+                "loads": self.loads,
+                "refreshes": self.refreshes,
+                "served_stale": self.served_stale,
+                "lock_waits": self.lock_waits,
+                "lock_wait_seconds": self.lock_wait_seconds,
+                "lock_timeouts": self.lock_timeouts,
+                "coalesced": self.coalesced,
+            },
+        }
+
+
+def build_codec(
+    serializer: Any,
+) -> Tuple[Callable[[Any], Any], Callable[[Any], Any]]:
+    """
+    => (dumps, loads) of a cached model's values for its `serializer` setting.
+    loads reads values tagged by any serializer but pickle (see
+    apphelpers.utilities.serializers) and untagged JSON.
+    """
+    dumps = json.dumps if serializer is None else get_serializer(serializer).dumps
+    tagged_loads = build_loads(get_serializer(serializer or "json"), allow_pickle=False)
+    tags = {
+        serializer_class.tag
+        for name, serializer_class in {**serializers, **compressors}.items()
+        if name != "pickle"
+    }
+
+    def loads(raw: Any) -> Any:
+        if isinstance(raw, bytes) and raw[:1] in tags:
+            return tagged_loads(raw)
+        return json.loads(raw)
+
+    return dumps, loads
+
+
+def as_dict(value: Any) -> dict:
+    """
+    => `value` as a dict: dataclass and pydantic model instances are dumped,
+    the latter to JSON types (datetimes, UUIDs, decimals... as strings) that
+    every codec can encode and validation turns back into their own
+    """
+    if isinstance(value, dict):
+        return value
+    if dataclasses.is_dataclass(value):
+        return dataclasses.asdict(value)  # type: ignore[arg-type]
+    # pydantic 2, pydantic 1
+    dump = getattr(value, "model_dump", None)
+    return dump(mode="json") if dump is not None else json.loads(value.json())
+
+
+def recompute_early(seconds_left: float, load_seconds: float, beta: float) -> bool:
+    """
+    Probabilistic early recomputation ("XFetch"): true more and more often as
+    the value nears expiry, the sooner the longer it takes to load, so that
+    usually a single caller reloads it before it expires
+    """
+    return -load_seconds * beta * math.log(1.0 - random.random()) >= seconds_left
+
 
 class ReadOnlyCachedModel:
     """
     Read only cached model
+
+    With `local_cache_size` set, decoded values read by `get`, `get_many` and
+    `get_by_secondary_key` are also kept in-process (LRU, `local_cache_ttl`
+    seconds, optionally at most `local_cache_max_bytes` of JSON). Writes through
+    ReadWriteCachedModel publish the key to the model's invalidation channel,
+    which every process caching locally listens to. Values are only cached
+    locally while subscribed to it.
     """
 
     connection: ClassVar[Redis]
     ns: ClassVar[str]
     key_fields: ClassVar[List[str]]
     secondary_key_fields: ClassVar[List[str]]
+    local_cache_size: ClassVar[int] = 0
+    local_cache_ttl: ClassVar[Optional[float]] = 5
+    local_cache_max_bytes: ClassVar[Optional[int]] = None
+    _cache_tiers: ClassVar[CacheTiers]
+    # Keep the model's keys in a sorted set scored by the time they expire, so
+    # that `count_matched_keys` and `delete_all` read it instead of scanning
+    # the whole db. Keys written before opting in are added by `rebuild_index`.
+    indexed: ClassVar[bool] = False
+    # Encoding of the values: None (untagged stdlib JSON, as always), "json"
+    # (orjson when installed), "msgpack" or a serializer object (see
+    # apphelpers.utilities.serializers). Untagged JSON stays readable whatever
+    # the setting, so that a model can switch while old values are cached.
+    serializer: ClassVar[Any] = None
+    # Dataclass or pydantic model to decode values into (None: dicts)
+    value_type: ClassVar[Optional[type]] = None
+    _codec: ClassVar[Tuple[Callable[[Any], Any], Callable[[Any], Any]]]
 
     @classmethod
     def _prefix_key(cls, data: dict) -> str:
@@ -31,31 +253,214 @@ class ReadOnlyCachedModel:
         return key
 
     @classmethod
-    def _get_matched_keys(cls, data: dict) -> List[str]:
+    def _matched_keys_pattern(cls, data: dict) -> str:
         pattern = cls.ns
         for _field in cls.key_fields:
             pattern += f':{data.get(_field, "*")}'
-        return cls.connection.keys(pattern)  # type: ignore
+        return pattern
 
     @classmethod
-    def get(cls, **data: Any) -> Optional[dict]:
-        key = cls._prefix_key(data)
+    def _index_key(cls) -> str:
+        return f"{cls.ns}:_idx_"
+
+    @classmethod
+    def _index_pattern(cls, data: dict) -> Optional[str]:
+        """
+        => pattern of the indexed keys matching `data`, None if all of them do
+        """
+        if any(_field in data for _field in cls.key_fields):
+            return cls._matched_keys_pattern(data)
+        return None
+
+    @classmethod
+    def _get_matched_keys(cls, data: dict) -> List[str]:
+        pattern = cls._matched_keys_pattern(data)
+        if cls.indexed:
+            now = time.time()
+            return [
+                member
+                for member, expires_at in cls.connection.zscan_iter(
+                    cls._index_key(), match=pattern
+                )
+                if expires_at > now
+            ]
+        # SCAN may return a key more than once
+        return list(set(cls.connection.scan_iter(pattern)))
+
+    @classmethod
+    def _dumps(cls, value: dict) -> Any:
+        codec = cls.__dict__.get("_codec")
+        if codec is None:
+            codec = cls._codec = build_codec(cls.serializer)
+        return codec[0](value)
+
+    @classmethod
+    def _loads(cls, raw: Any) -> dict:
+        codec = cls.__dict__.get("_codec")
+        if codec is None:
+            codec = cls._codec = build_codec(cls.serializer)
+        return codec[1](raw)
+
+    @classmethod
+    def _typed(cls, value: Optional[dict]) -> Any:
+        value_type = cls.value_type
+        if value_type is None or value is None:
+            return value
+        # pydantic 2, pydantic 1
+        validate = getattr(value_type, "model_validate", None) or getattr(
+            value_type, "parse_obj", None
+        )
+        return validate(value) if validate is not None else value_type(**value)
+
+    @classmethod
+    def _invalidation_channel(cls) -> str:
+        return f"{cls.ns}:_invalidations_"
+
+    @classmethod
+    def _tiers(cls) -> CacheTiers:
+        tiers = cls.__dict__.get("_cache_tiers")
+        if tiers is None:
+            local = (
+                LRUCache(
+                    cls.local_cache_size,
+                    cls.local_cache_ttl,
+                    cls.local_cache_max_bytes,
+                )
+                if cls.local_cache_size
+                else None
+            )
+            tiers = cls._cache_tiers = CacheTiers(local)
+        return tiers
+
+    @classmethod
+    def _can_cache_locally(cls, tiers: CacheTiers) -> bool:
+        """
+        Local caching is only safe while invalidations are being received, so
+        this also (re)starts the listener thread when needed
+        """
+        if tiers.local is None:
+            return False
+        listener = tiers.listener
+        if listener is None or not listener.is_alive():
+            with tiers.lock:
+                if tiers.listener is listener:
+                    tiers.listener = threading.Thread(
+                        target=cls._listen_for_invalidations,
+                        args=(tiers,),
+                        name=f"{cls.ns} cache invalidations",
+                        daemon=True,
+                    )
+                    tiers.listener.start()
+        return tiers.subscribed
+
+    @classmethod
+    def _listen_for_invalidations(cls, tiers: CacheTiers):
+        delay = RESUBSCRIBE_DELAY
+        while True:
+            pubsub = cls.connection.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(cls._invalidation_channel())
+                tiers.subscribed = True
+                delay = RESUBSCRIBE_DELAY
+                for message in pubsub.listen():
+                    tiers.evict(_text(message["data"]))
+            except Exception:
+                logger.exception(
+                    "%s cache invalidations lost, resubscribing in %.1fs",
+                    cls.ns,
+                    delay,
+                )
+            finally:
+                # Invalidations may be missed until we are subscribed again:
+                # the local tier is neither read nor filled meanwhile
+                tiers.subscribed = False
+                tiers.evict("*")
+                pubsub.close()
+            time.sleep(delay)
+            delay = min(delay * 2, RESUBSCRIBE_DELAY_CAP)
+
+    @classmethod
+    def _get_key(cls, key: str) -> Optional[dict]:
+        tiers = cls._tiers()
+        cached = tiers.cached(key)
+        if cached is not None:
+            return cached
+        generation = tiers.generation
         value: Any = cls.connection.get(key)
-        return json.loads(value) if value else None
+        tiers.count((value,))
+        if not value:
+            return None
+        decoded = cls._loads(value)
+        if cls._can_cache_locally(tiers):
+            tiers.store(key, decoded, len(value), generation)
+        return decoded
+
+    @classmethod
+    def get(cls, **data: Any) -> Optional[dict]:
+        return cls._typed(cls._get_key(cls._prefix_key(data)))
+
+    @classmethod
+    def get_many(
+        cls, keys_data: Iterable[dict], chunk_size: int = 500
+    ) -> List[Optional[dict]]:
+        """
+        => [value or None, ...] for each dict of key fields in `keys_data`, in
+        order, fetched with one MGET per `chunk_size` keys
+        """
+        keys = [cls._prefix_key(data) for data in keys_data]
+        tiers = cls._tiers()
+        results: List[Optional[dict]] = [None] * len(keys)
+        missed = []
+        for i, key in enumerate(keys):
+            cached = tiers.cached(key)
+            if cached is None:
+                missed.append(i)
+            else:
+                results[i] = cached
+        generation = tiers.generation
+        values: List[Any] = []
+        for chunk in chunks([keys[i] for i in missed], chunk_size):
+            values.extend(cls.connection.mget(chunk))
+        tiers.count(values)
+        can_cache = bool(missed) and cls._can_cache_locally(tiers)
+        for i, value in zip(missed, values):
+            if value:
+                results[i] = cls._loads(value)
+                if can_cache:
+                    tiers.store(keys[i], results[i], len(value), generation)
+        if cls.value_type is not None:
+            return [cls._typed(result) for result in results]
+        return results
 
     @classmethod
     def get_by_secondary_key(cls, **data: Any) -> Optional[dict]:
         secondary_key = cls._secondary_prefix_key(data)
         primary_key = cls.connection.get(secondary_key)
         if primary_key:
-            value = cls.connection.get(primary_key)
-            return json.loads(value) if value else None
+            return cls._typed(cls._get_key(_text(primary_key)))
 
     @classmethod
     def exists(cls, **data: Any) -> bool:
         key = cls._prefix_key(data)
         return cls.connection.exists(key)  # type: ignore
 
+    @classmethod
+    def exists_many(
+        cls, keys_data: Iterable[dict], chunk_size: int = 500
+    ) -> List[bool]:
+        """
+        => [bool, ...] for each dict of key fields in `keys_data`, in order,
+        checked with one pipelined round trip per `chunk_size` keys
+        """
+        keys = [cls._prefix_key(data) for data in keys_data]
+        found: List[bool] = []
+        for chunk in chunks(keys, chunk_size):
+            pipe = cls.connection.pipeline(transaction=False)
+            for key in chunk:
+                pipe.exists(key)
+            found.extend(bool(count) for count in pipe.execute())
+        return found
+
     @classmethod
     def get_count(cls, **data: Any) -> int:
         key: Any = cls._prefix_key(data)
@@ -64,9 +469,25 @@ class ReadOnlyCachedModel:
 
     @classmethod
     def count_matched_keys(cls, **data: Any) -> int:
+        """
+        Indexed models count with ZCOUNT when no key field is given, else by
+        scanning their index; the others SCAN the db
+        """
+        if cls.indexed:
+            return count_indexed(
+                cls.connection, cls._index_key(), cls._index_pattern(data)
+            )
         keys = cls._get_matched_keys(data)
         return len(keys)
 
+    @classmethod
+    def cache_stats(cls) -> dict:
+        """
+        => {"local": LRUCache stats or None, "redis": {"hits", "misses",
+        "hit_ratio"}}, Redis counting only the lookups the local cache missed
+        """
+        return cls._tiers().stats()
+
 
 class ReadWriteCachedModel(ReadOnlyCachedModel):
     """
@@ -74,15 +495,240 @@ class ReadWriteCachedModel(ReadOnlyCachedModel):
     """
 
     timeout: ClassVar[Optional[int]] = None
+    # Pace of `delete_all` and `delete_all_secondary_keys`
+    delete_batch_size: ClassVar[int] = 1000
+    delete_rate_limit: ClassVar[Optional[float]] = None
+    # get_or_set: seconds a reload lock is held at most, seconds to wait for
+    # another process' reload before loading anyway (looking for its result
+    # every `lock_poll_interval` seconds), XFetch early recomputation (0: off,
+    # 1: the usual setting, more: earlier) and seconds an expired value is
+    # still served while one caller reloads it (all values, those of `create`
+    # too, are kept that much longer than `timeout`)
+    lock_timeout: ClassVar[float] = 10
+    lock_wait: ClassVar[float] = 5
+    lock_poll_interval: ClassVar[float] = 0.05
+    early_recompute_beta: ClassVar[float] = 0
+    stale_ttl: ClassVar[int] = 0
+    _unlock_script: ClassVar[Any]
+
+    @classmethod
+    def _invalidate(cls, key: str):
+        """
+        Drops `key` ("*": all keys) from the local cache of every process,
+        published whatever this model's own `local_cache_size`: readers of the
+        namespace may cache locally
+        """
+        if cls.local_cache_size:
+            cls._tiers().evict(key)
+        cls.connection.publish(cls._invalidation_channel(), key)
+
+    @classmethod
+    def _set(cls, key: str, value: Any, timeout: Optional[int] = None):
+        """
+        Sets `key` to `value` for `timeout` seconds (default: the model's), and
+        indexes it if the model is `indexed` (in the same round trip)
+        """
+        timeout = timeout or cls.timeout
+        if not cls.indexed:
+            cls.connection.set(key, value)
+            if timeout:
+                cls.connection.expire(key, timeout)
+            return
+        index_key = cls._index_key()
+        pipe = cls.connection.pipeline()
+        pipe.set(key, value)
+        expires_at = float("inf")
+        if timeout:
+            pipe.expire(key, timeout)
+            now = time.time()
+            expires_at = now + timeout
+            # Drop the keys expired since
+            pipe.zremrangebyscore(index_key, "-inf", now)
+        pipe.zadd(index_key, {key: expires_at})
+        pipe.execute()
 
     @classmethod
     def create(cls, **data: Any) -> str:
         key = cls._prefix_key(data)
-        cls.connection.set(key, json.dumps(data))
-        if cls.timeout:
-            cls.connection.expire(key, cls.timeout)
+        cls._set(key, cls._dumps(data), cls._value_timeout())
+        cls._invalidate(key)
         return key
 
+    @classmethod
+    def get_or_set(
+        cls, loader: Callable[[], Optional[dict]], **data: Any
+    ) -> Optional[dict]:
+        """
+        Cache-aside read => the value cached for the key fields in `data`, else
+        loader()'s result, cached for `timeout` seconds (a None result is
+        returned but not cached)
+
+        A miss is loaded once: the process' other threads wait for that load,
+        other processes for the result of the one holding its Redis lock (up to
+        `lock_wait` seconds, then they load it themselves). With
+        `early_recompute_beta` a caller may reload a value shortly before it
+        expires, and with `stale_ttl` an expired value is served for that many
+        more seconds while a caller reloads it: meanwhile the others get the
+        cached value. Counts are in `cache_stats()["recompute"]`.
+        """
+        return cls._typed(cls._get_or_set(loader, data))
+
+    @classmethod
+    def _get_or_set(
+        cls, loader: Callable[[], Optional[dict]], data: dict
+    ) -> Optional[dict]:
+        key = cls._prefix_key(data)
+        tiers = cls._tiers()
+        cached = tiers.cached(key)
+        if cached is not None:
+            return cached
+        generation = tiers.generation
+        raw, due = cls._lookup(key)
+        if raw is None:
+            return cls._load_missing(key, loader)
+        value = cls._loads(raw)
+        if due:
+            return cls._reload(key, loader, value)
+        if cls._can_cache_locally(tiers):
+            tiers.store(key, value, len(raw), generation)
+        return value
+
+    @classmethod
+    def _value_timeout(cls) -> Optional[int]:
+        """
+        => seconds values live: `stale_ttl` past `timeout`, so that
+        `get_or_set` can tell how long before they are stale
+        """
+        return cls.timeout + cls.stale_ttl if cls.timeout else None
+
+    @classmethod
+    def _lock_key(cls, key: str) -> str:
+        return f"_lock_:{key}"
+
+    @classmethod
+    def _load_seconds_key(cls, key: str) -> str:
+        """
+        => key of the seconds `get_or_set` last took to load `key`
+        """
+        return f"_load_seconds_:{key}"
+
+    @classmethod
+    def _lookup(cls, key: str) -> Tuple[Any, bool]:
+        """
+        => (raw value or None, whether it is due for reloading: missing,
+        stale, or picked for early recomputation)
+        """
+        pipe = cls.connection.pipeline(transaction=False)
+        pipe.get(key)
+        pipe.pttl(key)
+        if cls.early_recompute_beta:
+            pipe.get(cls._load_seconds_key(key))
+        raw, pttl, *load_seconds = pipe.execute()
+        cls._tiers().count((raw,))
+        if not raw:
+            return None, True
+        return raw, cls._due(pttl, load_seconds)
+
+    @classmethod
+    def _due(cls, pttl: int, load_seconds: list) -> bool:
+        if not cls.timeout or pttl < 0:
+            return False
+        # Values live `stale_ttl` seconds past `timeout` (see `_value_timeout`)
+        seconds_left = pttl / 1000 - cls.stale_ttl
+        if seconds_left <= 0:
+            return True
+        return bool(load_seconds and load_seconds[0]) and recompute_early(
+            seconds_left, float(load_seconds[0]), cls.early_recompute_beta
+        )
+
+    @classmethod
+    def _lock(cls, key: str) -> Optional[str]:
+        """
+        => token to release the reload lock of `key` with, None if it is taken
+        """
+        token = secrets.token_hex(8)
+        locked = cls.connection.set(
+            cls._lock_key(key), token, nx=True, px=int(cls.lock_timeout * 1000)
+        )
+        return token if locked else None
+
+    @classmethod
+    def _unlock(cls, key: str, token: str):
+        unlock = cls.__dict__.get("_unlock_script")
+        if unlock is None:
+            unlock = cls._unlock_script = cls.connection.register_script(UNLOCK_SCRIPT)
+        unlock(keys=[cls._lock_key(key)], args=[token])
+
+    @classmethod
+    def _load(cls, key: str, loader: Callable[[], Optional[dict]]) -> Optional[dict]:
+        tiers = cls._tiers()
+        started_at = time.perf_counter()
+        value = loader()
+        load_seconds = time.perf_counter() - started_at
+        tiers.loads += 1
+        if value is not None:
+            value = as_dict(value)
+            timeout = cls._value_timeout()
+            cls._set(key, cls._dumps(value), timeout)
+            if cls.early_recompute_beta and timeout:
+                cls.connection.set(cls._load_seconds_key(key), load_seconds, ex=timeout)
+            cls._invalidate(key)
+        return value
+
+    @classmethod
+    def _load_missing(
+        cls, key: str, loader: Callable[[], Optional[dict]]
+    ) -> Optional[dict]:
+        return cls._tiers().flight(key, lambda: cls._load_locked(key, loader))
+
+    @classmethod
+    def _load_locked(
+        cls, key: str, loader: Callable[[], Optional[dict]]
+    ) -> Optional[dict]:
+        tiers = cls._tiers()
+        started_at = time.monotonic()
+        token = cls._lock(key)
+        if token is None:
+            while token is None:
+                if time.monotonic() - started_at >= cls.lock_wait:
+                    tiers.waited(time.monotonic() - started_at)
+                    tiers.lock_timeouts += 1
+                    return cls._load(key, loader)
+                time.sleep(cls.lock_poll_interval)
+                raw = cls.connection.get(key)
+                if raw:
+                    tiers.waited(time.monotonic() - started_at)
+                    return cls._loads(raw)
+                token = cls._lock(key)
+            tiers.waited(time.monotonic() - started_at)
+        try:
+            # Loaded meanwhile by the process before us?
+            raw = cls.connection.get(key)
+            if raw:
+                return cls._loads(raw)
+            return cls._load(key, loader)
+        finally:
+            cls._unlock(key, token)
+
+    @classmethod
+    def _reload(
+        cls, key: str, loader: Callable[[], Optional[dict]], current: dict
+    ) -> Optional[dict]:
+        """
+        Reloads the `current` value of `key`, unless another caller holds its
+        lock: then => `current`
+        """
+        tiers = cls._tiers()
+        token = cls._lock(key)
+        if token is None:
+            tiers.served_stale += 1
+            return current
+        try:
+            tiers.refreshes += 1
+            return cls._load(key, loader)
+        finally:
+            cls._unlock(key, token)
+
     @classmethod
     def add_secondary_key(cls, primary_key: str, **data: Any) -> str:
         secondary_key = cls._secondary_prefix_key(data)
@@ -92,17 +738,15 @@ class ReadWriteCachedModel(ReadOnlyCachedModel):
     @classmethod
     def create_lookup(cls, **data: Any) -> str:
         key = cls._prefix_key(data)
-        cls.connection.set(key, 1)
-        if cls.timeout:
-            cls.connection.expire(key, cls.timeout)
+        cls._set(key, 1)
+        cls._invalidate(key)
         return key
 
     @classmethod
     def create_counter(cls, starting=1, **data: Any) -> str:
         key = cls._prefix_key(data)
-        cls.connection.set(key, starting)
-        if cls.timeout:
-            cls.connection.expire(key, cls.timeout)
+        cls._set(key, starting)
+        cls._invalidate(key)
         return key
 
     @classmethod
@@ -116,16 +760,25 @@ class ReadWriteCachedModel(ReadOnlyCachedModel):
     def increment(cls, amount=1, **data):
         key = cls._prefix_key(data)
         cls.connection.incr(key, amount)
+        cls._invalidate(key)
 
     @classmethod
     def decrement(cls, amount=1, **data):
         key = cls._prefix_key(data)
         cls.connection.decr(key, amount)
+        cls._invalidate(key)
 
     @classmethod
     def delete(cls, **data):
         key = cls._prefix_key(data)
-        cls.connection.delete(key)
+        if cls.indexed:
+            pipe = cls.connection.pipeline()
+            pipe.delete(key)
+            pipe.zrem(cls._index_key(), key)
+            pipe.execute()
+        else:
+            cls.connection.delete(key)
+        cls._invalidate(key)
 
     @classmethod
     def delete_secondary_key(cls, **data: Any):
@@ -133,13 +786,76 @@ class ReadWriteCachedModel(ReadOnlyCachedModel):
         cls.connection.delete(secondary_key)
 
     @classmethod
-    def delete_all(cls, **data):
-        keys = cls._get_matched_keys(data)
-        if keys:
-            cls.connection.delete(*keys)
+    def delete_all(cls, progress: Optional[Callable[[int], Any]] = None, **data) -> int:
+        """
+        Deletes the matching keys in batches of `delete_batch_size` (SCAN +
+        UNLINK, or a scan of the index if the model is `indexed`), at most
+        `delete_rate_limit` keys per second
+
+        progress: called with the number of keys deleted so far after each batch
+        => number of keys deleted
+        """
+        if cls.indexed:
+            deleted = unlink_indexed(
+                cls.connection,
+                cls._index_key(),
+                cls._index_pattern(data),
+                cls.delete_batch_size,
+                cls.delete_rate_limit,
+                progress,
+            )
+        else:
+            deleted = unlink_matching(
+                cls.connection,
+                cls._matched_keys_pattern(data),
+                cls.delete_batch_size,
+                cls.delete_rate_limit,
+                progress,
+            )
+        cls._invalidate("*")
+        return deleted
 
     @classmethod
-    def delete_all_secondary_keys(cls):
-        secondary_keys = cls.connection.keys(cls._secondary_prefix_key(data={}))
-        if secondary_keys:
-            cls.connection.delete(*secondary_keys)
+    def delete_all_secondary_keys(
+        cls, progress: Optional[Callable[[int], Any]] = None
+    ) -> int:
+        """
+        Same as `delete_all` for secondary keys
+        progress: called with the number of keys deleted so far after each batch
+        """
+        return unlink_matching(
+            cls.connection,
+            cls._secondary_prefix_key(data={}),
+            cls.delete_batch_size,
+            cls.delete_rate_limit,
+            progress,
+        )
+
+    @classmethod
+    def rebuild_index(cls) -> int:
+        """
+        Adds the model's existing keys, found with SCAN, to its index with their
+        expiry, e.g. after opting into `indexed`
+
+        => number of keys indexed
+        """
+        index_key = cls._index_key()
+        skipped = (index_key, f"{cls.ns}:_sk_:")
+        indexed = 0
+        for batch in scan_batches(
+            cls.connection, cls._matched_keys_pattern({}), cls.delete_batch_size
+        ):
+            batch = [key for key in batch if not _text(key).startswith(skipped)]
+            pipe = cls.connection.pipeline(transaction=False)
+            for key in batch:
+                pipe.pttl(key)
+            now = time.time()
+            mapping = {
+                key: now + pttl / 1000 if pttl >= 0 else float("inf")
+                for key, pttl in zip(batch, pipe.execute())
+                if pttl != -2
+            }
+            if mapping:
+                cls.connection.zadd(index_key, mapping)
+                indexed += len(mapping)
+        return indexed
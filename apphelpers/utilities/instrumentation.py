@@ -0,0 +1,177 @@
+from __future__ import annotations
+
+import bisect
+import functools
+import inspect
+import logging
+import threading
+import time
+from contextvars import ContextVar
+from typing import Any, Callable, Iterable, Optional
+
+# Upper bounds, in seconds, of the latency histogram buckets (the last bucket,
+# "+Inf", takes the rest)
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+)
+
+# hook(method name, seconds, exception raised or None)
+CallHook = Callable[[str, float, Optional[BaseException]], Any]
+
+# Instance whose instrumented method is running in this context (thread or
+# task), so that the calls it makes to its other instrumented methods are not
+# recorded a second time
+_calling: ContextVar[Any] = ContextVar("instrumented_call", default=None)
+
+
+class CallMetrics:
+    """
+    Count, latency histogram and errors of each instrumented method.
+
+    buckets: upper bounds in seconds of the latency histogram buckets
+    """
+
+    def __init__(self, buckets: Iterable[float] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        # method -> [count, seconds, max seconds, bucket counts, errors by type]
+        self._methods: dict[str, list] = {}
+        self._lock = threading.Lock()
+
+    def record(self, method: str, seconds: float, error: Optional[BaseException]):
+        with self._lock:
+            entry = self._methods.get(method)
+            if entry is None:
+                entry = self._methods[method] = [
+                    0,
+                    0.0,
+                    0.0,
+                    [0] * (len(self.buckets) + 1),
+                    {},
+                ]
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+            entry[3][bisect.bisect_left(self.buckets, seconds)] += 1
+            if error is not None:
+                errors = entry[4]
+                name = type(error).__name__
+                errors[name] = errors.get(name, 0) + 1
+
+    def stats(self) -> dict[str, dict[str, Any]]:
+        """
+        => {method: {"count", "errors" (by exception type), "seconds" (total),
+        "max_seconds", "buckets" (cumulative counts by upper bound, as in
+        Prometheus histograms)}}
+        """
+        bounds = [str(bound) for bound in self.buckets] + ["+Inf"]
+        stats = {}
+        with self._lock:
+            for method, (count, seconds, max_seconds, counts, errors) in sorted(
+                self._methods.items()
+            ):
+                cumulative = 0
+                buckets = {}
+                for bound, bucket_count in zip(bounds, counts):
+                    cumulative += bucket_count
+                    buckets[bound] = cumulative
+                stats[method] = {
+                    "count": count,
+                    "errors": dict(errors),
+                    "seconds": seconds,
+                    "max_seconds": max_seconds,
+                    "buckets": buckets,
+                }
+        return stats
+
+    def reset(self):
+        with self._lock:
+            self._methods.clear()
+
+
+class SlowCallLog:
+    """
+    Logs a warning for each call taking at least `threshold` seconds. Only the
+    method name is logged: arguments (sids, session fields) stay out of logs.
+    """
+
+    def __init__(self, threshold: float, logger: Optional[logging.Logger] = None):
+        self.threshold = threshold
+        self.logger = logger or logging.getLogger("apphelpers.sessions")
+
+    def __call__(self, method: str, seconds: float, error: Optional[BaseException]):
+        if seconds >= self.threshold:
+            self.logger.warning(
+                "slow call: %s took %.3fs%s",
+                method,
+                seconds,
+                f" and raised {type(error).__name__}" if error is not None else "",
+            )
+
+
+def instrument(obj, methods: Iterable[str], hooks: list[CallHook]):
+    """
+    Wraps the `methods` of the instance `obj` so that every call ends with
+    hook(method, seconds, error) for each of `hooks`. Only the outermost call
+    is recorded: those an instrumented method makes to others of `obj` count
+    as part of it. The class is left alone: instances that are not
+    instrumented pay nothing.
+    """
+    for name in methods:
+        method = getattr(obj, name)
+        wrap = _wrap_async if inspect.iscoroutinefunction(method) else _wrap
+        setattr(obj, name, wrap(obj, name, method, hooks))
+
+
+def _wrap(obj, name, method, hooks):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if _calling.get() is obj:
+            return method(*args, **kwargs)
+        token = _calling.set(obj)
+        error = None
+        started_at = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            seconds = time.perf_counter() - started_at
+            _calling.reset(token)
+            for hook in hooks:
+                hook(name, seconds, error)
+
+    return wrapper
+
+
+def _wrap_async(obj, name, method, hooks):
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        if _calling.get() is obj:
+            return await method(*args, **kwargs)
+        token = _calling.set(obj)
+        error = None
+        started_at = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        except BaseException as e:
+            error = e
+            raise
+        finally:
+            seconds = time.perf_counter() - started_at
+            _calling.reset(token)
+            for hook in hooks:
+                hook(name, seconds, error)
+
+    return wrapper
@@ -0,0 +1,219 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Callable, Optional
+
+from apphelpers.utilities import chunks
+
+
+def scan_batches(connection, pattern: str, batch_size: int = 1000):
+    """
+    Yields lists of at most `batch_size` keys matching `pattern`, found with SCAN
+    """
+    yield from chunks(connection.scan_iter(pattern, count=batch_size), batch_size)
+
+
+async def async_scan_batches(connection, pattern: str, batch_size: int = 1000):
+    """
+    Same as `scan_batches` for redis.asyncio connections
+    """
+    batch = []
+    async for key in connection.scan_iter(pattern, count=batch_size):
+        batch.append(key)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def index_batches(
+    connection, index_key: str, pattern: Optional[str] = None, batch_size: int = 1000
+):
+    """
+    Yields lists of at most `batch_size` members of the sorted set `index_key`
+    matching `pattern` (None: all of them), found with ZSCAN
+    """
+    members = (
+        member
+        for member, _ in connection.zscan_iter(
+            index_key, match=pattern, count=batch_size
+        )
+    )
+    yield from chunks(members, batch_size)
+
+
+async def async_index_batches(
+    connection, index_key: str, pattern: Optional[str] = None, batch_size: int = 1000
+):
+    """
+    Same as `index_batches` for redis.asyncio connections
+    """
+    batch = []
+    async for member, _ in connection.zscan_iter(
+        index_key, match=pattern, count=batch_size
+    ):
+        batch.append(member)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def count_indexed(
+    connection, index_key: str, pattern: Optional[str] = None, batch_size: int = 1000
+) -> int:
+    """
+    => number of live keys in the index `index_key`, a sorted set of keys scored
+    by the time they expire, matching `pattern`. ZCOUNT when all keys match
+    (None), else a ZSCAN of the index.
+    """
+    now = time.time()
+    if pattern is None:
+        return connection.zcount(index_key, now, "+inf")
+    return sum(
+        1
+        for _, expires_at in connection.zscan_iter(
+            index_key, match=pattern, count=batch_size
+        )
+        if expires_at > now
+    )
+
+
+async def async_count_indexed(
+    connection, index_key: str, pattern: Optional[str] = None, batch_size: int = 1000
+) -> int:
+    """
+    Same as `count_indexed` for redis.asyncio connections
+    """
+    now = time.time()
+    if pattern is None:
+        return await connection.zcount(index_key, now, "+inf")
+    count = 0
+    async for _, expires_at in connection.zscan_iter(
+        index_key, match=pattern, count=batch_size
+    ):
+        if expires_at > now:
+            count += 1
+    return count
+
+
+def _pause(deleted: int, started_at: float, rate_limit: Optional[float]) -> float:
+    """
+    => seconds to wait so that deleting `deleted` keys took at least
+    `deleted / rate_limit` seconds since `started_at`
+    """
+    if not rate_limit:
+        return 0.0
+    return deleted / rate_limit - (time.monotonic() - started_at)
+
+
+def unlink_matching(
+    connection,
+    pattern: str,
+    batch_size: int = 1000,
+    rate_limit: Optional[float] = None,
+    progress: Optional[Callable[[int], Any]] = None,
+) -> int:
+    """
+    Deletes the keys matching `pattern` without blocking Redis: keys are found
+    with SCAN and freed in the background with UNLINK, `batch_size` at a time.
+    Keys created while it runs may survive.
+
+    rate_limit: max keys deleted per second (None: as fast as possible)
+    progress: called with the number of keys deleted so far after each batch
+
+    => number of keys deleted
+    """
+    deleted = 0
+    started_at = time.monotonic()
+    for batch in scan_batches(connection, pattern, batch_size):
+        deleted += connection.unlink(*batch)
+        if progress is not None:
+            progress(deleted)
+        pause = _pause(deleted, started_at, rate_limit)
+        if pause > 0:
+            time.sleep(pause)
+    return deleted
+
+
+async def async_unlink_matching(
+    connection,
+    pattern: str,
+    batch_size: int = 1000,
+    rate_limit: Optional[float] = None,
+    progress: Optional[Callable[[int], Any]] = None,
+) -> int:
+    """
+    Same as `unlink_matching` for redis.asyncio connections
+    """
+    deleted = 0
+    started_at = time.monotonic()
+    async for batch in async_scan_batches(connection, pattern, batch_size):
+        deleted += await connection.unlink(*batch)
+        if progress is not None:
+            progress(deleted)
+        pause = _pause(deleted, started_at, rate_limit)
+        if pause > 0:
+            await asyncio.sleep(pause)
+    return deleted
+
+
+def unlink_indexed(
+    connection,
+    index_key: str,
+    pattern: Optional[str] = None,
+    batch_size: int = 1000,
+    rate_limit: Optional[float] = None,
+    progress: Optional[Callable[[int], Any]] = None,
+) -> int:
+    """
+    Same as `unlink_matching` for the keys in the index `index_key` (see
+    `count_indexed`) matching `pattern`, which are removed from the index too.
+    Only the index is scanned, not the whole db.
+
+    => number of keys deleted
+    """
+    connection.zremrangebyscore(index_key, "-inf", time.time())
+    deleted = 0
+    started_at = time.monotonic()
+    for batch in index_batches(connection, index_key, pattern, batch_size):
+        pipe = connection.pipeline()
+        pipe.unlink(*batch)
+        pipe.zrem(index_key, *batch)
+        deleted += pipe.execute()[0]
+        if progress is not None:
+            progress(deleted)
+        pause = _pause(deleted, started_at, rate_limit)
+        if pause > 0:
+            time.sleep(pause)
+    return deleted
+
+
+async def async_unlink_indexed(
+    connection,
+    index_key: str,
+    pattern: Optional[str] = None,
+    batch_size: int = 1000,
+    rate_limit: Optional[float] = None,
+    progress: Optional[Callable[[int], Any]] = None,
+) -> int:
+    """
+    Same as `unlink_indexed` for redis.asyncio connections
+    """
+    await connection.zremrangebyscore(index_key, "-inf", time.time())
+    deleted = 0
+    started_at = time.monotonic()
+    async for batch in async_index_batches(connection, index_key, pattern, batch_size):
+        pipe = connection.pipeline()
+        pipe.unlink(*batch)
+        pipe.zrem(index_key, *batch)
+        deleted += (await pipe.execute())[0]
+        if progress is not None:
+            progress(deleted)
+        pause = _pause(deleted, started_at, rate_limit)
+        if pause > 0:
+            await asyncio.sleep(pause)
+    return deleted
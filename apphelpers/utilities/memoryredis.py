@@ -0,0 +1,659 @@
+"""
+In-process stand-in for the subset of Redis the session handlers and cached
+models use, so that tests and benchmarks can run without a Redis server.
+
+    SessionDBHandler(dict(backend="memory"))
+
+Clients built with the same host, port and db share their data, like clients of
+one Redis server would. Keys expire as in Redis. Commands run atomically, so a
+pipeline behaves like MULTI/EXEC and a script like EVAL. Only the scripts of
+apphelpers.utilities.redisscripts are supported, through their Python versions
+in `scripts`.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import fnmatch
+import functools
+import math
+import pickle
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+
+from redis.exceptions import ResponseError
+
+from apphelpers.utilities.redisscripts import (
+    CREATE_SESSION_SCRIPT,
+    EXTEND_INDEX_SCRIPT,
+    INDEX_SCRIPT,
+    UNLOCK_SCRIPT,
+    WRITE_SESSION_SCRIPT,
+)
+
+COMMANDS = frozenset(
+    (
+        "decr",
+        "delete",
+        "dump",
+        "exists",
+        "expire",
+        "get",
+        "hdel",
+        "hget",
+        "hgetall",
+        "hmget",
+        "hset",
+        "incr",
+        "keys",
+        "mget",
+        "pttl",
+        "publish",
+        "restore",
+        "sadd",
+        "set",
+        "smembers",
+        "srem",
+        "ttl",
+        "type",
+        "unlink",
+        "zadd",
+        "zcount",
+        "zrangebyscore",
+        "zrem",
+        "zremrangebyscore",
+        "zscan",
+    )
+)
+
+
+def _encode(value: Any) -> bytes:
+    """
+    Same conversion redis-py applies to keys and values
+    """
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, float):
+        return repr(value).encode()
+    return str(value).encode()
+
+
+class SortedSet(dict):
+    """
+    member => score
+    """
+
+
+# Value types => what TYPE answers for them
+TYPES = {bytes: b"string", dict: b"hash", set: b"set", SortedSet: b"zset"}
+
+
+def _wrong_type() -> ResponseError:
+    return ResponseError(
+        "WRONGTYPE Operation against a key holding the wrong kind of value"
+    )
+
+
+class MemoryStore:
+    """
+    Data of one in-memory "server" db
+    """
+
+    def __init__(self):
+        self.data: Dict[bytes, Any] = {}
+        self.expires: Dict[bytes, float] = {}
+        self.subscribers: Dict[bytes, set] = {}
+        self.lock = threading.RLock()
+
+    def execute(self, command: str, *args, **kwargs) -> Any:
+        with self.lock:
+            return getattr(self, command)(*args, **kwargs)
+
+    def execute_many(self, commands, raise_on_error=True) -> list:
+        """
+        Like a pipeline: runs every command, then raises the first error
+        """
+        results = []
+        with self.lock:
+            for name, args, kwargs in commands:
+                try:
+                    results.append(getattr(self, name)(*args, **kwargs))
+                except ResponseError as e:
+                    results.append(e)
+        if raise_on_error:
+            for result in results:
+                if isinstance(result, ResponseError):
+                    raise result
+        return results
+
+    def _live(self, key: bytes) -> bool:
+        expires_at = self.expires.get(key)
+        if expires_at is not None and expires_at <= time.monotonic():
+            self.data.pop(key, None)
+            del self.expires[key]
+        return key in self.data
+
+    def _lookup(self, key: Any, default: Any = None, kind: Optional[type] = None):
+        """
+        raises WRONGTYPE if the value is not of type `kind`
+        """
+        key = _encode(key)
+        if not self._live(key):
+            return default
+        value = self.data[key]
+        if kind is not None and type(value) is not kind:
+            raise _wrong_type()
+        return value
+
+    def _container(self, key: Any, factory: Callable) -> Any:
+        key = _encode(key)
+        if not self._live(key):
+            self.data[key] = factory()
+        elif type(self.data[key]) is not factory:
+            raise _wrong_type()
+        return self.data[key]
+
+    def _prune(self, key: Any):
+        key = _encode(key)
+        if key in self.data and not self.data[key]:
+            del self.data[key]
+            self.expires.pop(key, None)
+
+    # keys
+
+    def delete(self, *keys) -> int:
+        deleted = 0
+        for key in map(_encode, keys):
+            if self._live(key):
+                del self.data[key]
+                self.expires.pop(key, None)
+                deleted += 1
+        return deleted
+
+    unlink = delete
+
+    def exists(self, *keys) -> int:
+        return sum(self._live(_encode(key)) for key in keys)
+
+    def expire(self, key, seconds) -> bool:
+        key = _encode(key)
+        if not self._live(key):
+            return False
+        if int(seconds) <= 0:
+            return bool(self.delete(key))
+        self.expires[key] = time.monotonic() + int(seconds)
+        return True
+
+    def pttl(self, key) -> int:
+        key = _encode(key)
+        if not self._live(key):
+            return -2
+        if key not in self.expires:
+            return -1
+        return math.ceil((self.expires[key] - time.monotonic()) * 1000)
+
+    def ttl(self, key) -> int:
+        pttl = self.pttl(key)
+        return pttl if pttl < 0 else round(pttl / 1000)
+
+    def type(self, key) -> bytes:
+        value = self._lookup(key)
+        return b"none" if value is None else TYPES[type(value)]
+
+    def keys(self, pattern="*") -> list:
+        pattern = _encode(pattern).decode()
+        return [
+            key
+            for key in list(self.data)
+            if self._live(key) and fnmatch.fnmatchcase(key.decode(), pattern)
+        ]
+
+    def dump(self, key) -> Optional[bytes]:
+        value = self._lookup(key)
+        return None if value is None else pickle.dumps(value)
+
+    def restore(self, key, ttl, value, replace=False) -> bool:
+        key = _encode(key)
+        if self._live(key) and not replace:
+            raise ValueError("BUSYKEY Target key name already exists.")
+        self.data[key] = pickle.loads(value)
+        self.expires.pop(key, None)
+        if ttl:
+            self.expires[key] = time.monotonic() + ttl / 1000
+        return True
+
+    # strings
+
+    def get(self, key) -> Optional[bytes]:
+        return self._lookup(key, kind=bytes)
+
+    def mget(self, keys, *args) -> list:
+        values = [self._lookup(key) for key in [*keys, *args]]
+        return [value if type(value) is bytes else None for value in values]
+
+    def set(self, key, value, ex=None, px=None, nx=False, keepttl=False):
+        key = _encode(key)
+        if nx and self._live(key):
+            return None
+        self.data[key] = _encode(value)
+        if not keepttl:
+            self.expires.pop(key, None)
+        if ex is not None:
+            self.expire(key, ex)
+        if px is not None:
+            self.expires[key] = time.monotonic() + int(px) / 1000
+        return True
+
+    def incr(self, key, amount=1) -> int:
+        key = _encode(key)
+        value = int(self._lookup(key, 0, bytes)) + amount
+        self.data[key] = _encode(value)
+        return value
+
+    def decr(self, key, amount=1) -> int:
+        return self.incr(key, -amount)
+
+    # hashes
+
+    def hset(self, key, field=None, value=None, mapping=None) -> int:
+        items = dict(mapping or {})
+        if field is not None:
+            items[field] = value
+        hash_ = self._container(key, dict)
+        added = 0
+        for field, value in items.items():
+            field = _encode(field)
+            added += field not in hash_
+            hash_[field] = _encode(value)
+        return added
+
+    def hget(self, key, field) -> Optional[bytes]:
+        return self._lookup(key, {}, dict).get(_encode(field))
+
+    def hmget(self, key, keys, *args) -> list:
+        hash_ = self._lookup(key, {}, dict)
+        return [hash_.get(_encode(field)) for field in [*keys, *args]]
+
+    def hgetall(self, key) -> dict:
+        return dict(self._lookup(key, {}, dict))
+
+    def hdel(self, key, *fields) -> int:
+        hash_ = self._lookup(key, {}, dict)
+        deleted = sum(hash_.pop(_encode(field), None) is not None for field in fields)
+        self._prune(key)
+        return deleted
+
+    # sets
+
+    def sadd(self, key, *members) -> int:
+        set_ = self._container(key, set)
+        before = len(set_)
+        set_.update(map(_encode, members))
+        return len(set_) - before
+
+    def srem(self, key, *members) -> int:
+        set_ = self._lookup(key, set(), set)
+        before = len(set_)
+        set_.difference_update(map(_encode, members))
+        self._prune(key)
+        return before - len(set_)
+
+    def smembers(self, key) -> set:
+        return set(self._lookup(key, set(), set))
+
+    # sorted sets
+
+    def zadd(self, key, mapping) -> int:
+        zset = self._container(key, SortedSet)
+        added = sum(_encode(member) not in zset for member in mapping)
+        zset.update({_encode(k): float(v) for k, v in mapping.items()})
+        return added
+
+    def zrangebyscore(self, key, min, max, withscores=False) -> list:
+        low, high = float(_encode(min)), float(_encode(max))
+        zset = self._lookup(key, {}, SortedSet)
+        return [
+            (member, score) if withscores else member
+            for member, score in sorted(zset.items(), key=lambda item: item[1])
+            if low <= score <= high
+        ]
+
+    def zcount(self, key, min, max) -> int:
+        return len(self.zrangebyscore(key, min, max))
+
+    def zrem(self, key, *members) -> int:
+        zset = self._lookup(key, {}, SortedSet)
+        removed = 0
+        for member in map(_encode, members):
+            if member in zset:
+                del zset[member]
+                removed += 1
+        self._prune(key)
+        return removed
+
+    def zscan(self, key, match="*") -> list:
+        """
+        => [(member, score), ...] of the members matching `match`, all at once
+        """
+        pattern = _encode(match).decode()
+        zset = self._lookup(key, {}, SortedSet)
+        return [
+            (member, score)
+            for member, score in list(zset.items())
+            if fnmatch.fnmatchcase(member.decode(), pattern)
+        ]
+
+    def zremrangebyscore(self, key, min, max) -> int:
+        zset = self._lookup(key, {}, SortedSet)
+        members = self.zrangebyscore(key, min, max)
+        for member in members:
+            del zset[member]
+        self._prune(key)
+        return len(members)
+
+    # pub/sub
+
+    def publish(self, channel, message) -> int:
+        channel = _encode(channel)
+        subscribers = self.subscribers.get(channel, ())
+        for subscriber in list(subscribers):
+            subscriber.deliver(
+                {
+                    "type": "message",
+                    "pattern": None,
+                    "channel": channel,
+                    "data": _encode(message),
+                }
+            )
+        return len(subscribers)
+
+    def subscribe(self, subscriber, channels):
+        for channel in channels:
+            self.subscribers.setdefault(_encode(channel), set()).add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        for subscribers in self.subscribers.values():
+            subscribers.discard(subscriber)
+
+    # scripts
+
+    def evalscript(self, source, keys, args) -> Any:
+        return scripts[source](self, keys, [_encode(arg) for arg in args])
+
+
+def _create_session(store, keys, args):
+    sid, ttl, uid, site_ctx, *fields = args
+    if len(keys) > 1:
+        existing = store.get(keys[1])
+        if existing:
+            return existing
+    if len(fields) == 1:
+        store.set(keys[0], fields[0], ex=int(ttl))
+    else:
+        store.hset(keys[0], mapping=dict(zip(fields[::2], fields[1::2])))
+        store.expire(keys[0], ttl)
+    if len(keys) > 1:
+        store.set(keys[1], sid, ex=int(ttl))
+    if len(keys) > 2:
+        store.sadd(keys[2], site_ctx)
+        if len(keys) > 3:
+            store.sadd(keys[3], uid)
+        for key in keys[2:]:
+            if store.ttl(key) < int(ttl):
+                store.expire(key, ttl)
+    return sid
+
+
+def _add_to_index(store, keys, args):
+    member, ttl = args
+    store.sadd(keys[0], member)
+    if store.ttl(keys[0]) < int(ttl):
+        store.expire(keys[0], ttl)
+
+
+def _extend_index(store, keys, args):
+    (ttl,) = args
+    if store.ttl(keys[0]) < int(ttl):
+        return int(store.expire(keys[0], ttl))
+    return 0
+
+
+def _write_session(store, keys, args):
+    layout = store.type(keys[0])
+    if layout == b"none":
+        return 0
+    mode, *args = args
+    fields = dict(zip(args[::2], args[1::2])) if mode != b"del" else {}
+    if layout == b"hash":
+        if mode == b"del":
+            store.hdel(keys[0], *args)
+            return 1
+        if mode == b"replace":
+            removed = [field for field in store.hgetall(keys[0]) if field not in fields]
+            if removed:
+                store.hdel(keys[0], *removed)
+        if fields:
+            store.hset(keys[0], mapping=fields)
+        return 1
+    # As cmsgpack does: raw strings both ways
+    import msgpack
+
+    session = {}
+    if mode != b"replace":
+        session = msgpack.unpackb(store.get(keys[0]), raw=True) or {}
+    for field in args if mode == b"del" else ():
+        session.pop(field, None)
+    session.update(fields)
+    if session:
+        store.set(keys[0], msgpack.packb(session, use_bin_type=False), keepttl=True)
+    else:
+        store.delete(keys[0])
+    return 1
+
+
+# Lua source => equivalent taking (store, keys, encoded args)
+def _unlock(store, keys, args):
+    if store.get(keys[0]) != args[0]:
+        return 0
+    return store.delete(keys[0])
+
+
+scripts: Dict[str, Callable] = {
+    CREATE_SESSION_SCRIPT: _create_session,
+    INDEX_SCRIPT: _add_to_index,
+    EXTEND_INDEX_SCRIPT: _extend_index,
+    WRITE_SESSION_SCRIPT: _write_session,
+    UNLOCK_SCRIPT: _unlock,
+}
+
+_stores: Dict[Tuple[Hashable, ...], MemoryStore] = {}
+_stores_lock = threading.Lock()
+
+
+def get_store(host="localhost", port=6379, db=0) -> MemoryStore:
+    with _stores_lock:
+        return _stores.setdefault((host, port, db), MemoryStore())
+
+
+def flush_all():
+    """
+    Drops the data of every in-memory db
+    """
+    with _stores_lock:
+        _stores.clear()
+
+
+class MemoryPipeline:
+    def __init__(self, store: MemoryStore):
+        self.store = store
+        self.commands: list = []
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(name)
+
+        def queue_command(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+
+        return queue_command
+
+    def execute(self, raise_on_error=True) -> list:
+        commands, self.commands = self.commands, []
+        return self.store.execute_many(commands, raise_on_error)
+
+
+class MemoryPubSub:
+    def __init__(self, store: MemoryStore, ignore_subscribe_messages=False):
+        self.store = store
+        self.ignore_subscribe_messages = ignore_subscribe_messages
+        self.messages: queue.Queue = queue.Queue()
+
+    def deliver(self, message):
+        self.messages.put(message)
+
+    def subscribe(self, *channels):
+        self.store.execute("subscribe", self, channels)
+        if not self.ignore_subscribe_messages:
+            for channel in channels:
+                self.deliver({"type": "subscribe", "channel": channel, "data": 1})
+
+    def get_message(self, timeout=0.0):
+        try:
+            return (
+                self.messages.get(timeout=timeout)
+                if timeout
+                else self.messages.get_nowait()
+            )
+        except queue.Empty:
+            return None
+
+    def listen(self):
+        while True:
+            yield self.messages.get()
+
+    def close(self):
+        self.store.execute("unsubscribe", self)
+
+
+class MemoryScript:
+    def __init__(self, store: MemoryStore, source: str):
+        if source not in scripts:
+            raise NotImplementedError("script not supported by the memory backend")
+        self.store = store
+        self.source = source
+
+    def __call__(self, keys=(), args=(), client=None):
+        if isinstance(client, MemoryPipeline):
+            client.commands.append(("evalscript", (self.source, keys, args), {}))
+            return client
+        return self.store.execute("evalscript", self.source, keys, args)
+
+
+class MemoryRedis:
+    """
+    Drop-in for redis.Redis over a `MemoryStore`
+    """
+
+    def __init__(self, host="localhost", port=6379, db=0, **_):
+        self.store = get_store(host, port, db)
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(name)
+        return functools.partial(self.store.execute, name)
+
+    def pipeline(self, transaction=True) -> MemoryPipeline:
+        return MemoryPipeline(self.store)
+
+    def register_script(self, source: str) -> MemoryScript:
+        return MemoryScript(self.store, source)
+
+    def pubsub(self, ignore_subscribe_messages=False) -> MemoryPubSub:
+        return MemoryPubSub(self.store, ignore_subscribe_messages)
+
+    def scan_iter(self, match="*", count=None):
+        yield from self.store.execute("keys", match)
+
+    def zscan_iter(self, name, match=None, count=None):
+        yield from self.store.execute("zscan", name, match or "*")
+
+    def close(self):
+        pass
+
+
+class AsyncMemoryPipeline(MemoryPipeline):
+    async def execute(self, raise_on_error=True) -> list:  # type: ignore[override]
+        return super().execute(raise_on_error)
+
+
+class AsyncMemoryPubSub(MemoryPubSub):
+    def __init__(self, store: MemoryStore, ignore_subscribe_messages=False):
+        self.store = store
+        self.ignore_subscribe_messages = ignore_subscribe_messages
+        self.loop = asyncio.get_running_loop()
+        self.messages: asyncio.Queue = asyncio.Queue()
+
+    def deliver(self, message):
+        # Publishers may run in another thread or event loop
+        self.loop.call_soon_threadsafe(self.messages.put_nowait, message)
+
+    async def subscribe(self, *channels):  # type: ignore[override]
+        super().subscribe(*channels)
+
+    async def get_message(self, timeout=0.0):  # type: ignore[override]
+        try:
+            return await asyncio.wait_for(self.messages.get(), timeout or 0.001)
+        except asyncio.TimeoutError:
+            return None
+
+    async def listen(self):  # type: ignore[override]
+        while True:
+            yield await self.messages.get()
+
+    async def aclose(self):
+        self.close()
+
+
+class AsyncMemoryScript(MemoryScript):
+    async def __call__(self, keys=(), args=(), client=None):  # type: ignore
+        return super().__call__(keys, args, client)
+
+
+class AsyncMemoryRedis(MemoryRedis):
+    """
+    Drop-in for redis.asyncio.Redis over a `MemoryStore`
+    """
+
+    def __getattr__(self, name):
+        if name not in COMMANDS:
+            raise AttributeError(name)
+
+        async def command(*args, **kwargs):
+            return self.store.execute(name, *args, **kwargs)
+
+        return command
+
+    def pipeline(self, transaction=True) -> AsyncMemoryPipeline:
+        return AsyncMemoryPipeline(self.store)
+
+    def register_script(self, source: str) -> AsyncMemoryScript:
+        return AsyncMemoryScript(self.store, source)
+
+    def pubsub(self, ignore_subscribe_messages=False) -> AsyncMemoryPubSub:
+        return AsyncMemoryPubSub(self.store, ignore_subscribe_messages)
+
+    async def scan_iter(self, match="*", count=None):  # type: ignore[override]
+        for key in self.store.execute("keys", match):
+            yield key
+
+    async def zscan_iter(self, name, match=None, count=None):  # type: ignore
+        for item in self.store.execute("zscan", name, match or "*"):
+            yield item
+
+    async def aclose(self):
+        pass
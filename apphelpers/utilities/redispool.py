@@ -0,0 +1,186 @@
+from __future__ import annotations
+
+import time
+from typing import Any, Optional
+
+import redis
+import redis.asyncio
+from redis.asyncio.retry import Retry as AsyncRetry
+from redis.backoff import ExponentialWithJitterBackoff
+from redis.retry import Retry
+
+# Max connections of a blocking pool when `max_connections` is not given
+BLOCKING_MAX_CONNECTIONS = 50
+
+
+class PoolStatsMixin:
+    """
+    Times how long callers waited to get a connection from the pool
+    """
+
+    acquired = 0
+    wait_seconds = 0.0
+    max_wait_seconds = 0.0
+
+    def _waited(self, seconds: float):
+        self.acquired += 1
+        self.wait_seconds += seconds
+        if seconds > self.max_wait_seconds:
+            self.max_wait_seconds = seconds
+
+    def _counts(self) -> tuple[int, int]:
+        """
+        => (connections in use, idle connections)
+        """
+        return len(self._in_use_connections), len(self._available_connections)
+
+    def stats(self) -> dict[str, Any]:
+        in_use, idle = self._counts()
+        return {
+            "in_use": in_use,
+            "idle": idle,
+            "max_connections": self.max_connections,
+            "acquired": self.acquired,
+            "wait_seconds": self.wait_seconds,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+class _TimedPool(PoolStatsMixin):
+    def get_connection(self, *args, **kwargs):
+        started_at = time.monotonic()
+        connection = super().get_connection(*args, **kwargs)
+        self._waited(time.monotonic() - started_at)
+        return connection
+
+
+class _AsyncTimedPool(PoolStatsMixin):
+    async def get_connection(self, *args, **kwargs):
+        started_at = time.monotonic()
+        connection = await super().get_connection(*args, **kwargs)
+        self._waited(time.monotonic() - started_at)
+        return connection
+
+
+class ConnectionPool(_TimedPool, redis.ConnectionPool):
+    pass
+
+
+class BlockingConnectionPool(_TimedPool, redis.BlockingConnectionPool):
+    def _counts(self) -> tuple[int, int]:
+        idle = sum(1 for connection in list(self.pool.queue) if connection)
+        return len(self._connections) - idle, idle
+
+
+class AsyncConnectionPool(_AsyncTimedPool, redis.asyncio.ConnectionPool):
+    pass
+
+
+class AsyncBlockingConnectionPool(
+    _AsyncTimedPool, redis.asyncio.BlockingConnectionPool
+):
+    pass
+
+
+def connection_options(
+    max_connections: Optional[int] = None,
+    health_check_interval: Optional[float] = None,
+    socket_keepalive: Optional[bool] = None,
+    retries: Optional[int] = None,
+    retry_backoff: float = 0.01,
+    retry_backoff_cap: float = 1.0,
+    retry_class=Retry,
+) -> dict[str, Any]:
+    """
+    => client keyword arguments for the options that are set (None: leave the
+    redis default)
+
+    retries: times a command is retried after a connection error or timeout,
+             waiting between `retry_backoff` and `retry_backoff_cap` seconds
+             (exponential backoff with jitter)
+    """
+    options: dict[str, Any] = {}
+    if max_connections is not None:
+        options["max_connections"] = max_connections
+    if health_check_interval is not None:
+        options["health_check_interval"] = health_check_interval
+    if socket_keepalive is not None:
+        options["socket_keepalive"] = socket_keepalive
+    if retries is not None:
+        backoff = ExponentialWithJitterBackoff(
+            base=retry_backoff, cap=retry_backoff_cap
+        )
+        options["retry"] = retry_class(backoff, retries)
+    return options
+
+
+_POOLS = {
+    redis.Redis: (ConnectionPool, BlockingConnectionPool, Retry, redis.connection),
+    redis.asyncio.Redis: (
+        AsyncConnectionPool,
+        AsyncBlockingConnectionPool,
+        AsyncRetry,
+        redis.asyncio.connection,
+    ),
+}
+
+# TCP only connection parameters
+_TCP_PARAMS = (
+    "host",
+    "port",
+    "socket_connect_timeout",
+    "socket_keepalive",
+    "socket_keepalive_options",
+)
+
+
+def pooled_client(
+    params: dict,
+    pool_timeout: Optional[float] = None,
+    client_class=redis.Redis,
+    **options,
+):
+    """
+    => `client_class` (redis.Redis or redis.asyncio.Redis) for `params` over a
+    pool keeping `stats`. With `pool_timeout` the pool is a blocking one: once
+    `max_connections` are in use, callers wait up to `pool_timeout` seconds for
+    a free connection instead of failing at once.
+
+    options: see `connection_options`
+    """
+    pool_class, blocking_pool_class, retry_class, connections = _POOLS[client_class]
+    kwargs = dict(params)
+    kwargs.update(connection_options(retry_class=retry_class, **options))
+    # redis.Redis maps these parameters to a connection class itself, pools
+    # built by hand have to
+    path = kwargs.pop("unix_socket_path", None)
+    if path:
+        for name in _TCP_PARAMS:
+            kwargs.pop(name, None)
+        kwargs["path"] = path
+        connection_class = connections.UnixDomainSocketConnection
+    elif kwargs.pop("ssl", False):
+        connection_class = connections.SSLConnection
+    else:
+        connection_class = connections.Connection
+    # Same timeouts as redis.Redis, rather than none at all
+    kwargs.setdefault("socket_timeout", 5)
+    if not path:
+        kwargs.setdefault("socket_connect_timeout", 5)
+    if pool_timeout is None:
+        pool = pool_class(connection_class=connection_class, **kwargs)
+    else:
+        kwargs.setdefault("max_connections", BLOCKING_MAX_CONNECTIONS)
+        pool = blocking_pool_class(
+            connection_class=connection_class, timeout=pool_timeout, **kwargs
+        )
+    return client_class.from_pool(pool)
+
+
+def pool_stats(client) -> Optional[dict[str, Any]]:
+    """
+    => `stats` of the client's connection pool, None if it does not keep any
+    (e.g. cluster or in-memory clients)
+    """
+    pool = getattr(client, "connection_pool", None)
+    return pool.stats() if isinstance(pool, PoolStatsMixin) else None
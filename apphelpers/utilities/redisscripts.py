@@ -0,0 +1,132 @@
+"""
+Lua scripts run by the session handlers and the cached models. They live apart
+from both so that backends emulating them (see memoryredis) need not import
+either.
+"""
+
+# Session handlers (apphelpers.sessions, apphelpers.async_sessions)
+
+# KEYS: session key, [reverse lookup key, [uid's sites index, [site's uids index]]]
+# ARGV: sid, ttl, uid, site_ctx, field, value, [field, value ...]
+#       or sid, ttl, uid, site_ctx, blob (blob layout)
+# Returns the existing sid if the uid already has one, else the new sid.
+# In cluster mode the site's uids index lives on another slot (INDEX_SCRIPT).
+CREATE_SESSION_SCRIPT = """
+if KEYS[2] then
+    local existing = redis.call('GET', KEYS[2])
+    if existing then
+        return existing
+    end
+end
+if #ARGV == 5 then
+    redis.call('SET', KEYS[1], ARGV[5], 'EX', ARGV[2])
+else
+    redis.call('HSET', KEYS[1], unpack(ARGV, 5))
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+if KEYS[2] then
+    redis.call('SET', KEYS[2], ARGV[1], 'EX', ARGV[2])
+end
+if KEYS[3] then
+    redis.call('SADD', KEYS[3], ARGV[4])
+    if KEYS[4] then
+        redis.call('SADD', KEYS[4], ARGV[3])
+    end
+    for i = 3, #KEYS do
+        if redis.call('TTL', KEYS[i]) < tonumber(ARGV[2]) then
+            redis.call('EXPIRE', KEYS[i], ARGV[2])
+        end
+    end
+end
+return ARGV[1]
+"""
+
+# KEYS: index set
+# ARGV: member, ttl
+INDEX_SCRIPT = """
+redis.call('SADD', KEYS[1], ARGV[1])
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[2]) then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+"""
+
+# KEYS: index set
+# ARGV: ttl
+# Pushes back the expiry of the index, never shortening it (EXPIRE GT needs
+# Redis 7)
+EXTEND_INDEX_SCRIPT = """
+if redis.call('TTL', KEYS[1]) < tonumber(ARGV[1]) then
+    return redis.call('EXPIRE', KEYS[1], ARGV[1])
+end
+return 0
+"""
+
+# KEYS: session key
+# ARGV: mode, then field, value, [field, value ...] for "set" and "replace" or
+#       field, [field ...] for "del"
+# Sets, removes or replaces ("replace": the given fields become the session's only
+# fields) fields of a session in either layout, keeping its TTL. Blobs are
+# merged with cmsgpack. Returns 0 (and does not recreate it) if the session is
+# missing, else 1.
+WRITE_SESSION_SCRIPT = """
+local layout = redis.call('TYPE', KEYS[1]).ok
+if layout == 'none' then
+    return 0
+end
+local mode = ARGV[1]
+if layout == 'hash' then
+    if mode == 'del' then
+        redis.call('HDEL', KEYS[1], unpack(ARGV, 2))
+        return 1
+    end
+    if mode == 'replace' then
+        local keep = {}
+        for i = 2, #ARGV, 2 do
+            keep[ARGV[i]] = true
+        end
+        local removed = {}
+        for _, field in ipairs(redis.call('HKEYS', KEYS[1])) do
+            if not keep[field] then
+                removed[#removed + 1] = field
+            end
+        end
+        if #removed > 0 then
+            redis.call('HDEL', KEYS[1], unpack(removed))
+        end
+    end
+    if #ARGV > 1 then
+        redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+    end
+    return 1
+end
+local session = {}
+if mode ~= 'replace' then
+    session = cmsgpack.unpack(redis.call('GET', KEYS[1]))
+end
+if mode == 'del' then
+    for i = 2, #ARGV do
+        session[ARGV[i]] = nil
+    end
+else
+    for i = 2, #ARGV, 2 do
+        session[ARGV[i]] = ARGV[i + 1]
+    end
+end
+if next(session) == nil then
+    redis.call('DEL', KEYS[1])
+else
+    redis.call('SET', KEYS[1], cmsgpack.pack(session), 'KEEPTTL')
+end
+return 1
+"""
+
+# Cached models (apphelpers.utilities.caching, apphelpers.utilities.async_caching)
+
+# KEYS: lock key
+# ARGV: token of the holder
+UNLOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
@@ -0,0 +1,195 @@
+from __future__ import annotations
+
+import _pickle as pickle
+import json
+import zlib
+from typing import Any, Callable, Union
+
+
+class PickleSerializer:
+    """
+    Serializes any Python object. Never use it to read data others can write.
+    """
+
+    # Pickles (protocol 2+) always start with the PROTO opcode
+    tag = b"\x80"
+
+    def dumps(self, value: Any) -> bytes:
+        return pickle.dumps(value)
+
+    def loads(self, data: bytes) -> Any:
+        return pickle.loads(data)
+
+
+class MsgpackSerializer:
+    """
+    Fast and safe. Round trips non-str dict keys (e.g. site_groups) but turns
+    tuples into lists.
+    """
+
+    tag = b"m"
+
+    def __init__(self):
+        import msgpack
+
+        self._pack = msgpack.Packer(use_bin_type=True).pack
+        self._unpackb = msgpack.unpackb
+
+    def dumps(self, value: Any) -> bytes:
+        return self.tag + self._pack(value)
+
+    def loads(self, data: bytes) -> Any:
+        return self._unpackb(data[1:], raw=False, strict_map_key=False)
+
+
+class JSONSerializer:
+    """
+    Uses orjson when installed, else the stdlib json. JSON turns tuples into lists
+    and non-str dict keys into str (the session handlers key site_groups by site
+    id again).
+    """
+
+    tag = b"j"
+
+    def __init__(self):
+        try:
+            import orjson
+        except ImportError:
+            self._dumps = lambda value: json.dumps(value).encode()
+            self._loads = json.loads
+        else:
+            self._dumps = lambda value: orjson.dumps(
+                value, option=orjson.OPT_NON_STR_KEYS
+            )
+            self._loads = orjson.loads
+
+    def dumps(self, value: Any) -> bytes:
+        return self.tag + self._dumps(value)
+
+    def loads(self, data: bytes) -> Any:
+        return self._loads(data[1:])
+
+
+serializers = {
+    "pickle": PickleSerializer,
+    "msgpack": MsgpackSerializer,
+    "json": JSONSerializer,
+}
+
+Serializer = Union[PickleSerializer, MsgpackSerializer, JSONSerializer]
+
+
+class ZlibCompressor:
+    tag = b"z"
+
+    def __init__(self, level: int = 6):
+        self.level = level
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, self.level)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCompressor:
+    """
+    Needs the zstandard package. Faster than zlib for a similar ratio.
+    """
+
+    tag = b"Z"
+
+    def __init__(self, level: int = 3):
+        import zstandard
+
+        self._compress = zstandard.ZstdCompressor(level=level).compress
+        self._decompress = zstandard.ZstdDecompressor().decompress
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return self._decompress(data)
+
+
+# Compressed values are the compressor's tag followed by the compressed encoded
+# value, so these tags must not clash with the serializers' tags
+compressors = {
+    "zlib": ZlibCompressor,
+    "zstd": ZstdCompressor,
+}
+
+Compressor = Union[ZlibCompressor, ZstdCompressor]
+
+
+def get_serializer(serializer: Union[str, Serializer]) -> Serializer:
+    """
+    serializer: name from `serializers` or an object with `tag`, `dumps`, `loads`
+    """
+    return serializers[serializer]() if isinstance(serializer, str) else serializer
+
+
+def build_dumps(
+    serializer: Serializer,
+    compression: Union[str, Compressor, None] = None,
+    threshold: int = 1024,
+) -> Callable[[Any], bytes]:
+    """
+    => dumps(value) that also compresses encoded values of at least `threshold`
+    bytes when given a `compression` (name from `compressors` or an object with
+    `tag`, `compress`, `decompress`). Values that do not shrink are kept as is.
+    """
+    dumps = serializer.dumps
+    if compression is None:
+        return dumps
+    compressor = (
+        compressors[compression]() if isinstance(compression, str) else compression
+    )
+    tag, compress = compressor.tag, compressor.compress
+
+    def dumps_compressed(value: Any) -> bytes:
+        data = dumps(value)
+        if len(data) < threshold:
+            return data
+        compressed = tag + compress(data)
+        return compressed if len(compressed) < len(data) else data
+
+    return dumps_compressed
+
+
+def build_loads(
+    serializer: Serializer, allow_pickle: bool = True
+) -> Callable[[bytes], Any]:
+    """
+    => loads(data) that picks the serializer by the leading tag byte, so values
+    written with any of the available serializers stay readable while switching
+    from one to another. Pickles are only read if `allow_pickle` (or if
+    `serializer` itself is pickle). Compressed values are decompressed first,
+    whatever the compression settings of the reader.
+    """
+    decoders = {}
+    for serializer_class in serializers.values():
+        if serializer_class is PickleSerializer and not allow_pickle:
+            continue
+        try:
+            decoders[serializer_class.tag] = serializer_class().loads
+        except ImportError:
+            pass
+    decoders[serializer.tag] = serializer.loads
+
+    def loads(data: bytes) -> Any:
+        try:
+            decoder = decoders[data[:1]]
+        except KeyError:
+            raise ValueError(f"Unknown serialization format: {data[:1]!r}")
+        return decoder(data)
+
+    for compressor_class in compressors.values():
+        try:
+            decompress = compressor_class().decompress
+        except ImportError:
+            continue
+        decoders[compressor_class.tag] = lambda data, decompress=decompress: loads(
+            decompress(data[1:])
+        )
+    return loads
@@ -0,0 +1,106 @@
+"""
+Encode/decode cost of the cached model codecs for documents of realistic sizes.
+
+    python benchmarks/cache_codecs.py [--sizes 1,10,100] [--number 2000]
+
+Documents are article-like dicts of about the given sizes in KB. Decoding is
+also timed into a dataclass and a pydantic model (`value_type`). Needs no
+Redis. Codecs whose library is not installed are skipped.
+"""
+
+import argparse
+import dataclasses
+import timeit
+from typing import Any, Optional
+
+from apphelpers.utilities.caching import build_codec
+
+CODECS = {"stdlib json": None, "json": "json", "msgpack": "msgpack"}
+
+
+@dataclasses.dataclass
+class Document:
+    id: int
+    site: int
+    title: str
+    tags: list
+    authors: list
+    paragraphs: list
+    meta: dict
+
+
+def document(kb):
+    paragraph = "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 4
+    return {
+        "id": 123456,
+        "site": 12,
+        "title": "A title of some length for the document",
+        "tags": ["politics", "economy", "world", "opinion"],
+        "authors": [{"id": 42, "name": "Some One", "email": "someone@example.com"}],
+        "paragraphs": [
+            {"n": n, "text": paragraph, "score": n / 7}
+            for n in range(max(1, kb * 1024 // 260))
+        ],
+        "meta": {"published": "2024-01-01T00:00:00Z", "views": 12345, "draft": False},
+    }
+
+
+def pydantic_model() -> Optional[Any]:
+    try:
+        from pydantic import create_model
+    except ImportError:
+        return None
+    return create_model(
+        "Document", **{f.name: (f.type, ...) for f in dataclasses.fields(Document)}
+    )
+
+
+def bench(serializer, doc, number, value_types):
+    dumps, loads = build_codec(serializer)
+    encoded = dumps(doc)
+    if isinstance(encoded, str):
+        encoded = encoded.encode()
+    timings = {
+        "encode": timeit.timeit(lambda: dumps(doc), number=number),
+        "decode": timeit.timeit(lambda: loads(encoded), number=number),
+    }
+    for name, convert in value_types.items():
+        timings[name] = timeit.timeit(lambda: convert(loads(encoded)), number=number)
+    return {k: v / number * 1e6 for k, v in timings.items()}, len(encoded)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--sizes", type=lambda s: [int(n) for n in s.split(",")], default=[1, 10, 100]
+    )
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    value_types = {"dataclass": lambda value: Document(**value)}
+    model = pydantic_model()
+    if model is not None:
+        value_types["pydantic"] = model.model_validate
+    columns = ["encode", "decode", *value_types]
+    print(
+        f"{'KB':>4} {'codec':<12} {'bytes':>8}"
+        + "".join(f" {name + ' us':>13}" for name in columns)
+    )
+    for kb in args.sizes:
+        doc = document(kb)
+        for name, serializer in CODECS.items():
+            try:
+                timings, size = bench(serializer, doc, args.number, value_types)
+            except ImportError:
+                print(f"{kb:>4} {name:<12} skipped (not installed)")
+                continue
+            print(
+                f"{kb:>4} {name:<12} {size:>8}"
+                + "".join(f" {timings[column]:>13.1f}" for column in columns)
+            )
+
+
+if __name__ == "__main__":
+    main()
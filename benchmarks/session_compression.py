@@ -0,0 +1,85 @@
+"""
+Memory per session and CPU per request with and without compression, for a
+session carrying a large profile in its extras.
+
+    python benchmarks/session_compression.py [--number 20000] [--profile-kb 8]
+
+Needs no Redis: memory is the encoded size of the fields and their names (Redis
+adds a fixed overhead per hash on top). Codecs whose library is not installed
+are skipped.
+"""
+
+import argparse
+import timeit
+
+from session_serializers import AUTH_SESSION
+
+from apphelpers.utilities.serializers import (
+    build_dumps,
+    build_loads,
+    compressors,
+    get_serializer,
+)
+
+
+def profile(size_kb):
+    """
+    => reading history like profile of about `size_kb` KB once pickled
+    """
+    return {
+        "history": [
+            {
+                "id": 100000 + i,
+                "title": f"Article number {i} about topic {i % 17}",
+                "tags": ["news", f"topic-{i % 17}", f"author-{i % 5}"],
+                "read_at": 1700000000 + i * 97,
+            }
+            for i in range(size_kb * 10)
+        ]
+    }
+
+
+def bench(serializer, compression, session, number):
+    dumps = build_dumps(serializer, compression)
+    loads = build_loads(serializer)
+    encoded = {k: dumps(v) for k, v in session.items()}
+    auth_encoded = [encoded[k] for k in AUTH_SESSION]
+    encode = timeit.timeit(
+        lambda: {k: dumps(v) for k, v in session.items()}, number=number
+    )
+    decode = timeit.timeit(
+        lambda: {k: loads(v) for k, v in encoded.items()}, number=number
+    )
+    decode_auth = timeit.timeit(lambda: [loads(v) for v in auth_encoded], number=number)
+    size = sum(len(k) + len(v) for k, v in encoded.items())
+    return size, (encode, decode, decode_auth)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=20000)
+    parser.add_argument("--profile-kb", type=int, default=8)
+    parser.add_argument("--serializer", default="pickle")
+    args = parser.parse_args()
+
+    serializer = get_serializer(args.serializer)
+    session = dict(AUTH_SESSION, profile=profile(args.profile_kb))
+    print(
+        f"{'compression':<12} {'bytes':>7} {'encode us':>10}"
+        f" {'get us':>8} {'auth get us':>12}"
+    )
+    for name in (None, *compressors):
+        try:
+            size, timings = bench(serializer, name, session, args.number)
+        except ImportError:
+            print(f"{name:<12} skipped (not installed)")
+            continue
+        encode, decode, decode_auth = (t / args.number * 1e6 for t in timings)
+        print(
+            f"{name or 'none':<12} {size:>7} {encode:>10.2f}"
+            f" {decode:>8.2f} {decode_auth:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Encode/decode cost per request for the field set the auth routers read.
+
+    python benchmarks/session_serializers.py [--number 100000]
+
+Needs no Redis. Serializers whose library is not installed are skipped.
+"""
+
+import argparse
+import timeit
+
+from apphelpers.utilities.serializers import build_loads, serializers
+
+AUTH_SESSION = {
+    "uid": 987651,
+    "name": "No One",
+    "groups": ["admin", "member"],
+    "email": "noone@example.com",
+    "mobile": "+911234567890",
+    "site_groups": {123: ["editor"], 456: ["viewer", "moderator"]},
+    "site_ctx": 123,
+}
+
+
+def bench(serializer, number):
+    dumps = serializer.dumps
+    loads = build_loads(serializer)
+    encoded = {k: dumps(v) for k, v in AUTH_SESSION.items()}
+    encode = timeit.timeit(
+        lambda: {k: dumps(v) for k, v in AUTH_SESSION.items()}, number=number
+    )
+    decode = timeit.timeit(
+        lambda: {k: loads(v) for k, v in encoded.items()}, number=number
+    )
+    size = sum(len(v) for v in encoded.values())
+    return encode / number * 1e6, decode / number * 1e6, size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--number", type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'serializer':<10} {'encode us':>10} {'decode us':>10} {'bytes':>6}")
+    for name, serializer_class in serializers.items():
+        try:
+            serializer = serializer_class()
+        except ImportError:
+            print(f"{name:<10} skipped (not installed)")
+            continue
+        encode, decode, size = bench(serializer, args.number)
+        print(f"{name:<10} {encode:>10.2f} {decode:>10.2f} {size:>6}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,274 @@
+"""
+Ops/sec and p50/p99 latency of the session handlers as the keyspace grows.
+
+    python benchmarks/sessions.py [--backend memory|redis] [--layout hash|blob]
+        [--sizes 1000,100000] [--ops 2000] [--output results.json]
+        [--baseline previous.json]
+
+Times `create`, `get` (all fields and the auth fields), `update`, `resync` and
+`destroy_bound_sessions_for` of apphelpers.sessions and apphelpers.async_sessions
+with 1k, 100k and 1M sessions in the db. `--backend memory` needs no server and
+measures the handlers' own overhead. `--backend redis` talks to --host/--port/--db
+and DELETES ALL SESSIONS there: point it at a throwaway db.
+
+Also reports the mean memory per session: MEMORY USAGE of the session keys on
+Redis, the size of the stored fields (or blob) on the memory backend. Run once
+per `--layout` to compare the hash and blob layouts.
+
+Results are written as JSON. Pass an earlier file as --baseline to print the
+change of each measurement, e.g. between two releases.
+"""
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import secrets
+import statistics
+import sys
+import time
+from importlib.metadata import PackageNotFoundError, version
+
+import redis
+from session_serializers import AUTH_SESSION
+
+from apphelpers import async_sessions, sessions
+
+AUTH_KEYS = ["uid", "groups", "site_groups", "site_ctx"]
+BOUND_SITES = 3
+SEED_BATCH = 10000
+
+
+def seed(handler, start, stop, ttl=3600):
+    """
+    Writes unbound sessions for uids `start` to `stop` as `create` would, but in
+    pipelined batches, so that building a 1M session keyspace takes seconds
+    """
+    fields = {k: handler._dumps(v) for k, v in AUTH_SESSION.items()}
+    sids = []
+    for batch_start in range(start, stop, SEED_BATCH):
+        pipe = handler.rconn.pipeline(transaction=False)
+        for uid in range(batch_start, min(batch_start + SEED_BATCH, stop)):
+            sid = secrets.token_urlsafe()
+            sk = handler._session_key(sid)
+            rev_key = handler._rev_lookup_key(uid)
+            session = dict(fields, uid=handler._dumps(uid))
+            if handler.layout == "blob":
+                pipe.set(sk, handler._blob.pack(session), ex=ttl)
+            else:
+                pipe.hset(sk, mapping=session)
+                pipe.expire(sk, ttl)
+            pipe.set(rev_key, sid, ex=ttl)
+            sids.append(sid)
+        pipe.execute()
+    return sids
+
+
+def session_bytes(handler, sids):
+    """
+    => mean memory per session of `sids`
+    """
+    rconn = handler.rconn
+    sks = [handler._session_key(sid) for sid in sids]
+    if isinstance(rconn, redis.Redis):
+        pipe = rconn.pipeline(transaction=False)
+        for sk in sks:
+            pipe.memory_usage(sk, samples=0)
+        sizes = pipe.execute()
+    else:
+        sizes = [
+            (
+                len(rconn.get(sk))
+                if rconn.type(sk) == b"string"
+                else sum(len(k) + len(v) for k, v in rconn.hgetall(sk).items())
+            )
+            for sk in sks
+        ]
+    return sum(sizes) / len(sizes)
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        "ops": len(latencies),
+        "ops_per_sec": len(latencies) / sum(latencies),
+        "p50_us": statistics.median(latencies) * 1e6,
+        "p99_us": latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1e6,
+    }
+
+
+def operations(sids, first_uid, ops):
+    """
+    => (name, setup, call) for each measured operation. `setup(i)` prepares the
+    arguments of the i-th call outside of the timing.
+    """
+    update = {"name": "Some One", "email": "someone@example.com"}
+    resync = dict(AUTH_SESSION, name="Some One")
+    resync.pop("mobile")
+    return [
+        ("create", lambda i: (), lambda h, i: h.create(first_uid + i, ["member"])),
+        ("get", lambda i: (), lambda h, i: h.get(sids[i % len(sids)])),
+        (
+            "get_keys",
+            lambda i: (),
+            lambda h, i: h.get(sids[i % len(sids)], AUTH_KEYS),
+        ),
+        ("update", lambda i: (), lambda h, i: h.update(sids[i % len(sids)], update)),
+        (
+            "resync",
+            lambda i: (),
+            lambda h, i: h.resync(sids[i % len(sids)], dict(resync)),
+        ),
+        (
+            "destroy_bound_sessions_for",
+            lambda i: [
+                (first_uid + ops + i, site) for site in range(1, BOUND_SITES + 1)
+            ],
+            lambda h, i: h.destroy_bound_sessions_for(first_uid + ops + i),
+        ),
+    ]
+
+
+def bench_sync(handler, sids, first_uid, ops):
+    results = {}
+    for name, setup, call in operations(sids, first_uid, ops):
+        latencies = []
+        for i in range(ops):
+            for uid, site in setup(i):
+                handler.create(uid, ["member"], site_ctx=site)
+            started_at = time.perf_counter()
+            call(handler, i)
+            latencies.append(time.perf_counter() - started_at)
+        results[name] = summarize(latencies)
+    return results
+
+
+async def bench_async(rconn_params, layout, sids, first_uid, ops):
+    handler = async_sessions.SessionDBHandler(rconn_params, layout=layout)
+    results = {}
+    try:
+        for name, setup, call in operations(sids, first_uid, ops):
+            latencies = []
+            for i in range(ops):
+                for uid, site in setup(i):
+                    await handler.create(uid, ["member"], site_ctx=site)
+                started_at = time.perf_counter()
+                await call(handler, i)
+                latencies.append(time.perf_counter() - started_at)
+            results[name] = summarize(latencies)
+    finally:
+        await handler.close()
+    return results
+
+
+def run(args):
+    rconn_params = {"host": args.host, "port": args.port, "db": args.db}
+    if args.backend == "memory":
+        rconn_params["backend"] = "memory"
+    handler = sessions.SessionDBHandler(rconn_params, layout=args.layout)
+    handler.destroy_all()
+
+    results = []
+    memory = []
+    seeded = 0
+    # Uids used by the measured calls, clear of the seeded ones
+    first_uid = 10**9
+    sids = []
+    for size in args.sizes:
+        print(f"seeding {size} sessions", file=sys.stderr)
+        sids += seed(handler, seeded, size)
+        seeded = size
+        sample = random.sample(sids, min(args.ops, len(sids)))
+        memory.append({"sessions": size, "bytes": session_bytes(handler, sample)})
+        print(f"{memory[-1]['bytes']:.0f} bytes per session", file=sys.stderr)
+        measured = {"sync": bench_sync(handler, sample, first_uid, args.ops)}
+        first_uid += 2 * args.ops
+        measured["async"] = asyncio.run(
+            bench_async(rconn_params, args.layout, sample, first_uid, args.ops)
+        )
+        first_uid += 2 * args.ops
+        for handler_name, ops in measured.items():
+            for op, stats in ops.items():
+                results.append(
+                    dict(handler=handler_name, sessions=size, op=op, **stats)
+                )
+                report(results[-1])
+    handler.destroy_all()
+    return results, memory
+
+
+def report(result, baseline=None):
+    line = (
+        f"{result['handler']:<6} {result['sessions']:>8} {result['op']:<27}"
+        f" {result['ops_per_sec']:>9.0f} {result['p50_us']:>8.1f}"
+        f" {result['p99_us']:>8.1f}"
+    )
+    if baseline:
+        change = result["ops_per_sec"] / baseline["ops_per_sec"] - 1
+        line += f" {change:>+8.1%}"
+    print(line)
+
+
+def compare(results, baseline_path):
+    with open(baseline_path) as f:
+        baseline = {
+            (r["handler"], r["sessions"], r["op"]): r for r in json.load(f)["results"]
+        }
+    print(f"\nops/sec change against {baseline_path}")
+    for result in results:
+        key = (result["handler"], result["sessions"], result["op"])
+        if key in baseline:
+            report(result, baseline[key])
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--backend", choices=("memory", "redis"), default="memory")
+    parser.add_argument("--layout", choices=("hash", "blob"), default="hash")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=6379)
+    parser.add_argument("--db", type=int, default=15)
+    parser.add_argument(
+        "--sizes",
+        type=lambda s: sorted(int(n) for n in s.split(",")),
+        default=[1000, 100000, 1000000],
+    )
+    parser.add_argument("--ops", type=int, default=2000, help="calls per operation")
+    parser.add_argument("--output", default="session_benchmark.json")
+    parser.add_argument("--baseline")
+    args = parser.parse_args()
+
+    print(
+        f"{'':<6} {'sessions':>8} {'op':<27} {'ops/sec':>9} {'p50 us':>8}"
+        f" {'p99 us':>8}"
+    )
+    results, memory = run(args)
+    try:
+        apphelpers_version = version("apphelpers")
+    except PackageNotFoundError:
+        apphelpers_version = None
+    with open(args.output, "w") as f:
+        json.dump(
+            {
+                "apphelpers": apphelpers_version,
+                "python": platform.python_version(),
+                "backend": args.backend,
+                "layout": args.layout,
+                "ops": args.ops,
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+                "results": results,
+                "memory": memory,
+            },
+            f,
+            indent=2,
+        )
+    print(f"results written to {args.output}", file=sys.stderr)
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,8 @@ SESSIONSDB_HOST = "127.0.0.1"
 SESSIONSDB_PORT = 6379
 SESSIONSDB_PASSWD = None
 SESSIONSDB_NO = 1
+# "memory" runs the session tests without a Redis server
+SESSIONSDB_BACKEND = None
 
 # SMTP
 SMTP_HOST = "127.0.0.1"
@@ -17,6 +17,7 @@ sessiondb_conn = dict(
     port=settings.SESSIONSDB_PORT,
     password=settings.SESSIONSDB_PASSWD,
     db=settings.SESSIONSDB_NO,
+    backend=settings.SESSIONSDB_BACKEND,
 )
 
 
@@ -17,6 +17,7 @@ def make_app():
         port=settings.SESSIONSDB_PORT,
         password=settings.SESSIONSDB_PASSWD,
         db=settings.SESSIONSDB_NO,
+        backend=settings.SESSIONSDB_BACKEND,
     )
 
     api_factory = APIFactory(sessiondb_conn=sessiondb_conn, site_identifier="site_id")
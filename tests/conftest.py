@@ -16,6 +16,7 @@ sessiondb_conn = dict(
     port=settings.SESSIONSDB_PORT,
     password=settings.SESSIONSDB_PASSWD,
     db=settings.SESSIONSDB_NO,
+    backend=settings.SESSIONSDB_BACKEND,
 )
 
 
@@ -36,3 +37,26 @@ async def sessionsdb():
     sessionsdb = SessionDBHandler(sessiondb_conn)
     yield sessionsdb
     await sessionsdb.close()
+
+
+@pytest.fixture
+async def cached_sessionsdb():
+    sessionsdb = SessionDBHandler(sessiondb_conn, cache_size=100)
+    yield sessionsdb
+    await sessionsdb.close()
+
+
+@pytest.fixture
+async def sessionsdb_factory():
+    """
+    => function building handlers with the given options, closed on teardown
+    """
+    handlers = []
+
+    def factory(**options):
+        handlers.append(SessionDBHandler(sessiondb_conn, **options))
+        return handlers[-1]
+
+    yield factory
+    for handler in handlers:
+        await handler.close()
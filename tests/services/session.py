@@ -29,6 +29,7 @@ def make_app():
         port=settings.SESSIONSDB_PORT,
         password=settings.SESSIONSDB_PASSWD,
         db=settings.SESSIONSDB_NO,
+        backend=settings.SESSIONSDB_BACKEND,
     )
     api_factory.setup_session_db(sessiondb_conn)
     setup_routes(api_factory)
@@ -1,10 +1,11 @@
+import asyncio
 from collections import namedtuple
 
 import pytest
 
 import apphelpers.async_sessions as sessionslib
 from apphelpers.errors import InvalidSessionError
-
+from tests.conftest import sessiondb_conn
 
 Session = namedtuple("Session", ["uid", "groups", "k", "v"])
 
@@ -15,6 +16,14 @@ class data:
     site_ctx = 123
 
 
+async def wait_for(condition, timeout=1):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError()
+
+
 @pytest.mark.anyio
 class TestSessions:
 
@@ -33,6 +42,8 @@ class TestSessions:
         assert len(sid) == 43
         sid_new = await sessionsdb.create(data.session.uid, data.session.groups)
         assert sid == sid_new == await sessionsdb.uid2sid(d["uid"])
+        assert await sessionsdb.rconn.ttl(sessionslib.session_key(sid)) > 0
+        assert await sessionsdb.rconn.ttl(sessionslib.rev_lookup_key(d["uid"])) > 0
         assert await sessionsdb.uid2bound_sids(d["uid"]) == []
 
         d = dict(
@@ -66,6 +77,237 @@ class TestSessions:
         await sessionsdb.destroy_bound_sessions_for(data.session.uid)
         assert not await sessionsdb.exists(bound_sid)
 
+    async def test_bound_session_indexes(
+        self, sessionsdb: sessionslib.SessionDBHandler
+    ):
+        uid, groups = 20001, ["grp1"]
+        sids = {
+            site_ctx: await sessionsdb.create(uid, groups, site_ctx=site_ctx)
+            for site_ctx in (1, 2, 3)
+        }
+        assert sorted(await sessionsdb.uid2bound_site_ids(uid)) == [1, 2, 3]
+        assert sorted(await sessionsdb.uid2bound_sids(uid)) == sorted(sids.values())
+
+        # expired reverse lookups are dropped from the index
+        await sessionsdb.rconn.delete(sessionslib.rev_lookup_key(uid, 3))
+        assert sorted(await sessionsdb.uid2bound_site_ids(uid)) == [1, 2]
+
+        # sessions created before the index existed are picked up by a rebuild
+        await sessionsdb.rconn.delete(sessionslib.bound_site_ids_key(uid))
+        assert await sessionsdb.uid2bound_site_ids(uid) == []
+        await sessionsdb.rebuild_bound_indexes()
+        assert sorted(await sessionsdb.uid2bound_site_ids(uid)) == [1, 2]
+
+        await sessionsdb.destroy_all_for_bound_site(1)
+        assert not await sessionsdb.exists(sids[1])
+        assert await sessionsdb.uid2bound_sids(uid) == [sids[2]]
+
+        await sessionsdb.destroy_bound_sessions_for(uid)
+        assert not await sessionsdb.exists(sids[2])
+        assert await sessionsdb.uid2bound_sids(uid) == []
+
+    async def test_bound_session_slugs(self, sessionsdb: sessionslib.SessionDBHandler):
+        uid = 20002
+        sid = await sessionsdb.create(uid, ["grp1"], site_ctx="news")
+        assert await sessionsdb.uid2bound_sids(uid) == [sid]
+        assert await sessionsdb.uid2bound_site_ids(uid) == ["news"]
+        await sessionsdb.destroy_bound_sessions_for(uid)
+        assert not await sessionsdb.exists(sid)
+
+    async def test_json_site_groups(self, sessionsdb_factory):
+        handler = sessionsdb_factory(serializer="json")
+        site_groups = {1: ["editor"], "news": ["admin"]}
+        sid = await handler.create(30003, ["grp1"], site_groups=site_groups)
+        assert (await handler.get(sid))["site_groups"] == site_groups
+        assert await handler.get_attribute(sid, "site_groups") == site_groups
+        await handler.destroy(sid)
+
+    async def test_get_many(self, sessionsdb: sessionslib.SessionDBHandler):
+        uids = range(40000, 40005)
+        sids = [await sessionsdb.create(uid, ["grp1"]) for uid in uids]
+        assert await sessionsdb.uid2sid_many([*uids, 1], chunk_size=2) == [
+            *sids,
+            None,
+        ]
+
+        sessions = await sessionsdb.get_many(
+            ["no-such-sid", *sids], ["uid"], chunk_size=2
+        )
+        assert sessions == [None, *({"uid": uid} for uid in uids)]
+        sessions = await sessionsdb.get_many([sids[0], "no-such-sid"])
+        assert sessions[0]["groups"] == ["grp1"] and sessions[1] is None
+
+    async def test_negative_cache(self, sessionsdb_factory):
+        cached_sessionsdb = sessionsdb_factory(negative_cache_size=10)
+        for _ in range(3):
+            with pytest.raises(InvalidSessionError):
+                await cached_sessionsdb.get("no-such-sid", ["uid"])
+        assert cached_sessionsdb.negative_cache.hits == 2
+
+        sid = await cached_sessionsdb.create(50001, ["grp1"])
+        assert await cached_sessionsdb.sid2uid(sid) == 50001
+
+    async def test_signed_tokens(self, sessionsdb, sessionsdb_factory):
+        signed_sessionsdb = sessionsdb_factory(
+            signing_key="secret", revocation_poll_interval=0
+        )
+        site_groups = {123: ["editor"]}
+        sid = await signed_sessionsdb.create(
+            50002, ["grp1"], site_groups=site_groups, site_ctx=123
+        )
+        token = await signed_sessionsdb.issue_signed_token(sid)
+        assert await signed_sessionsdb.get(token, ["uid", "site_groups", "name"]) == {
+            "uid": 50002,
+            "site_groups": site_groups,
+            "name": None,
+        }
+
+        body, _, signature = token.partition(".")
+        with pytest.raises(InvalidSessionError):
+            await signed_sessionsdb.get(body + "." + signature[::-1], ["uid"])
+
+        # expired tokens fall back to the session in redis
+        signer = sessionslib.SessionSigner("secret", ttl=-1)
+        expired = signer.sign(sid, {"uid": 50002})
+        assert await signed_sessionsdb.get(expired, ["uid", "groups"]) == {
+            "uid": 50002,
+            "groups": ["grp1"],
+        }
+
+        # destroyed by another process
+        writer = sessionsdb_factory(record_revocations=True)
+        await writer.destroy(sid, site_ctx=123)
+        with pytest.raises(InvalidSessionError):
+            await signed_sessionsdb.get(token, ["uid"])
+        with pytest.raises(InvalidSessionError):
+            await signed_sessionsdb.get(expired, ["uid"])
+
+    async def test_signed_token_writes(self, sessionsdb, sessionsdb_factory):
+        signed_sessionsdb = sessionsdb_factory(
+            signing_key="secret", revocation_poll_interval=0, cache_size=100
+        )
+        sid = await signed_sessionsdb.create(50004, ["grp1"])
+        token = await signed_sessionsdb.issue_signed_token(sid)
+        assert await signed_sessionsdb.exists(token)
+        await signed_sessionsdb.update(token, {"k": "v"})
+        assert await signed_sessionsdb.get_attribute(token, "k") == "v"
+        assert await signed_sessionsdb.get_many([token], ["k"]) == [{"k": "v"}]
+        forged = token[:-4] + "AAAA"
+        assert await signed_sessionsdb.get_many([forged, token], ["k"]) == [
+            None,
+            {"k": "v"},
+        ]
+        await signed_sessionsdb.remove_from_session(token, ["k"])
+        assert not await sessionsdb.rconn.exists(sessionslib.session_key(token))
+
+        # resynced by another process: the token is answered from redis
+        writer = sessionsdb_factory(record_revocations=True)
+        await writer.resync(sid, {"uid": 50004, "groups": ["grp2"]})
+        assert await signed_sessionsdb.get(token, ["groups"]) == {"groups": ["grp2"]}
+        await signed_sessionsdb.resync(token, {"uid": 50004, "groups": ["grp3"]})
+        assert await signed_sessionsdb.get(token, ["groups"]) == {"groups": ["grp3"]}
+        await signed_sessionsdb.destroy(token)
+
+    async def test_extend_timeout(self, sessionsdb, sessionsdb_factory):
+        sliding_sessionsdb = sessionsdb_factory(extend_interval=60)
+        sid = await sliding_sessionsdb.create(50003, ["grp1"], ttl=100, site_ctx=123)
+        assert await sliding_sessionsdb.extend_timeout(sid, ttl=1000)
+        assert await sessionsdb.rconn.ttl(sessionslib.session_key(sid)) > 100
+        rev_key = sessionslib.rev_lookup_key(50003, 123)
+        assert await sessionsdb.rconn.ttl(rev_key) > 100
+
+        # throttled until extend_interval has passed
+        await sessionsdb.rconn.expire(sessionslib.session_key(sid), 100)
+        assert not await sliding_sessionsdb.extend_timeout(sid, ttl=1000)
+        assert await sessionsdb.rconn.ttl(sessionslib.session_key(sid)) <= 100
+
+        await sessionsdb.destroy(sid, site_ctx=123)
+        sliding_sessionsdb.extend_interval = 0
+        with pytest.raises(InvalidSessionError):
+            await sliding_sessionsdb.extend_timeout(sid)
+
+    async def test_extend_bound_session(self, sessionsdb):
+        uid, site_ctx = 50005, 50005
+        sid = await sessionsdb.create(uid, ["grp1"], ttl=100, site_ctx=site_ctx)
+        assert await sessionsdb.extend_timeout(sid, ttl=1000)
+        for key in (
+            sessionslib.bound_site_ids_key(uid),
+            sessionslib.bound_uids_key(site_ctx),
+        ):
+            assert await sessionsdb.rconn.ttl(key) > 100
+        await sessionsdb.destroy_bound_sessions_for(uid)
+        assert not await sessionsdb.exists(sid)
+
+    async def test_replica_reads(self, sessionsdb, sessionsdb_factory):
+        replica_conn = dict(sessiondb_conn, db=sessiondb_conn["db"] + 1)
+        replica = sessionslib.SessionDBHandler(replica_conn)
+        replicated_sessionsdb = sessionsdb_factory(replicas=[replica_conn])
+
+        replica_sid = await replica.create(60020, ["grp1"])
+        assert await replicated_sessionsdb.sid2uid(replica_sid) == 60020
+
+        # missing from the replica: read from the primary
+        sid = await sessionsdb.create(60021, ["grp1"])
+        assert await replicated_sessionsdb.sid2uid(sid) == 60021
+        assert await replicated_sessionsdb.uid2sid_many([60020, 60021]) == [
+            replica_sid,
+            sid,
+        ]
+
+        # a lagging replica does not hide this process's own writes
+        await replica.rconn.hset(sessionslib.session_key(sid), "uid", replica._dumps(1))
+        assert await replicated_sessionsdb.sid2uid(sid) == 1
+        await replicated_sessionsdb.update(sid, {"k": "v"})
+        assert await replicated_sessionsdb.get(sid, ["uid", "k"]) == {
+            "uid": 60021,
+            "k": "v",
+        }
+        await replica.destroy_all()
+        await replica.close()
+
+    async def test_coalesced_get(
+        self, sessionsdb: sessionslib.SessionDBHandler, monkeypatch
+    ):
+        sid = await sessionsdb.create(data.session.uid, data.session.groups)
+        calls = []
+        _get = sessionsdb._get
+
+        async def counting_get(*args):
+            calls.append(args)
+            await asyncio.sleep(0.01)
+            return await _get(*args)
+
+        monkeypatch.setattr(sessionsdb, "_get", counting_get)
+        sessions = await asyncio.gather(
+            *(sessionsdb.get(sid, ["uid"]) for _ in range(10))
+        )
+        assert sessions == [{"uid": data.session.uid}] * 10
+        assert len(calls) == 1
+
+        # each caller gets its own copy
+        sessions = await asyncio.gather(
+            *(sessionsdb.get(sid, ["groups", "k"]) for _ in range(3))
+        )
+        sessions[0]["groups"].append("changed")
+        assert sessions[1:] == [{"groups": data.session.groups, "k": None}] * 2
+        assert len(calls) == 2
+
+        # errors reach every waiter
+        errors = await asyncio.gather(
+            *(sessionsdb.get("no-such-sid") for _ in range(5)), return_exceptions=True
+        )
+        assert all(isinstance(error, InvalidSessionError) for error in errors)
+        assert len(calls) == 3
+
+        # a cancelled caller hands the lookup over to one of its waiters
+        first = asyncio.ensure_future(sessionsdb.get(sid, ["uid"]))
+        await asyncio.sleep(0)
+        others = asyncio.gather(*(sessionsdb.get(sid, ["uid"]) for _ in range(3)))
+        await asyncio.sleep(0)
+        first.cancel()
+        assert await others == [{"uid": data.session.uid}] * 3
+        assert len(calls) == 5 and not sessionsdb._inflight
+
     async def test_update(self, sessionsdb: sessionslib.SessionDBHandler):
         d = dict(
             uid=data.session.uid,
@@ -83,6 +325,23 @@ class TestSessions:
         d = await sessionsdb.get(sid)
         assert k not in d
 
+    async def test_get_keys(self, sessionsdb: sessionslib.SessionDBHandler):
+        sid = await sessionsdb.create(
+            data.session.uid,
+            data.session.groups,
+            extras=dict(email=data.session_email),
+        )
+        missing = object()
+        d = await sessionsdb.get(sid, ["uid", "email", "nope"], default=missing)
+        assert d == {
+            "uid": data.session.uid,
+            "email": data.session_email,
+            "nope": missing,
+        }
+        assert await sessionsdb.get(sid, ["nope"]) == {"nope": None}
+        with pytest.raises(InvalidSessionError):
+            await sessionsdb.get("no-such-sid", ["uid"])
+
     async def test_resync(self, sessionsdb: sessionslib.SessionDBHandler):
         d = dict(
             uid=data.session.uid,
@@ -109,6 +368,26 @@ class TestSessions:
         with pytest.raises(InvalidSessionError):
             await sessionsdb.get(sid)
 
+    async def test_resync_many(self, sessionsdb: sessionslib.SessionDBHandler):
+        uids = range(20000, 20005)
+        sids = [
+            await sessionsdb.create(uid, ["member"], extras={"stale": 1})
+            for uid in uids
+        ]
+        keyvalues = {uid: {"groups": ["editor"], "name": str(uid)} for uid in uids}
+        keyvalues[20100] = {"groups": []}
+        assert await sessionsdb.resync_many(keyvalues) == len(sids)
+        for uid, sid in zip(uids, sids):
+            assert await sessionsdb.get(sid) == {
+                "uid": uid,
+                "groups": ["editor"],
+                "name": str(uid),
+                "site_ctx": None,
+            }
+            await sessionsdb.destroy(sid)
+        with pytest.raises(InvalidSessionError):
+            await sessionsdb.resync(sids[0], {"uid": uids[0]})
+
     async def test_session_lookup(self, sessionsdb: sessionslib.SessionDBHandler):
         uids = range(10000, 10010)
         groups = ["grp1", "grp2"]
@@ -118,3 +397,124 @@ class TestSessions:
             await sessionsdb.destroy(sid)
             with pytest.raises(InvalidSessionError):
                 await sessionsdb.get(sid)
+
+    async def test_cache(
+        self,
+        sessionsdb: sessionslib.SessionDBHandler,
+        cached_sessionsdb: sessionslib.SessionDBHandler,
+    ):
+        sid = await sessionsdb.create(
+            data.session.uid,
+            data.session.groups,
+            extras=dict(email=data.session_email),
+        )
+        await cached_sessionsdb.get(sid)
+        await wait_for(lambda: cached_sessionsdb._invalidations_subscribed)
+
+        # callers get their own copy, whether loaded or served from the cache
+        for _ in range(2):
+            session = await cached_sessionsdb.get(sid)
+            session["groups"].append("intruder")
+        d = await cached_sessionsdb.get(sid, ["email", "groups"])
+        assert d == {"email": data.session_email, "groups": data.session.groups}
+        assert cached_sessionsdb.cache.hits == 2
+        sessions = await cached_sessionsdb.get_many([sid, "no-such-sid"], ["email"])
+        assert sessions == [{"email": data.session_email}, None]
+        assert cached_sessionsdb.cache.hits == 3
+
+        # writes from another handler evict the cached copy
+        await sessionsdb.update(sid, {"email": "someone@example.com"})
+        await wait_for(lambda: sid not in cached_sessionsdb.cache)
+        d = await cached_sessionsdb.get(sid, ["email"])
+        assert d == {"email": "someone@example.com"}
+
+        await sessionsdb.destroy(sid)
+        await wait_for(lambda: sid not in cached_sessionsdb.cache)
+        with pytest.raises(InvalidSessionError):
+            await cached_sessionsdb.get(sid)
+
+    async def test_cache_resubscribes(
+        self, sessionsdb, sessionsdb_factory, monkeypatch, caplog
+    ):
+        monkeypatch.setattr(sessionslib, "RESUBSCRIBE_DELAY", 0.01)
+        handler = sessionsdb_factory(cache_size=100)
+        dropped = asyncio.Event()
+        pubsubs = []
+        pubsub = handler.rconn.pubsub
+
+        def dropping_pubsub(**options):
+            pubsubs.append(pubsub(**options))
+            if len(pubsubs) == 1:
+
+                async def listen():
+                    await dropped.wait()
+                    raise ConnectionError("Connection lost")
+                    yield
+
+                pubsubs[0].listen = listen
+            return pubsubs[-1]
+
+        handler.rconn.pubsub = dropping_pubsub
+        sid = await sessionsdb.create(50010, ["grp1"])
+        await handler.get(sid)
+        await wait_for(lambda: handler._invalidations_subscribed)
+        await handler.get(sid)
+        assert sid in handler.cache
+
+        # the cache is dropped and the listener subscribes again
+        dropped.set()
+        await wait_for(lambda: len(pubsubs) == 2 and handler._invalidations_subscribed)
+        assert sid not in handler.cache
+        assert "session invalidations lost" in caplog.text
+        await handler.get(sid)
+        await sessionsdb.update(sid, {"name": "Changed"})
+        await wait_for(lambda: sid not in handler.cache)
+        assert (await handler.get(sid, ["name"])) == {"name": "Changed"}
+        await sessionsdb.destroy(sid)
+
+    async def test_blob_layout(self, sessionsdb, sessionsdb_factory):
+        blobdb = sessionsdb_factory(layout="blob")
+        cached_blobdb = sessionsdb_factory(layout="blob", cache_size=100)
+        sid = await blobdb.create(30001, ["member"], extras={"stale": 1})
+        sk = sessionslib.session_key(sid)
+        assert await blobdb.rconn.type(sk) == b"string"
+
+        await blobdb.update(sid, {"name": "Uno"})
+        await blobdb.remove_from_session(sid, ["stale"])
+        assert await cached_blobdb.get(sid, ["name", "stale"]) == {
+            "name": "Uno",
+            "stale": None,
+        }
+        await blobdb.resync(sid, {"uid": 30001, "groups": ["editor"]})
+        assert await blobdb.get(sid) == {"uid": 30001, "groups": ["editor"]}
+        assert await blobdb.rconn.ttl(sk) > 0
+
+        # Either layout reads and writes sessions stored in the other one
+        hash_sid = await sessionsdb.create(30002, ["member"])
+        for db, other_sid in ((blobdb, hash_sid), (sessionsdb, sid)):
+            await db.update(other_sid, {"name": "Two"})
+            assert await db.get(other_sid, ["name"]) == {"name": "Two"}
+        sessions = await cached_blobdb.get_many([sid, hash_sid, "nope"], ["name"])
+        assert sessions == [{"name": "Two"}, {"name": "Two"}, None]
+        await blobdb.destroy(sid)
+        await blobdb.destroy(hash_sid)
+
+    async def test_call_metrics(self, sessionsdb_factory):
+        handler = sessionsdb_factory(metrics=True)
+        sid = await handler.create(40001, ["member"])
+        await handler.get(sid)
+        with pytest.raises(InvalidSessionError):
+            await handler.get("nope")
+        stats = handler.metrics.stats()
+        assert stats["get"]["count"] == 2
+        assert stats["get"]["errors"] == {"InvalidSessionError": 1}
+        assert stats["create"]["count"] == 1
+
+        # One event per public call: those it makes internally are part of it
+        handler.metrics.reset()
+        await handler.get_attribute(sid, "uid")
+        await handler.exists(sid)
+        await handler.destroy(sid)
+        assert {
+            method: entry["count"] for method, entry in handler.metrics.stats().items()
+        } == {"get_attribute": 1, "exists": 1, "destroy": 1}
@@ -0,0 +1,504 @@
+import asyncio
+import dataclasses
+import datetime
+import threading
+import time
+
+import pytest
+from pydantic import BaseModel
+
+from apphelpers.utilities import async_caching, caching
+from apphelpers.utilities.async_caching import (
+    ReadOnlyAsyncCachedModel,
+    ReadWriteAsyncCachedModel,
+)
+from apphelpers.utilities.caching import ReadOnlyCachedModel, ReadWriteCachedModel
+from apphelpers.utilities.memoryredis import AsyncMemoryRedis, MemoryRedis
+
+
+class Article(ReadWriteCachedModel):
+    connection = MemoryRedis(db="test_caching")
+    ns = "article"
+    key_fields = ["site", "id"]
+    secondary_key_fields = ["slug"]
+
+
+class LocalArticle(Article):
+    local_cache_size = 100
+
+
+# The same model in another worker
+class OtherLocalArticle(Article):
+    local_cache_size = 100
+
+
+# A reader of the namespace caching locally, written to by Article
+class ArticleReader(ReadOnlyCachedModel):
+    connection = Article.connection
+    ns = "article"
+    key_fields = ["site", "id"]
+    local_cache_size = 100
+
+
+class ResubscribingArticle(Article):
+    connection = MemoryRedis(db="test_resubscribe")
+    local_cache_size = 100
+
+
+class IndexedArticle(Article):
+    connection = MemoryRedis(db="test_indexed_caching")
+    indexed = True
+    timeout = 100
+
+
+class LoadedArticle(Article):
+    connection = MemoryRedis(db="test_get_or_set")
+    timeout = 100
+    stale_ttl = 100
+    lock_poll_interval = 0.01
+
+
+@dataclasses.dataclass
+class ArticleValue:
+    site: int
+    id: int
+    title: str
+
+
+class PackedArticle(Article):
+    connection = MemoryRedis(db="test_codecs")
+    serializer = "msgpack"
+    value_type = ArticleValue
+
+
+class ArticleModel(BaseModel):
+    site: int
+    id: int
+    title: str
+
+
+class StampedArticleModel(ArticleModel):
+    published: datetime.datetime
+
+
+class StampedArticle(Article):
+    connection = MemoryRedis(db="test_stamped")
+    value_type = StampedArticleModel
+
+
+class AsyncArticle(ReadWriteAsyncCachedModel):
+    connection = AsyncMemoryRedis(db="test_async_caching")
+    ns = "article"
+    key_fields = ["site", "id"]
+    secondary_key_fields = ["slug"]
+
+
+class AsyncLocalArticle(AsyncArticle):
+    local_cache_size = 100
+
+
+class AsyncArticleReader(ReadOnlyAsyncCachedModel):
+    connection = AsyncArticle.connection
+    ns = "article"
+    key_fields = ["site", "id"]
+    local_cache_size = 100
+
+
+class AsyncJSONArticle(AsyncArticle):
+    serializer = "json"
+    value_type = ArticleModel
+
+
+class AsyncResubscribingArticle(AsyncArticle):
+    connection = AsyncMemoryRedis(db="test_async_resubscribe")
+    local_cache_size = 100
+
+
+class AsyncIndexedArticle(AsyncArticle):
+    connection = AsyncMemoryRedis(db="test_async_indexed_caching")
+    indexed = True
+
+
+def wait_for(condition, timeout=1):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        time.sleep(0.01)
+    raise TimeoutError()
+
+
+async def async_wait_for(condition, timeout=1):
+    for _ in range(int(timeout / 0.01)):
+        if condition():
+            return
+        await asyncio.sleep(0.01)
+    raise TimeoutError()
+
+
+def test_get_many():
+    Article.create(site=1, id=1, title="One")
+    Article.create(site=1, id=3, title="Three")
+    keys = [{"site": 1, "id": i} for i in (3, 2, 1)]
+    assert Article.get_many(keys, chunk_size=2) == [
+        {"site": 1, "id": 3, "title": "Three"},
+        None,
+        {"site": 1, "id": 1, "title": "One"},
+    ]
+    assert Article.exists_many(keys, chunk_size=2) == [True, False, True]
+    assert Article.get_many([]) == Article.exists_many([]) == []
+    progress = []
+    assert Article.delete_all(progress=progress.append) == 2
+    assert progress == [2]
+
+
+@pytest.mark.anyio
+async def test_async_get_many():
+    await AsyncArticle.create(site=1, id=1, title="One")
+    keys = [{"site": 1, "id": i} for i in (2, 1)]
+    assert await AsyncArticle.get_many(keys) == [
+        None,
+        {"site": 1, "id": 1, "title": "One"},
+    ]
+    assert await AsyncArticle.exists_many(keys) == [False, True]
+    progress = []
+    assert await AsyncArticle.delete_all(progress=progress.append) == 1
+    assert progress == [1]
+
+
+def test_local_cache():
+    key = {"site": 2, "id": 1}
+    LocalArticle.create(title="One", **key)
+    tiers = OtherLocalArticle._tiers()
+    OtherLocalArticle.get(**key)
+    wait_for(lambda: tiers.subscribed)
+    assert OtherLocalArticle.get_many([key]) == [dict(key, title="One")]
+    OtherLocalArticle.get(**key)["title"] = "Changed"
+    assert OtherLocalArticle.get(**key)["title"] == "One"
+
+    # writes from another worker evict the cached copy
+    LocalArticle.update(title="Uno", **key)
+    wait_for(lambda: not len(tiers.local))
+    assert OtherLocalArticle.get(**key)["title"] == "Uno"
+    stats = OtherLocalArticle.cache_stats()
+    assert stats["local"]["hits"] + stats["local"]["misses"] == 5
+    assert stats["local"]["hits"] >= 2
+    assert stats["redis"]["hits"] == stats["local"]["misses"]
+    assert stats["redis"]["hit_ratio"] == 1.0
+    assert Article.cache_stats()["local"] is None
+
+    # nested values and values other than dicts
+    LocalArticle.create(tags=["one"], **key)
+    wait_for(lambda: not len(tiers.local))
+    OtherLocalArticle.get(**key)["tags"].append("two")
+    assert OtherLocalArticle.get(**key)["tags"] == ["one"]
+    LocalArticle.create_counter(site=2, id=2)
+    assert OtherLocalArticle.get(site=2, id=2) == 1
+    assert OtherLocalArticle.get(site=2, id=2) == 1
+    LocalArticle.delete_all()
+
+
+@pytest.mark.anyio
+async def test_async_local_cache():
+    key = {"site": 2, "id": 1}
+    await AsyncLocalArticle.create(title="One", **key)
+    tiers = AsyncLocalArticle._tiers()
+    await AsyncLocalArticle.get(**key)
+    await async_wait_for(lambda: tiers.subscribed)
+    await AsyncLocalArticle.get(**key)
+    assert await AsyncLocalArticle.get(**key) == dict(key, title="One")
+    assert tiers.local.hits == 1
+
+    await AsyncLocalArticle.update(title="Uno", **key)
+    assert await AsyncLocalArticle.get(**key) == dict(key, title="Uno")
+    await AsyncLocalArticle.delete_all()
+
+
+def test_local_cache_of_reader():
+    key = {"site": 4, "id": 1}
+    Article.create(title="One", **key)
+    tiers = ArticleReader._tiers()
+    ArticleReader.get(**key)
+    wait_for(lambda: tiers.subscribed)
+    assert ArticleReader.get(**key)["title"] == "One"
+    assert len(tiers.local) == 1
+
+    # the writer caches nothing itself, but still invalidates
+    Article.update(title="Uno", **key)
+    wait_for(lambda: not len(tiers.local))
+    assert ArticleReader.get(**key)["title"] == "Uno"
+    Article.delete_all()
+
+
+@pytest.mark.anyio
+async def test_async_local_cache_of_reader():
+    key = {"site": 4, "id": 1}
+    await AsyncArticle.create(title="One", **key)
+    tiers = AsyncArticleReader._tiers()
+    await AsyncArticleReader.get(**key)
+    await async_wait_for(lambda: tiers.subscribed)
+    await AsyncArticleReader.get(**key)
+    assert len(tiers.local) == 1
+
+    await AsyncArticle.update(title="Uno", **key)
+    await async_wait_for(lambda: not len(tiers.local))
+    assert (await AsyncArticleReader.get(**key))["title"] == "Uno"
+    await AsyncArticle.delete_all()
+
+
+def test_local_cache_resubscribes(monkeypatch, caplog):
+    monkeypatch.setattr(caching, "RESUBSCRIBE_DELAY", 0.01)
+    connection = ResubscribingArticle.connection
+    dropped, resumed = threading.Event(), threading.Event()
+    pubsubs = []
+    pubsub = connection.pubsub
+
+    def dropping_pubsub(**options):
+        pubsubs.append(pubsub(**options))
+        if len(pubsubs) == 1:
+
+            def listen():
+                dropped.wait()
+                raise ConnectionError("Connection lost")
+                yield
+
+            pubsubs[0].listen = listen
+        elif len(pubsubs) == 2:
+            subscribe = pubsubs[1].subscribe
+            pubsubs[1].subscribe = lambda *channels: (
+                resumed.wait(),
+                subscribe(*channels),
+            )
+        return pubsubs[-1]
+
+    monkeypatch.setattr(connection, "pubsub", dropping_pubsub)
+    key = {"site": 3, "id": 1}
+    ResubscribingArticle.create(title="One", **key)
+    tiers = ResubscribingArticle._tiers()
+    ResubscribingArticle.get(**key)
+    wait_for(lambda: tiers.subscribed)
+    ResubscribingArticle.get(**key)
+    assert len(tiers.local) == 1
+
+    # the local tier is flushed, and neither read nor filled until the
+    # listener is back
+    dropped.set()
+    wait_for(lambda: len(pubsubs) == 2)
+    assert not tiers.subscribed and not len(tiers.local)
+    assert "article cache invalidations lost" in caplog.text
+    connection.set("article:3:1", '{"title": "Uno"}')
+    assert ResubscribingArticle.get(**key) == {"title": "Uno"}
+    assert not len(tiers.local)
+
+    resumed.set()
+    wait_for(lambda: tiers.subscribed)
+    ResubscribingArticle.get(**key)
+    ResubscribingArticle.update(title="Eins", **key)
+    wait_for(lambda: not len(tiers.local))
+    assert ResubscribingArticle.get(**key)["title"] == "Eins"
+    ResubscribingArticle.delete_all()
+
+
+@pytest.mark.anyio
+async def test_async_local_cache_resubscribes(monkeypatch, caplog):
+    monkeypatch.setattr(async_caching, "RESUBSCRIBE_DELAY", 0.01)
+    connection = AsyncResubscribingArticle.connection
+    dropped = asyncio.Event()
+    pubsubs = []
+    pubsub = connection.pubsub
+
+    def dropping_pubsub(**options):
+        pubsubs.append(pubsub(**options))
+        if len(pubsubs) == 1:
+
+            async def listen():
+                await dropped.wait()
+                raise ConnectionError("Connection lost")
+                yield
+
+            pubsubs[0].listen = listen
+        return pubsubs[-1]
+
+    monkeypatch.setattr(connection, "pubsub", dropping_pubsub)
+    key = {"site": 3, "id": 1}
+    await AsyncResubscribingArticle.create(title="One", **key)
+    tiers = AsyncResubscribingArticle._tiers()
+    await AsyncResubscribingArticle.get(**key)
+    await async_wait_for(lambda: tiers.subscribed)
+    await AsyncResubscribingArticle.get(**key)
+    assert len(tiers.local) == 1
+
+    dropped.set()
+    await async_wait_for(lambda: len(pubsubs) == 2 and tiers.subscribed)
+    assert not len(tiers.local)
+    assert "article cache invalidations lost" in caplog.text
+    await AsyncResubscribingArticle.get(**key)
+    await AsyncResubscribingArticle.update(title="Uno", **key)
+    await async_wait_for(lambda: not len(tiers.local))
+    assert (await AsyncResubscribingArticle.get(**key))["title"] == "Uno"
+    await AsyncResubscribingArticle.delete_all()
+
+
+def test_index():
+    for site, id in ((1, 1), (1, 2), (2, 1)):
+        IndexedArticle.create(site=site, id=id, title="One")
+    IndexedArticle.create_counter(site=3, id=1)
+    IndexedArticle.add_secondary_key("article:1:1", slug="one")
+    assert IndexedArticle.count_matched_keys() == 4
+    assert IndexedArticle.count_matched_keys(site=1) == 2
+    assert IndexedArticle.count_matched_keys(id=1) == 3
+    IndexedArticle.delete(site=3, id=1)
+    assert IndexedArticle.count_matched_keys() == 3
+
+    # expired keys are not counted, and leave the index on the next write
+    connection = IndexedArticle.connection
+    connection.store.expires[b"article:2:1"] = time.monotonic()
+    connection.zadd(IndexedArticle._index_key(), {"article:2:1": time.time()})
+    assert IndexedArticle.count_matched_keys() == 2
+    IndexedArticle.create(site=2, id=2, title="Two")
+    assert connection.zcount(IndexedArticle._index_key(), "-inf", "+inf") == 3
+
+    progress = []
+    assert IndexedArticle.delete_all(site=1, progress=progress.append) == 2
+    assert progress == [2]
+    assert IndexedArticle.count_matched_keys() == 1
+    assert IndexedArticle.get_by_secondary_key(slug="one") is None
+
+    # keys written before opting in
+    connection.set("article:4:1", "{}")
+    assert IndexedArticle.count_matched_keys() == 1
+    assert IndexedArticle.rebuild_index() == 2
+    assert IndexedArticle.count_matched_keys() == 2
+    assert IndexedArticle.delete_all() == 2
+    assert IndexedArticle.count_matched_keys() == 0
+
+
+@pytest.mark.anyio
+async def test_async_index():
+    await AsyncIndexedArticle.create(site=1, id=1, title="One")
+    await AsyncIndexedArticle.create_lookup(site=2, id=1)
+    assert await AsyncIndexedArticle.count_matched_keys() == 2
+    assert await AsyncIndexedArticle.count_matched_keys(site=2) == 1
+    await AsyncIndexedArticle.connection.zrem(
+        AsyncIndexedArticle._index_key(), "article:2:1"
+    )
+    assert await AsyncIndexedArticle.rebuild_index() == 2
+    assert await AsyncIndexedArticle.delete_all() == 2
+    assert await AsyncIndexedArticle.count_matched_keys() == 0
+
+
+def test_get_or_set(monkeypatch):
+    loads = []
+    locks = []
+    lock = LoadedArticle._lock
+    monkeypatch.setattr(
+        LoadedArticle, "_lock", lambda key: locks.append(key) or lock(key)
+    )
+
+    def loader():
+        loads.append(1)
+        time.sleep(0.05)
+        return {"title": f"Load {len(loads)}"}
+
+    results = []
+    threads = [
+        threading.Thread(
+            target=lambda: results.append(
+                LoadedArticle.get_or_set(loader, site=1, id=1)
+            )
+        )
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [{"title": "Load 1"}] * 5 and len(loads) == 1
+    # the other threads got the result without taking the lock in turn
+    assert locks == ["article:1:1"]
+    results[0]["title"] = "Changed"
+    assert results[1] == {"title": "Load 1"}
+    assert LoadedArticle.get(site=1, id=1) == {"title": "Load 1"}
+    assert LoadedArticle.get_or_set(lambda: None, site=1, id=2) is None
+    assert not LoadedArticle.exists(site=1, id=2)
+
+    # another process is loading: wait for its result
+    connection = LoadedArticle.connection
+    connection.set("_lock_:article:1:3", "other", px=1000)
+    threading.Timer(
+        0.05, lambda: connection.set("article:1:3", '{"title": "Other"}')
+    ).start()
+    assert LoadedArticle.get_or_set(loader, site=1, id=3) == {"title": "Other"}
+
+    # expired: served stale while another caller reloads it
+    connection.expire("article:1:1", 50)
+    connection.set("_lock_:article:1:1", "other", px=1000)
+    assert LoadedArticle.get_or_set(loader, site=1, id=1) == {"title": "Load 1"}
+    connection.delete("_lock_:article:1:1")
+    assert LoadedArticle.get_or_set(loader, site=1, id=1) == {"title": "Load 2"}
+    assert 150 < connection.ttl("article:1:1") <= 200
+
+    # written by create: fresh for `timeout` seconds as well
+    LoadedArticle.create(site=1, id=5, title="Five")
+    assert 150 < connection.ttl("article:1:5") <= 200
+    assert LoadedArticle.get_or_set(loader, site=1, id=5)["title"] == "Five"
+
+    stats = LoadedArticle.cache_stats()["recompute"]
+    assert (stats["loads"], stats["refreshes"], stats["served_stale"]) == (3, 1, 1)
+    assert stats["lock_waits"] == 1 and stats["coalesced"] == 4
+    # the unlock script is registered once
+    assert "_unlock_script" in vars(LoadedArticle)
+    LoadedArticle.delete_all()
+
+
+@pytest.mark.anyio
+async def test_async_get_or_set():
+    loads = []
+
+    async def loader():
+        loads.append(1)
+        await asyncio.sleep(0.01)
+        return {"title": "One"}
+
+    results = await asyncio.gather(
+        *[AsyncArticle.get_or_set(loader, site=1, id=1) for _ in range(5)]
+    )
+    assert results == [{"title": "One"}] * 5 and len(loads) == 1
+    results[0]["title"] = "Changed"
+    assert results[1] == {"title": "One"}
+    assert await AsyncArticle.get_or_set(loader, site=1, id=1) == {"title": "One"}
+    assert AsyncArticle.cache_stats()["recompute"]["coalesced"] == 4
+    await AsyncArticle.delete_all()
+
+
+def test_codecs():
+    # written before switching codecs
+    PackedArticle.connection.set("article:1:1", '{"site": 1, "id": 1, "title": "One"}')
+    PackedArticle.create(site=1, id=2, title="Two")
+    assert PackedArticle.connection.get("article:1:2")[:1] == b"m"
+    assert PackedArticle.get_many([{"site": 1, "id": i} for i in (1, 2, 3)]) == [
+        ArticleValue(1, 1, "One"),
+        ArticleValue(1, 2, "Two"),
+        None,
+    ]
+    value = PackedArticle.get_or_set(lambda: ArticleValue(1, 4, "Four"), site=1, id=4)
+    assert value == PackedArticle.get(site=1, id=4) == ArticleValue(1, 4, "Four")
+    PackedArticle.delete_all()
+
+
+def test_model_values():
+    published = datetime.datetime(2024, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    value = StampedArticleModel(site=1, id=1, title="One", published=published)
+    assert StampedArticle.get_or_set(lambda: value, site=1, id=1) == value
+    assert StampedArticle.get(site=1, id=1) == value
+    StampedArticle.delete_all()
+
+
+@pytest.mark.anyio
+async def test_async_codecs():
+    await AsyncArticle.create(site=1, id=1, title="One")
+    await AsyncJSONArticle.create(site=1, id=2, title="Two")
+    assert await AsyncJSONArticle.get(site=1, id=1) == ArticleModel(
+        site=1, id=1, title="One"
+    )
+    assert await AsyncArticle.get(site=1, id=2) == {"site": 1, "id": 2, "title": "Two"}
+    await AsyncArticle.delete_all()
@@ -0,0 +1,37 @@
+import time
+
+import pytest
+
+from apphelpers.utilities.memoryredis import AsyncMemoryRedis, MemoryRedis
+
+
+def test_expiry():
+    rconn = MemoryRedis(db="test_expiry")
+    rconn.set("k", "v", ex=100)
+    rconn.hset("h", mapping={"a": 1})
+    assert rconn.get("k") == b"v" and 99 <= rconn.ttl("k") <= 100
+    assert rconn.ttl("h") == -1 and rconn.ttl("nope") == -2
+
+    rconn.store.expires[b"k"] = time.monotonic()
+    assert rconn.get("k") is None and not rconn.exists("k")
+    assert rconn.keys("*") == [b"h"]
+
+
+def test_shared_store():
+    pipe = MemoryRedis(db="test_shared").pipeline()
+    pipe.sadd("s", 1, 2).srem("s", 1).smembers("s")
+    assert pipe.execute() == [2, 1, {b"2"}]
+    assert MemoryRedis(db="test_shared").smembers("s") == {b"2"}
+    assert MemoryRedis(db="other").smembers("s") == set()
+
+
+@pytest.mark.anyio
+async def test_async_pubsub():
+    rconn = AsyncMemoryRedis(db="test_pubsub")
+    pubsub = rconn.pubsub(ignore_subscribe_messages=True)
+    await pubsub.subscribe("channel")
+    assert await rconn.publish("channel", "hello") == 1
+    message = await pubsub.listen().__anext__()
+    assert message["data"] == b"hello"
+    await pubsub.aclose()
+    assert await rconn.publish("channel", "hello") == 0
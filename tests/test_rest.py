@@ -30,6 +30,7 @@ sessiondb_conn = dict(
     port=settings.SESSIONSDB_PORT,
     password=settings.SESSIONSDB_PASSWD,
     db=settings.SESSIONSDB_NO,
+    backend=settings.SESSIONSDB_BACKEND,
 )
 sessionsdb = sessionslib.SessionDBHandler(sessiondb_conn)
 sessionsdb.destroy_all()
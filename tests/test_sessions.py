@@ -1,7 +1,11 @@
 # -*- coding: utf-8 -*-
+import json
+import time
 from collections import namedtuple
 
 import pytest
+import redis
+from redis.crc import key_slot
 
 import apphelpers.sessions as sessionslib
 import settings
@@ -12,6 +16,7 @@ sessiondb_conn = dict(
     port=settings.SESSIONSDB_PORT,
     password=settings.SESSIONSDB_PASSWD,
     db=settings.SESSIONSDB_NO,
+    backend=settings.SESSIONSDB_BACKEND,
 )
 sessionsdb = sessionslib.SessionDBHandler(sessiondb_conn)
 sessionsdb.destroy_all()
@@ -43,6 +48,8 @@ def test_create():
     assert len(sid) == 43
     sid_new = sessionsdb.create(data.session.uid, data.session.groups)
     assert sid == sid_new == sessionsdb.uid2sid(d["uid"])
+    assert sessionsdb.rconn.ttl(sessionslib.session_key(sid)) > 0
+    assert sessionsdb.rconn.ttl(sessionslib.rev_lookup_key(d["uid"])) > 0
     state.sid = sid
     assert sessionsdb.uid2bound_sids(d["uid"]) == []
 
@@ -90,6 +97,16 @@ def test_update():
     assert k not in d
 
 
+def test_get_keys():
+    sid = state.sid
+    missing = object()
+    d = sessionsdb.get(sid, ["uid", "email", "nope"], default=missing)
+    assert d == {"uid": data.session.uid, "email": data.session_email, "nope": missing}
+    assert sessionsdb.get(sid, ["nope"]) == {"nope": None}
+    with pytest.raises(InvalidSessionError):
+        sessionsdb.get("no-such-sid", ["uid"])
+
+
 def test_resync():
     sid = state.sid
     k, v = data.session.k, data.session.v
@@ -107,6 +124,26 @@ def test_resync():
     assert k not in d
 
 
+def test_resync_many():
+    uids = range(20000, 20005)
+    sids = [sessionsdb.create(uid, ["member"], extras={"stale": 1}) for uid in uids]
+    keyvalues = {uid: {"groups": ["editor"], "name": str(uid)} for uid in uids}
+    keyvalues[20100] = {"groups": []}
+    assert sessionsdb.resync_many(keyvalues) == len(sids)
+    for uid, sid in zip(uids, sids):
+        assert sessionsdb.get(sid) == {
+            "uid": uid,
+            "groups": ["editor"],
+            "name": str(uid),
+            "site_ctx": None,
+        }
+        assert sessionsdb.rconn.ttl(sessionslib.session_key(sid)) > 0
+        sessionsdb.destroy(sid)
+    with pytest.raises(InvalidSessionError):
+        sessionsdb.resync(sids[0], {"uid": uids[0]})
+    assert not sessionsdb.rconn.exists(sessionslib.session_key(sids[0]))
+
+
 def test_delete():
     sessionsdb.destroy(state.sid)
     with pytest.raises(InvalidSessionError):
@@ -122,3 +159,437 @@ def test_session_lookups():
         sessionsdb.destroy(sid)
         with pytest.raises(InvalidSessionError):
             sessionsdb.get(sid)
+
+
+def test_bound_session_indexes():
+    uid, groups = 20001, ["grp1"]
+    sids = {
+        site_ctx: sessionsdb.create(uid, groups, site_ctx=site_ctx)
+        for site_ctx in (1, 2, 3)
+    }
+    assert sorted(sessionsdb.uid2bound_site_ids(uid)) == [1, 2, 3]
+    assert sorted(sessionsdb.uid2bound_sids(uid)) == sorted(sids.values())
+
+    # expired reverse lookups are dropped from the index
+    sessionsdb.rconn.delete(sessionslib.rev_lookup_key(uid, 3))
+    assert sorted(sessionsdb.uid2bound_site_ids(uid)) == [1, 2]
+
+    # sessions created before the index existed are picked up by a rebuild
+    sessionsdb.rconn.delete(sessionslib.bound_site_ids_key(uid))
+    assert sessionsdb.uid2bound_site_ids(uid) == []
+    sessionsdb.rebuild_bound_indexes()
+    assert sorted(sessionsdb.uid2bound_site_ids(uid)) == [1, 2]
+
+    sessionsdb.destroy_all_for_bound_site(1)
+    assert not sessionsdb.exists(sids[1])
+    assert sessionsdb.uid2bound_sids(uid) == [sids[2]]
+
+    sessionsdb.destroy_bound_sessions_for(uid)
+    assert not sessionsdb.exists(sids[2])
+    assert sessionsdb.uid2bound_sids(uid) == []
+
+
+def test_bound_session_slugs():
+    uid, groups = 20002, ["grp1"]
+    sid = sessionsdb.create(uid, groups, site_ctx="news")
+    numeric_sid = sessionsdb.create(uid, groups, site_ctx=7)
+    assert sorted(sessionsdb.uid2bound_sids(uid)) == sorted([sid, numeric_sid])
+    assert sorted(sessionsdb.uid2bound_site_ids(uid), key=str) == [7, "news"]
+    sessionsdb.destroy_bound_sessions_for(uid)
+    assert not sessionsdb.exists(sid) and not sessionsdb.exists(numeric_sid)
+
+
+def test_serializers():
+    uid, groups = 30001, ["grp1"]
+    site_groups = {1: ["editor"]}
+    legacy_sid = sessionsdb.create(uid, groups, site_groups=site_groups)
+    msgpack_sessionsdb = sessionslib.SessionDBHandler(
+        sessiondb_conn, serializer="msgpack"
+    )
+    # pickled sessions stay readable during the migration window
+    assert msgpack_sessionsdb.sid2uidgroups(legacy_sid) == (uid, groups)
+
+    sid = msgpack_sessionsdb.create(uid + 1, groups, site_groups=site_groups)
+    d = msgpack_sessionsdb.get(sid, ["uid", "groups", "site_groups", "site_ctx"])
+    assert d == dict(uid=uid + 1, groups=groups, site_groups=site_groups, site_ctx=None)
+
+    strict_sessionsdb = sessionslib.SessionDBHandler(
+        sessiondb_conn, serializer="msgpack", pickle_fallback=False
+    )
+    assert strict_sessionsdb.sid2uid(sid) == uid + 1
+    with pytest.raises(ValueError):
+        strict_sessionsdb.sid2uid(legacy_sid)
+
+    sessionsdb.destroy(legacy_sid)
+    sessionsdb.destroy(sid)
+
+    # JSON keys site_groups by str: read back by site id
+    site_groups = {1: ["editor"], "news": ["admin"]}
+    for layout in ("hash", "blob"):
+        json_sessionsdb = sessionslib.SessionDBHandler(
+            sessiondb_conn, serializer="json", layout=layout
+        )
+        sid = json_sessionsdb.create(uid + 2, groups, site_groups=site_groups)
+        assert json_sessionsdb.get(sid)["site_groups"] == site_groups
+        assert json_sessionsdb.get(sid, ["site_groups"]) == {"site_groups": site_groups}
+        assert json_sessionsdb.get_attribute(sid, "site_groups") == site_groups
+        assert json_sessionsdb.get_many([sid])[0]["site_groups"] == site_groups
+        json_sessionsdb.destroy(sid)
+
+
+def test_get_many():
+    uids = range(40000, 40005)
+    sids = [sessionsdb.create(uid, ["grp1"]) for uid in uids]
+    assert sessionsdb.uid2sid_many([*uids, 1], chunk_size=2) == [*sids, None]
+
+    sessions = sessionsdb.get_many(["no-such-sid", *sids], ["uid"], chunk_size=2)
+    assert sessions == [None, *({"uid": uid} for uid in uids)]
+    sessions = sessionsdb.get_many([sids[0], "no-such-sid"])
+    assert sessions[0]["groups"] == ["grp1"] and sessions[1] is None
+
+    for sid in sids:
+        sessionsdb.destroy(sid)
+
+
+def test_negative_cache():
+    cached_sessionsdb = sessionslib.SessionDBHandler(
+        sessiondb_conn, negative_cache_size=10
+    )
+    for _ in range(3):
+        with pytest.raises(InvalidSessionError):
+            cached_sessionsdb.get("no-such-sid", ["uid"])
+    assert cached_sessionsdb.negative_cache.hits == 2
+
+    sid = cached_sessionsdb.create(50001, ["grp1"])
+    assert cached_sessionsdb.sid2uid(sid) == 50001
+    cached_sessionsdb.destroy(sid)
+
+
+def test_signed_tokens():
+    signed_sessionsdb = sessionslib.SessionDBHandler(
+        sessiondb_conn, signing_key="secret", revocation_poll_interval=0
+    )
+    site_groups = {123: ["editor"]}
+    sid = signed_sessionsdb.create(
+        50002, ["grp1"], site_groups=site_groups, site_ctx=123
+    )
+    token = signed_sessionsdb.issue_signed_token(sid)
+    assert signed_sessionsdb.get(token, ["uid", "site_groups", "name"]) == {
+        "uid": 50002,
+        "site_groups": site_groups,
+        "name": None,
+    }
+
+    body, _, signature = token.partition(".")
+    with pytest.raises(InvalidSessionError):
+        signed_sessionsdb.get(body + "." + signature[::-1], ["uid"])
+
+    # personal data stays out of the (readable) token, read from redis instead
+    signed_sessionsdb.update(sid, {"email": "a@b.c"})
+    token = signed_sessionsdb.issue_signed_token(sid)
+    payload = json.loads(sessionslib._b64decode(token.partition(".")[0]))
+    assert "email" not in payload["s"] and "mobile" not in payload["s"]
+    assert signed_sessionsdb.get(token, ["uid", "email"]) == {
+        "uid": 50002,
+        "email": "a@b.c",
+    }
+
+    # expired tokens fall back to the session in redis
+    expired = sessionslib.SessionSigner("secret", ttl=-1).sign(sid, {"uid": 50002})
+    assert signed_sessionsdb.get(expired, ["uid", "groups"]) == {
+        "uid": 50002,
+        "groups": ["grp1"],
+    }
+
+    # revocations are only recorded by the processes told to
+    other_sid = sessionsdb.create(50003, ["grp1"])
+    sessionsdb.destroy(other_sid)
+    revoked = sessionsdb.rconn.zrangebyscore(
+        sessionslib.REVOKED_SIDS_KEY, "-inf", "+inf"
+    )
+    assert other_sid.encode() not in revoked
+
+    # destroyed by another process
+    writer = sessionslib.SessionDBHandler(sessiondb_conn, record_revocations=True)
+    writer.destroy(sid, site_ctx=123)
+    with pytest.raises(InvalidSessionError):
+        signed_sessionsdb.get(token, ["uid"])
+    with pytest.raises(InvalidSessionError):
+        signed_sessionsdb.get(expired, ["uid"])
+
+
+def test_signed_token_writes():
+    signed_sessionsdb = sessionslib.SessionDBHandler(
+        sessiondb_conn, signing_key="secret", revocation_poll_interval=0
+    )
+    sid = signed_sessionsdb.create(50004, ["grp1"], extras={"email": "a@b.c"})
+    token = signed_sessionsdb.issue_signed_token(sid)
+    assert signed_sessionsdb.issue_signed_token(token).startswith(token[:20])
+
+    # methods taking a sid act on the token's session
+    assert signed_sessionsdb.exists(token)
+    assert signed_sessionsdb.get_attribute(token, "email") == "a@b.c"
+    assert signed_sessionsdb.get_many([token], ["uid"]) == [{"uid": 50004}]
+    # a forged token in a batch comes back as None
+    forged = token[:-4] + "AAAA"
+    assert signed_sessionsdb.get_many([forged, token, "nope"], ["uid"]) == [
+        None,
+        {"uid": 50004},
+        None,
+    ]
+    signed_sessionsdb.update(token, {"k": "v"})
+    assert signed_sessionsdb.update_attribute(token, "k2", "v2")
+    assert signed_sessionsdb.get(sid, ["k", "k2"]) == {"k": "v", "k2": "v2"}
+    assert signed_sessionsdb.remove_from_session(token, ["k", "k2"])
+    assert signed_sessionsdb.get(sid, ["k"]) == {"k": None}
+    assert not sessionsdb.rconn.exists(sessionslib.session_key(token))
+
+    # fields not carried by the token are read from redis
+    uid_only = sessionslib.SessionDBHandler(
+        sessiondb_conn, signing_key="secret", signed_fields=["uid"]
+    )
+    assert uid_only.get(uid_only.issue_signed_token(sid), ["uid", "email"]) == {
+        "uid": 50004,
+        "email": "a@b.c",
+    }
+
+    # writes to signed fields, from any process recording revocations, revoke
+    # the issued tokens: they are answered from redis until reissued
+    writer = sessionslib.SessionDBHandler(sessiondb_conn, record_revocations=True)
+    writer.resync(sid, {"uid": 50004, "groups": ["grp2"]})
+    assert signed_sessionsdb.get(token, ["groups"]) == {"groups": ["grp2"]}
+    assert signed_sessionsdb.get(token) == {"uid": 50004, "groups": ["grp2"]}
+    signed_sessionsdb.update(token, {"email": "d@e.f"})
+    assert signed_sessionsdb.get(token, ["email"]) == {"email": "d@e.f"}
+    time.sleep(0.01)  # tokens issued within the same ms are not trusted
+    reissued = signed_sessionsdb.issue_signed_token(sid)
+    sessionsdb.rconn.delete(sessionslib.session_key(sid))
+    assert signed_sessionsdb.get(reissued, ["groups"]) == {"groups": ["grp2"]}
+
+    with pytest.raises(InvalidSessionError):
+        signed_sessionsdb.resync(token, {"uid": 50004})
+    with pytest.raises(InvalidSessionError):
+        signed_sessionsdb.get(token, ["uid"])
+
+
+def test_extend_timeout():
+    sliding_sessionsdb = sessionslib.SessionDBHandler(
+        sessiondb_conn, extend_interval=60
+    )
+    sid = sliding_sessionsdb.create(50003, ["grp1"], ttl=100, site_ctx=123)
+    assert sliding_sessionsdb.extend_timeout(sid, ttl=1000)
+    assert sessionsdb.rconn.ttl(sessionslib.session_key(sid)) > 100
+    assert sessionsdb.rconn.ttl(sessionslib.rev_lookup_key(50003, 123)) > 100
+
+    # throttled until extend_interval has passed
+    sessionsdb.rconn.expire(sessionslib.session_key(sid), 100)
+    assert not sliding_sessionsdb.extend_timeout(sid, ttl=1000)
+    assert sessionsdb.rconn.ttl(sessionslib.session_key(sid)) <= 100
+
+    sessionsdb.destroy(sid, site_ctx=123)
+    sliding_sessionsdb.extend_interval = 0
+    with pytest.raises(InvalidSessionError):
+        sliding_sessionsdb.extend_timeout(sid)
+
+
+def test_extend_bound_session():
+    uid, site_ctx = 50005, 50005
+    sid = sessionsdb.create(uid, ["grp1"], ttl=100, site_ctx=site_ctx)
+    assert sessionsdb.extend_timeout(sid, ttl=1000)
+
+    # the original ttl passes: only the keys extended past it are left
+    rconn = sessionsdb.rconn
+    for key in (
+        sessionslib.session_key(sid),
+        sessionslib.rev_lookup_key(uid, site_ctx),
+        sessionslib.bound_site_ids_key(uid),
+        sessionslib.bound_uids_key(site_ctx),
+    ):
+        if rconn.ttl(key) <= 100:
+            rconn.delete(key)
+    assert sessionsdb.uid2bound_sids(uid) == [sid]
+    sessionsdb.destroy_bound_sessions_for(uid)
+    assert not sessionsdb.exists(sid)
+
+    # extending never shortens an index other sessions keep alive
+    sid = sessionsdb.create(uid, ["grp1"], ttl=1000, site_ctx=site_ctx)
+    other_sid = sessionsdb.create(uid, ["grp1"], ttl=100, site_ctx=site_ctx + 1)
+    assert sessionsdb.extend_timeout(other_sid, ttl=10)
+    assert rconn.ttl(sessionslib.bound_site_ids_key(uid)) > 100
+    sessionsdb.destroy_bound_sessions_for(uid)
+
+
+def test_destroy_all():
+    sids = [sessionsdb.create(uid, ["grp1"]) for uid in range(60000, 60005)]
+    counts = []
+    assert sessionsdb.destroy_all(batch_size=2, progress=counts.append) >= 10
+    assert counts == sorted(counts) and len(counts) >= 5
+    assert not any(sessionsdb.exists(sid) for sid in sids)
+
+
+def test_cluster_key_layout():
+    uid, site_ctx = 60010, 123
+    sid = sessionslib.slot_tag(uid) + "x" * sessionslib.SID_LEN
+    keys = [
+        sessionslib.cluster_session_key(sid),
+        sessionslib.cluster_rev_lookup_key(uid),
+        sessionslib.cluster_rev_lookup_key(uid, site_ctx),
+        sessionslib.cluster_bound_site_ids_key(uid),
+    ]
+    assert len({key_slot(key.encode()) for key in keys}) == 1
+
+    legacy_sid = "x" * sessionslib.SID_LEN
+    assert sessionslib.to_cluster_key(sessionslib.session_key(legacy_sid)) == (
+        sessionslib.cluster_session_key(legacy_sid)
+    )
+    assert sessionslib.to_cluster_key(
+        sessionslib.rev_lookup_key(uid, site_ctx)
+    ) == sessionslib.cluster_rev_lookup_key(uid, site_ctx)
+    assert sessionslib.to_cluster_key(sessionslib.bound_uids_key(site_ctx)) is None
+    assert sessionslib.to_cluster_key(keys[0]) is None
+
+
+def test_cluster_params():
+    params = dict(host="h", port=1, db=0, backend=None, password="p", ssl=True)
+    assert sessionslib.cluster_params(params) == dict(
+        host="h", port=1, password="p", ssl=True
+    )
+    with pytest.raises(ValueError):
+        sessionslib.cluster_params(dict(params, backend="memory"))
+
+
+def test_replica_reads():
+    replica_conn = dict(sessiondb_conn, db=settings.SESSIONSDB_NO + 1)
+    replica = sessionslib.SessionDBHandler(replica_conn)
+    replicated_sessionsdb = sessionslib.SessionDBHandler(
+        sessiondb_conn,
+        replicas=[replica_conn, replica_conn],
+        replica_selection="least_latency",
+    )
+    # only on the "replica"
+    replica_sid = replica.create(60020, ["grp1"])
+    assert replicated_sessionsdb.sid2uid(replica_sid) == 60020
+
+    # missing from the replica: read from the primary
+    sid = sessionsdb.create(60021, ["grp1"])
+    assert replicated_sessionsdb.sid2uid(sid) == 60021
+    sessions = replicated_sessionsdb.get_many([replica_sid, sid], ["uid"])
+    assert sessions == [{"uid": 60020}, {"uid": 60021}]
+    assert replicated_sessionsdb.uid2sid_many([60020, 60021]) == [replica_sid, sid]
+
+    # a lagging replica does not hide this process's own writes
+    replica.rconn.hset(sessionslib.session_key(sid), "uid", replica._dumps(1))
+    assert replicated_sessionsdb.sid2uid(sid) == 1
+    replicated_sessionsdb.update(sid, {"k": "v"})
+    assert replicated_sessionsdb.get(sid, ["uid", "k"]) == {"uid": 60021, "k": "v"}
+
+    replica.destroy_all()
+    sessionsdb.destroy(sid)
+
+
+def test_compression():
+    compressed_sessionsdb = sessionslib.SessionDBHandler(
+        sessiondb_conn, compression="zlib", compression_threshold=100
+    )
+    profile = {"history": ["article-%d" % i for i in range(200)]}
+    sid = compressed_sessionsdb.create(60030, ["grp1"], extras=dict(profile=profile))
+    stored = sessionsdb.rconn.hget(sessionslib.session_key(sid), "profile")
+    assert stored[:1] == b"z" and len(stored) < len(sessionsdb._dumps(profile))
+    # small fields are left alone
+    stored = sessionsdb.rconn.hget(sessionslib.session_key(sid), "uid")
+    assert stored == sessionsdb._dumps(60030)
+
+    # readers decompress whatever their own settings
+    assert sessionsdb.get_attribute(sid, "profile") == profile
+    sessionsdb.update(sid, {"profile": {"history": []}})
+    assert compressed_sessionsdb.get(sid)["profile"] == {"history": []}
+    sessionsdb.destroy(sid)
+
+
+def test_pool_options():
+    params = dict(host=settings.SESSIONSDB_HOST, port=settings.SESSIONSDB_PORT)
+    handler = sessionslib.SessionDBHandler(
+        params,
+        replicas=[params],
+        max_connections=4,
+        pool_timeout=0.5,
+        health_check_interval=10,
+        retries=2,
+    )
+    pool = handler.rconn.connection_pool
+    assert isinstance(pool, redis.BlockingConnectionPool)
+    assert (pool.max_connections, pool.timeout) == (4, 0.5)
+    assert pool.connection_kwargs["health_check_interval"] == 10
+    assert pool.connection_kwargs["retry"].get_retries() == 2
+    stats = handler.pool_stats()
+    assert stats["primary"] == stats["replicas"][0]
+    assert stats["primary"]["in_use"] == stats["primary"]["acquired"] == 0
+
+    handler = sessionslib.SessionDBHandler(params)
+    assert not isinstance(handler.rconn.connection_pool, redis.BlockingConnectionPool)
+    assert handler.pool_stats()["primary"]["max_connections"] > 4
+    assert sessionsdb.pool_stats()["replicas"] == []
+
+
+def test_blob_layout():
+    blobdb = sessionslib.SessionDBHandler(sessiondb_conn, layout="blob")
+    sid = blobdb.create(30001, ["member"], extras={"name": "One", "stale": 1})
+    sk = sessionslib.session_key(sid)
+    assert blobdb.rconn.type(sk) == b"string" and blobdb.rconn.ttl(sk) > 0
+    assert blobdb.get(sid, ["uid", "nope"]) == {"uid": 30001, "nope": None}
+
+    blobdb.update(sid, {"name": "Uno"})
+    blobdb.remove_from_session(sid, ["stale"])
+    assert blobdb.get_attribute(sid, "name") == "Uno"
+    blobdb.resync(sid, {"uid": 30001, "groups": ["editor"]})
+    assert blobdb.get(sid) == {"uid": 30001, "groups": ["editor"]}
+    assert blobdb.rconn.ttl(sk) > 0
+
+    # Either layout reads and writes sessions stored in the other one
+    hash_sid = sessionsdb.create(30002, ["member"])
+    for db, other_sid in ((blobdb, hash_sid), (sessionsdb, sid)):
+        db.update(other_sid, {"name": "Two"})
+        assert db.get(other_sid, ["name"]) == {"name": "Two"}
+        [session] = db.get_many([other_sid], ["groups", "name"])
+        assert session["name"] == "Two"
+    assert sessionsdb.rconn.type(sessionslib.session_key(hash_sid)) == b"hash"
+    assert sessionsdb.get_many([sid, hash_sid, "nope"])[2] is None
+    blobdb.destroy(sid)
+    blobdb.destroy(hash_sid)
+    assert not blobdb.rconn.exists(sk)
+
+
+def test_call_metrics(caplog):
+    calls = []
+    handler = sessionslib.SessionDBHandler(
+        sessiondb_conn,
+        metrics=True,
+        call_hooks=[lambda *call: calls.append(call)],
+        slow_call_threshold=0,
+    )
+    sid = handler.create(40001, ["member"])
+    handler.get(sid)
+    with pytest.raises(InvalidSessionError):
+        handler.get("nope")
+    stats = handler.metrics.stats()
+    assert stats["get"]["count"] == 2
+    assert stats["get"]["errors"] == {"InvalidSessionError": 1}
+    assert stats["get"]["buckets"]["+Inf"] == 2
+    assert stats["create"]["count"] == 1 and stats["create"]["errors"] == {}
+    assert [(method, type(error)) for method, _, error in calls] == [
+        ("create", type(None)),
+        ("get", type(None)),
+        ("get", InvalidSessionError),
+    ]
+    assert "slow call: create took" in caplog.text
+    assert sid not in caplog.text
+
+    # One event per public call: those it makes internally are part of it
+    del calls[:]
+    handler.get_attribute(sid, "uid")
+    handler.exists(sid)
+    handler.destroy(sid)
+    assert [method for method, _, _ in calls] == ["get_attribute", "exists", "destroy"]
+
+    # Not instrumented: the class' own methods
+    assert "get" not in vars(sessionsdb)